@@ -13,6 +13,7 @@ from statsmodels.stats import multitest
 
 
 from Session import SessionLite, Session
+from session_store import load_session_store
 from loadpaths import loadpaths
 
 ## Wes Anderson color palette
@@ -92,9 +93,14 @@ class AverageTraces():
         sessions_file = 'sessions_lite_flu_2022-08-11.pkl'
         # sessions_file = 'sessions_full_flu_2022-08-11.pkl'
         sessions_path = os.path.join(base_path, sessions_file)
-                                 
-        with open(sessions_path, 'rb') as f:
-            self.sessions = pickle.load(f)
+
+        # Use memory-mapped session store if it exists (convert pkl with session_store.py)
+        store_path = os.path.splitext(sessions_path)[0]
+        if os.path.exists(os.path.join(store_path, 'index.json')):
+            self.sessions = load_session_store(store_path)
+        else:
+            with open(sessions_path, 'rb') as f:
+                self.sessions = pickle.load(f)
 
 
     @property
@@ -192,9 +198,9 @@ class AverageTraces():
                 behaviour_trials = session.behaviour_trials
 
             if mask == 'targets' and not prereward:
-                behaviour_trials = np.ma.array(behaviour_trials, mask=~session.is_target)
+                behaviour_trials = np.ma.array(behaviour_trials, mask=~session.get_is_target_3d())
             elif mask == 'followers' and not prereward:
-                behaviour_trials = np.ma.array(behaviour_trials, mask=session.is_target)
+                behaviour_trials = np.ma.array(behaviour_trials, mask=session.get_is_target_3d())
 
             # Cells include is a list of boolean lists of len(n_sesions)
             if type(cells_include) == list:
@@ -16,6 +16,7 @@ from Session import build_flu_array_single, SessionLite
 from utils_funcs import build_flu_array
 import copy
 import pickle
+import hashlib
 from popoff import loadpaths
 from IPython.display import HTML, display
 from IPython.core.debugger import Pdb
@@ -167,6 +168,162 @@ def pca_session(session, cells_include, n_components=100, plot=False,
     return session
 
 
+def stack_trials(flu, frames):
+    ''' Stack the trials of a fluoresence array, so that all per-trial
+        statistics can be computed at once (vectorised across trials).
+
+    Parameters
+    ----------
+    flu : fluoresence array [n_cells x n_trials x n_frames]
+    frames : indexing array, frames to select
+
+    Returns
+    -------
+    trials : array [n_trials x n_cells x n_selected_frames]
+
+    '''
+    return np.transpose(flu[:, :, frames], (1, 0, 2))
+
+
+def _mean_abs_offdiag_corr(trials, max_chunk_size=2e7):
+    ''' Mean of the absolute off-diagonal cell-cell correlation coefficients
+        of every trial of trials [n_trials x n_cells x n_frames]. The correlation
+        matrices are computed with einsum in chunks of trials of at most
+        max_chunk_size elements, to limit memory. '''
+    n_trials, n_cells, _ = trials.shape
+    centred = trials - np.mean(trials, 2, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):  # constant cells give NaN, as np.corrcoef
+        normed = centred / np.sqrt(np.sum(centred ** 2, 2, keepdims=True))
+    chunk = max(1, int(max_chunk_size // (n_cells ** 2)))
+    trial_corr = np.zeros(n_trials)
+    for i_start in range(0, n_trials, chunk):
+        sub = normed[i_start:(i_start + chunk)]
+        matrix = np.einsum('tcf,tdf->tcd', sub, sub, optimize=True)
+        matrix = np.abs(np.clip(matrix, -1, 1))  # clip as np.corrcoef
+        sum_offdiag = np.sum(matrix, (1, 2)) - np.trace(matrix, axis1=1, axis2=2)
+        trial_corr[i_start:(i_start + chunk)] = sum_offdiag / (n_cells * (n_cells - 1))
+    return trial_corr
+
+
+def _n_PCs_from_ratio(variance_ratio, perc=90):
+    ''' Number of PCs needed to explain perc % of variance, from
+        variance ratio array [n_trials x n_pcs] (see number_PCs_percentage()). '''
+    varexp = np.cumsum(variance_ratio, 1)
+    assert np.all(varexp[:, -1] <= 1.01), varexp[:, -1]
+    ## in case there are multiple pcs with cum var = 1, we want the first one (if this is closest to perc):
+    converged = np.isclose(varexp, 1.0)
+    after_first_conv = (np.cumsum(converged, 1) - converged) > 0  # after first converged pc, add a bit
+    varexp = varexp + 0.1 * after_first_conv  # set to 1.1
+    return np.argmin(np.abs(varexp - (perc / 100)), 1)
+
+
+class TrialSpectrum():
+    ''' Eigen-spectrum of the (pre-stim) population activity of every trial
+
+    Every trial matrix [n_cells x n_frames] is decomposed once (one batched
+    SVD across trials), and all PCA-based covariates are derived from this
+    decomposition. PCA is defined as in do_pca(): frames are samples and cells
+    are features. Signs of PCs are fixed as in sklearn's PCA (svd_flip with
+    u_based_decision), ie such that the largest absolute entry of every PC's
+    time course (left singular vector of the frames x cells matrix) is positive.
+
+    Parameters
+    -----------
+    flu : fluoresence array [n_cells x n_trials x n_frames]
+    frames : indexing array, frames across which to compute spectrum
+
+    Attibutes
+    -----------
+    singular_values : singular values of centred trials [n_trials x n_pcs]
+    variance_ratio : explained variance ratio of PCs [n_trials x n_pcs]
+    loading : PC loadings (PCA components) [n_trials x n_pcs x n_cells]
+    traces : projection of (uncentred) activity on PCs [n_trials x n_pcs x n_frames]
+    largest_singular_value : largest singular value of uncentred trials [n_trials]
+
+    Methods
+    --------
+    n_PCs : number of PCs needed to explain a percentage of variance
+    '''
+
+    def __init__(self, flu, frames):
+        trials = stack_trials(flu, frames)
+        centred = trials - np.mean(trials, 2, keepdims=True)
+        u, s, vt = np.linalg.svd(centred, full_matrices=False)
+        # svd_flip rule of sklearn.decomposition.PCA, batched across trials (vt rows are sklearn's U columns)
+        i_max = np.argmax(np.abs(vt), 2)[:, :, np.newaxis]
+        signs = np.sign(np.take_along_axis(vt, i_max, 2))
+        loading = np.transpose(u, (0, 2, 1)) * signs
+
+        self.n_trials = trials.shape[0]
+        self.singular_values = s
+        self.variance_ratio = s ** 2 / np.sum(s ** 2, 1, keepdims=True)
+        self.loading = loading
+        self.traces = np.einsum('tpc,tcf->tpf', loading, trials, optimize=True)
+
+        # The uncentred spectrum only requires eigenvalues of the (small) gram matrix
+        if trials.shape[2] <= trials.shape[1]:
+            gram = np.einsum('tcf,tcg->tfg', trials, trials, optimize=True)
+        else:
+            gram = np.einsum('tcf,tdf->tcd', trials, trials, optimize=True)
+        self.largest_singular_value = np.sqrt(np.maximum(np.linalg.eigvalsh(gram)[:, -1], 0))
+
+    def __getitem__(self, trial_inds):
+        ''' Spectrum of subset of trials '''
+        subset = copy.copy(self)
+        for attr in ['singular_values', 'variance_ratio', 'loading', 'traces',
+                     'largest_singular_value']:
+            setattr(subset, attr, getattr(self, attr)[trial_inds])
+        subset.n_trials = len(subset.largest_singular_value)
+        return subset
+
+    def n_PCs(self, perc=90):
+        return _n_PCs_from_ratio(self.variance_ratio, perc=perc)
+
+
+def trial_covariates(flu, frames, spectrum=None):
+    ''' Compute all (non-factor analysis) population covariates of every trial
+        at once. Equivalent to calling mean_cross_correlation(), largest_singular_value(),
+        largest_PC_var(), number_PCs_percentage() (90 and 95%), flattened_variance(),
+        variance_pop_mean(), variance_cell_rates(), mean_cell_variance(),
+        var_cell_variance() and jonas_metric() separately, but the trials are
+        stacked only once and the decompositions are batched across trials.
+
+    Parameters
+    ----------
+    flu : fluoresence array [n_cells x n_trials x n_frames]
+    frames : indexing array, frames across which to compute covariates
+    spectrum : TrialSpectrum of flu & frames, default None
+        If None, it is computed here.
+
+    Returns
+    -------
+    covs : dict with function names (and 'n_PCs_90', 'n_PCs_95') as keys
+           and vectors of len n_trials as values.
+
+    '''
+    trials = stack_trials(flu, frames)
+    cell_means = np.mean(trials, 2)
+    cell_vars = np.var(trials, 2)
+    pop_mean = np.mean(trials, 1)
+    if spectrum is None:
+        spectrum = TrialSpectrum(flu, frames)
+    assert spectrum.n_trials == trials.shape[0], f'spectrum has {spectrum.n_trials} trials, flu has {trials.shape[0]}'
+
+    covs = {}
+    covs['mean_cross_correlation'] = _mean_abs_offdiag_corr(trials)
+    covs['largest_singular_value'] = spectrum.largest_singular_value
+    covs['largest_PC_var'] = spectrum.variance_ratio[:, 0]
+    covs['n_PCs_90'] = spectrum.n_PCs(perc=90)
+    covs['n_PCs_95'] = spectrum.n_PCs(perc=95)
+    covs['flattened_variance'] = np.var(trials, (1, 2))
+    covs['variance_pop_mean'] = np.var(pop_mean, 1)
+    covs['variance_cell_rates'] = np.var(cell_means, 1)
+    covs['mean_cell_variance'] = np.mean(cell_vars, 1)
+    covs['var_cell_variance'] = np.var(cell_vars, 1)
+    covs['jonas_metric'] = np.std(pop_mean, 1)  # subtracting the grand mean does not change std
+    return covs
+
+
 def mean_cross_correlation(flu, frames):
 
     ''' Takes the mean of the absolute off-diagonal
@@ -184,172 +341,149 @@ def mean_cross_correlation(flu, frames):
                  mean of correlation coefficient matrix matrix on each trial.
 
     '''
+    return _mean_abs_offdiag_corr(stack_trials(flu, frames))
 
-    trial_corr = []
 
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        matrix = np.corrcoef(trial)
-        matrix = matrix[~np.eye(matrix.shape[0], dtype=bool)]
-        matrix = np.abs(matrix)
-        mean_cov = np.mean(matrix)
-        trial_corr.append(mean_cov)
+def largest_singular_value(flu, frames, centre=False, spectrum=None):
 
-    return np.array(trial_corr)
+    if spectrum is None:
+        spectrum = TrialSpectrum(flu, frames)
+    if centre:
+        return spectrum.singular_values[:, 0]
+    return spectrum.largest_singular_value
 
 
-def largest_singular_value(flu, frames, centre=False):
+def largest_PC_var(flu, frames, spectrum=None):
 
-    singular_values = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        trial = trial.T
-        if centre:
-            mean_ = np.mean(trial, axis=0)
-            trial -= mean_
-        _, s, _ = np.linalg.svd(trial)
-        singular_values.append(s[0])
+    if spectrum is None:
+        spectrum = TrialSpectrum(flu, frames)
+    return spectrum.variance_ratio[:, 0]
 
-    return np.array(singular_values)
+def number_PCs_percentage(flu, frames, perc=90, spectrum=None):
 
+    if spectrum is None:
+        spectrum = TrialSpectrum(flu, frames)
+    return spectrum.n_PCs(perc=perc)
 
-def largest_PC_var(flu, frames):
+def largest_factor_var(flu, frames):
 
     PC_vars = []
     for t in range(flu.shape[1]):
         trial = flu[:, t, :]
         trial = trial[:, frames]
-        varexp, _, _ = do_pca(trial, 10, plot=False)
+        varexp, _ = do_fa(trial, 10, plot=False)
         PC_vars.append(varexp[0])
 
     return np.array(PC_vars)
 
-def number_PCs_percentage(flu, frames, perc=90):
+def jonas_metric(flu, frames):
 
-    n_pcs = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        varexp, _, _ = do_pca(trial, np.minimum(trial.shape[0], trial.shape[1]), plot=False)
-        assert varexp[-1] <= 1.01, varexp
-        ## in case there are multiple pcs with cum var = 1, we want the first one (if this is closest to perc):
-        after_first_conv = False
-        for ii in range(len(varexp)):
-            if after_first_conv:  # if after first converged pc, add a bit. 
-                varexp[ii] += 0.1  # set to 1.1
-            if varexp[ii] == 1.0:  # if converged, set to True from now on 
-                after_first_conv = True 
-        result = np.argmin(np.abs(varexp - (perc / 100)))
-        n_pcs.append(result)
-
-    return np.array(n_pcs)
+    # std across time of mean across cells
+    return np.std(np.mean(stack_trials(flu, frames), 1), 1)
 
-def largest_factor_var(flu, frames):
+def largest_PC_loading(flu, frames, spectrum=None):
 
-    PC_vars = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        varexp, _ = do_fa(trial, 10, plot=False)
-        PC_vars.append(varexp[0])
+    if spectrum is None:
+        spectrum = TrialSpectrum(flu, frames)
+    # loadings = pca.components_.T * np.sqrt(pca.explained_variance_)
+    return spectrum.loading[:, 0, :]
 
-    return np.array(PC_vars)
 
-def jonas_metric(flu, frames):
+def largest_PC_trace(flu, frames, spectrum=None):
 
-    jm = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        # mean across cells
-        trial -= np.mean(trial)
-        meaned = np.mean(trial, 0)
-        jm.append(np.std(meaned))
+    if spectrum is None:
+        spectrum = TrialSpectrum(flu, frames)
+    return list(spectrum.traces[:, 0, :])
 
-    return np.array(jm)
 
-def largest_PC_loading(flu, frames):
+def flattened_variance(flu, frames):
 
-    PC_loading = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        pca = PCA(n_components=10)
-        pca.fit(trial.T)
+    return np.var(stack_trials(flu, frames), (1, 2))
 
-        # loadings = pca.components_.T * np.sqrt(pca.explained_variance_)
-        loadings = pca.components_.T
-        PC_loading.append(loadings[:, 0])
 
-    return np.array(PC_loading)
+def variance_cell_rates(flu, frames):
 
+    return np.var(np.mean(stack_trials(flu, frames), 2), 1)
 
-def largest_PC_trace(flu, frames):
 
-    traces = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        _, trace = do_pca(trial, 10, plot=False)
-        traces.append(trace[0, :])
-
-    return traces
+def mean_cell_variance(flu, frames):
 
+    return np.mean(np.var(stack_trials(flu, frames), 2), 1)
 
-def flattened_variance(flu, frames):
+def var_cell_variance(flu, frames):
 
-    vars_ = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        vars_.append(np.var(trial))
+    return np.var(np.var(stack_trials(flu, frames), 2), 1)
 
-    return np.array(vars_)
+def variance_pop_mean(flu, frames):
 
+    return np.var(np.mean(stack_trials(flu, frames), 1), 1)
 
-def variance_cell_rates(flu, frames):
 
-    vars_ = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        vars_.append(np.var(np.mean(trial, axis=1)))
+## Covariates of LinearModel.prepare_data(model='partial') are stored on disk per session,
+## so that they are only computed once. Increase the version if the covariates code changes.
+COVARIATE_STORE_FOLDER = os.path.join(USER_PATHS_DICT['base_path'], 'covariate_store')
+COVARIATE_STORE_VERSION = 1
 
-    return np.array(vars_)
 
+def hash_arrays(*arrays):
+    ''' Hash of the contents (and shape & dtype) of arrays '''
+    hasher = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        hasher.update(f'{arr.shape}_{arr.dtype}'.encode())
+        if arr.dtype == object:
+            hasher.update(pickle.dumps(arr.tolist()))
+        else:
+            hasher.update(arr.tobytes())
+    return hasher.hexdigest()
 
-def mean_cell_variance(flu, frames):
 
-    vars_ = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        vars_.append(np.mean(np.var(trial, axis=1)))
+class CovariateStore():
+    ''' On-disk store of covariates of one session (one pickle file per session).
 
-    return np.array(vars_)
+    Entries are keyed by (region, frame window, trial selection) and are only
+    returned if the hash of the input data (and COVARIATE_STORE_VERSION) matches
+    the hash that was stored with them, so stale entries are recomputed.
 
-def var_cell_variance(flu, frames):
+    Parameters
+    -----------
+    signature : session.signature, used as file name
+    folder : folder of the store, default COVARIATE_STORE_FOLDER
 
-    vars_ = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        vars_.append(np.var(np.var(trial, axis=1)))
+    Methods
+    --------
+    load : return stored (covariates_dict, y) or None if not stored or stale
+    save : store (covariates_dict, y)
+    '''
 
-    return np.array(vars_)
+    def __init__(self, signature, folder=None):
+        if folder is None:
+            folder = COVARIATE_STORE_FOLDER
+        self.path = os.path.join(folder, f'{signature}_covariates.pkl')
 
-def variance_pop_mean(flu, frames):
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'rb') as f:
+            return pickle.load(f)
 
-    vars_ = []
-    for t in range(flu.shape[1]):
-        trial = flu[:, t, :]
-        trial = trial[:, frames]
-        meaned = np.mean(trial, 0)
-        vars_.append(np.var(meaned))
+    def load(self, key, input_hash):
+        entry = self._read().get(key)
+        if entry is None or entry['input_hash'] != input_hash or entry['version'] != COVARIATE_STORE_VERSION:
+            return None
+        return copy.deepcopy(entry['covariates']), entry['y'].copy()
 
-    return np.array(vars_)
+    def save(self, key, input_hash, covariates_dict, y):
+        try:
+            store = self._read()
+            store[key] = {'input_hash': input_hash, 'version': COVARIATE_STORE_VERSION,
+                          'covariates': copy.deepcopy(covariates_dict), 'y': y.copy()}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'wb') as f:  # write to tmp first, so that no partial files exist
+                pickle.dump(store, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            print(f'WARNING: covariates could not be stored in {self.path}: {e}')
 
 
 def reward_history(session, window_size=5):
@@ -535,10 +669,32 @@ class LinearModel():
                            's2': self.session.s2_bool
                            }
 
+    def get_trial_spectrum(self, frames, region='all', prereward=False):
+        ''' Return TrialSpectrum of all trials of self.flu (or self.pre_flu if prereward)
+            for cells of region and frames (indexing array).
+
+            Spectra are memoised per (region, frames, prereward), so that all
+            PCA-based covariates of a session require only one decomposition per trial.
+            The memo is reset when self.flu or self.pre_flu are reassigned (eg by
+            remove_targets_from_data()).
+            '''
+        flu = self.pre_flu if prereward else self.flu
+        cache_key = (region, prereward, np.asarray(frames).tobytes())
+        if not hasattr(self, '_spectrum_cache'):
+            self._spectrum_cache = {}
+        if cache_key in self._spectrum_cache:
+            cached_flu, spectrum = self._spectrum_cache[cache_key]
+            if cached_flu is flu:
+                return spectrum
+            self._spectrum_cache = {}  # flu has been reassigned
+        spectrum = TrialSpectrum(flu[self.region_map[region], :, :], frames)
+        self._spectrum_cache[cache_key] = (flu, spectrum)
+        return spectrum
+
     def prepare_data(self, frames='all', model='full',
                      outcomes=['hit', 'miss', 'cr', 'fp'], region='all',
                      n_comps_include=0, prereward=False, remove_easy=False,
-                     return_matrix=True):
+                     return_matrix=True, use_store=True):
         ''' Prepare fluoresence data in Session object for regression
 
         Parameters
@@ -564,6 +720,10 @@ class LinearModel():
         prereward : bool, default=False
             Just include prereward trials? Negates outcomes argument
 
+        use_store : bool, default=True
+            Load covariates of partial model from CovariateStore if they have
+            been computed before for the same input data, and store them otherwise.
+
 
         Returns
         --------
@@ -600,10 +760,24 @@ class LinearModel():
         if model == 'full':
             X = self.covariates_full(flu=flu, frames=frames)
         elif model == 'partial':
-            covariates_dict = self.covariates_partial(flu=flu, frames=frames,
-                                        trial_bool=trial_bool, region=region,
-                                        n_comps_include=n_comps_include,
-                                        prereward=prereward)
+            covariates_dict = None
+            if use_store:
+                store = CovariateStore(signature=self.session.signature)
+                store_key = (region, prereward, remove_easy, tuple(np.unique(outcomes)),
+                             hash_arrays(self.pre, self.post, self.remove_artifact))
+                input_hash = hash_arrays(flu, trial_bool, y, self.session.outcome,
+                                         self.session.trial_subsets, self.session.decision)
+                stored = store.load(key=store_key, input_hash=input_hash)
+                if stored is not None:
+                    covariates_dict, y = stored
+            if covariates_dict is None:
+                covariates_dict = self.covariates_partial(flu=flu, frames=frames,
+                                            trial_bool=trial_bool, region=region,
+                                            n_comps_include=n_comps_include,
+                                            prereward=prereward)
+                if use_store:
+                    store.save(key=store_key, input_hash=input_hash,
+                               covariates_dict=covariates_dict, y=y)
 
             X = self.dict2matrix(covariates_dict)
         else:
@@ -659,20 +833,26 @@ class LinearModel():
         # Mean network activity just after the stim
         covariates_dict['mean_post'] = np.mean(flu[:, :, self.post], (0, 2))
 
+        # Population covariates of pre stim frames, batched across trials.
+        # The spectrum of all trials is memoised, select trials used here
+        spectrum = self.get_trial_spectrum(frames=self.pre, region=region,
+                                           prereward=prereward)
+        if not prereward:  # prereward uses all trials
+            spectrum = spectrum[trial_bool]
+        pre_covs = trial_covariates(flu, self.pre, spectrum=spectrum)
+
         # Mean trace correlation pre stim
-        covariates_dict['corr_pre'] = np.log((mean_cross_correlation(flu,
-                                                    self.frames_map['pre'])))
+        covariates_dict['corr_pre'] = np.log(pre_covs['mean_cross_correlation'])
         # Mean trace correlation post stim
         covariates_dict['corr_post'] = np.log((mean_cross_correlation(flu,
                                                      self.frames_map['post'])))
 
-        covariates_dict['largest_singular_value'] = np.log(largest_singular_value(
-                                                           flu, self.pre))
+        covariates_dict['largest_singular_value'] = np.log(pre_covs['largest_singular_value'])
 
-        covariates_dict['largest_PC_var'] = np.log(largest_PC_var(flu, self.pre))
+        covariates_dict['largest_PC_var'] = np.log(pre_covs['largest_PC_var'])
 
-        covariates_dict['n_PCs_90'] = number_PCs_percentage(flu, self.pre, perc=90)
-        covariates_dict['n_PCs_95'] = number_PCs_percentage(flu, self.pre, perc=95)
+        covariates_dict['n_PCs_90'] = pre_covs['n_PCs_90']
+        covariates_dict['n_PCs_95'] = pre_covs['n_PCs_95']
         # covariates_dict['largest_PC_var'] = largest_PC_var(flu, self.pre)
 
         covariates_dict['largest_factor_var'] = np.log(largest_factor_var(flu, self.pre))
@@ -691,11 +871,11 @@ class LinearModel():
             covariates_dict['trial_number_original'] = np.arange(*covariates_dict['mean_pre'].shape)
         assert len(covariates_dict['trial_number']) == len(covariates_dict['trial_number_original']), f'trial number lengths do not match: {len(covariates_dict["trial_number"])}, {len(covariates_dict["trial_number_original"])}'
 
-        covariates_dict['flattened_variance'] = flattened_variance(flu, self.pre)
-        covariates_dict['variance_pop_mean'] = variance_pop_mean(flu, self.pre)
-        covariates_dict['variance_cell_rates'] = np.log(variance_cell_rates(flu, self.pre))
-        covariates_dict['mean_cell_variance'] = mean_cell_variance(flu, self.pre)
-        covariates_dict['var_cell_variance'] = var_cell_variance(flu, self.pre)
+        covariates_dict['flattened_variance'] = pre_covs['flattened_variance']
+        covariates_dict['variance_pop_mean'] = pre_covs['variance_pop_mean']
+        covariates_dict['variance_cell_rates'] = np.log(pre_covs['variance_cell_rates'])
+        covariates_dict['mean_cell_variance'] = pre_covs['mean_cell_variance']
+        covariates_dict['var_cell_variance'] = pre_covs['var_cell_variance']
 
         if prereward is False:
             covariates_dict['reward_history'] = reward_history(self.session)[trial_bool]
@@ -710,7 +890,7 @@ class LinearModel():
             covariates_dict['reward'] = np.ones(len(trial_bool))
         
 
-        covariates_dict['jonas_metric'] = jonas_metric(flu, self.pre)
+        covariates_dict['jonas_metric'] = pre_covs['jonas_metric']
 
 
         # for key in ['ts_s1_pre', 'ts_s2_pre', 'ts_both_pre']:
@@ -1163,7 +1343,7 @@ class LinearModel():
         '''
 
         # Don't need the frame dimension here
-        is_target = self.session.is_target[:, :, 0]
+        is_target = self.session.get_is_target_2d()
         is_target = is_target[:, self.session.photostim == 1]
         self.n_times_targetted = np.sum(is_target, 1)
         self.ever_targetted = np.any(is_target, axis=1)
@@ -18,10 +18,12 @@ import math
 # from subsets_analysis import Subsets
 import pickle
 
+import joblib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import scipy.spatial
+import scipy.special
 import scipy.stats
 # from mpl_toolkits.mplot3d import Axes3D
 import seaborn as sns
@@ -170,6 +172,314 @@ def create_dict_pred(nl, train_proj, lt):
         dict_predictions_train['angle_decoders'] = np.array([])
     return dict_predictions_train, dict_predictions_test
 
+class PredictionTable:
+    """Preallocated columnar table of decoder results (used by train_test_all_sessions()).
+
+    All columns are allocated up front (the number of rows follows from the trial selection) 
+    and filled block by block with add_rows(), so results are not concatenated per fold. 
+    Prediction columns are stored per C value (see regularisation path in train_test_all_sessions()),
+    all other columns are shared. Besides the result columns, every row has the identifier columns 
+    in ID_COLUMNS (mouse, session, region, time, fold; fold is -1 for predictions averaged across folds).
+
+    Parameters
+    ----------
+    n_rows : int
+        number of rows
+    columns : list of str
+        names of result columns (in order)
+    prediction_columns : list of str
+        subset of columns that are predictions (one per C value)
+    C_path : list, default=[None]
+        C values
+    dtypes : dict, default={}
+        dtype per column (default float64)
+    """
+    ID_COLUMNS = ['mouse', 'session', 'region', 'time', 'fold']
+
+    def __init__(self, n_rows, columns, prediction_columns=[], C_path=[None], dtypes={}):
+        self.n_rows = int(n_rows)
+        self.n_filled = 0
+        self.column_names = list(columns)
+        self.prediction_columns = list(prediction_columns)
+        assert np.isin(self.prediction_columns, self.column_names).all()
+        dtypes = {**{'mouse': object, 'session': object, 'region': object, 'fold': int}, **dtypes}
+        self.columns = {name: np.zeros(self.n_rows, dtype=dtypes.get(name, np.float64))
+                        for name in self.ID_COLUMNS + self.column_names if name not in self.prediction_columns}
+        self.predictions = {C: {name: np.zeros(self.n_rows) for name in self.prediction_columns} for C in C_path}
+
+    def add_rows(self, n_rows, predictions={}, **values):
+        """Fill the next n_rows rows. values are arrays of length n_rows or scalars (per column name), 
+        predictions is a dict with C values as keys and dicts of prediction arrays as values."""
+        rows = slice(self.n_filled, self.n_filled + n_rows)
+        assert rows.stop <= self.n_rows, f'{rows.stop} rows exceed size of table ({self.n_rows})'
+        for name, value in values.items():
+            self.columns[name][rows] = value
+        for C, dict_pred in predictions.items():
+            for name, value in dict_pred.items():
+                self.predictions[C][name][rows] = value
+        self.n_filled = rows.stop
+        return rows
+
+    def unique(self, name):
+        """Unique values of column name (in order of appearance)."""
+        return pd.unique(self.columns[name][:self.n_filled])
+
+    def select_rows(self, **selection):
+        """Rows for which all columns match selection (eg mouse='RL070'). Returns a slice if these 
+        rows are contiguous (so that columns are returned as views), otherwise an index array."""
+        mask = np.ones(self.n_filled, dtype=bool)
+        for name, value in selection.items():
+            mask &= (self.columns[name][:self.n_filled] == value)
+        inds = np.where(mask)[0]
+        if len(inds) == 0 or inds[-1] - inds[0] + 1 == len(inds):
+            return slice(inds[0], inds[-1] + 1) if len(inds) > 0 else slice(0, 0)
+        return inds
+
+    def get_columns(self, C=None, include_ids=False, **selection):
+        """Dict of result columns (with predictions of C value C) of rows that match selection."""
+        if C is None:
+            C = list(self.predictions.keys())[0]
+        rows = self.select_rows(**selection)
+        names = (self.ID_COLUMNS if include_ids else []) + self.column_names
+        return {name: (self.predictions[C][name][rows] if name in self.prediction_columns 
+                       else self.columns[name][rows]) for name in names}
+
+    def to_dataframe(self, C=None, include_ids=True, **selection):
+        """pd.DataFrame of rows that match selection (by default with identifier columns, ie a tidy table)."""
+        return pd.DataFrame(self.get_columns(C=C, include_ids=include_ids, **selection))
+
+def get_decoder_list(list_tt_training):
+    """Return names of decoders that can be trained on list_tt_training. If trial types used for training 
+    are all of the same response type for either stim or dec, that decoder is not trained.
+
+    Parameters
+    ----------
+    list_tt_training : list
+        trial types used for training
+
+    Returns
+    -------
+    list_test : list
+        subset of ['dec', 'stim']
+    """
+    dict_response_matrix = {'hit': [1, 1], 'miss': [1, 0], 'fp': [0, 1], 'cr': [0, 0], 'spont': [0, 1]}
+    stim_response_list, dec_response_list = [], []
+    for tt in list_tt_training:
+        stim_response_list.append(dict_response_matrix[tt][0])
+        dec_response_list.append(dict_response_matrix[tt][1])
+    list_test = ['dec', 'stim']
+    if len(np.unique(stim_response_list)) < 2 and 'stim' in list_test:
+        list_test.remove('stim')
+    if len(np.unique(dec_response_list)) < 2 and 'dec' in list_test:
+        list_test.remove('dec')
+    return list_test
+
+def select_trials_session(session, list_tt_training=['hit', 'miss', 'fp', 'cr', 'spont'], include_150=False,
+                          include_autoreward=False, include_unrewardedhit=False, include_too_early=False,
+                          equalize_n_trials_per_tt=True, hard_set_10_trials=False, all_spont_lick_times=None,
+                          verbose=0):
+    """Select the trials of session that are used for training/testing decoders, and those used for
+    evaluation only (used in train_test_all_sessions()). If equalize_n_trials_per_tt, trials are randomly subsampled.
+
+    Parameters
+    ----------
+    session : Session
+        session to select trials from
+    list_tt_training : list
+        trial types used for training
+    include_150, include_autoreward, include_unrewardedhit, include_too_early : bool
+        whether to include these trials (see train_test_all_sessions())
+    equalize_n_trials_per_tt : bool, default=True
+        if True, subsample trials such that each trial type has the same number of trials
+    hard_set_10_trials : bool, default=False
+        if True (and equalize_n_trials_per_tt), use 10 trials per trial type
+    all_spont_lick_times : np.array or None
+        distribution of first lick times of reward only trials (required if equalize_n_trials_per_tt)
+    verbose : int, default=0
+        verbosiness
+
+    Returns
+    -------
+    trial_inds : np.array
+        inds of trials used for training & testing
+    eval_only_inds : np.array
+        inds of trials only used for testing (ARM, URH & trial types not in list_tt_training)
+    eval_only_labels : list
+        trial type labels of eval_only_inds
+    """
+    ## Set trial inds
+    ## trial_inds: used for training & testing
+    ## eval_only_inds: only used for testing (Auto Rew Miss; Un Rew Hit)
+    trial_inds = np.array([], dtype='int')
+    for tt in list_tt_training:
+        curr_tt_trials = np.where(session.outcome == tt)[0]
+        trial_inds = np.concatenate((trial_inds, curr_tt_trials))
+
+    if include_150 is False:
+        trial_inds = np.intersect1d(trial_inds, np.where(session.photostim < 2)[0])
+    else:
+        print('150 n_stim is Used!!')
+    if include_autoreward is False:
+        ar_exclude = np.where(session.autorewarded == False)[0]
+        if verbose == 2:
+            print(f'{np.sum(session.autorewarded)} autorewarded trials found and excluded')
+        trial_inds = np.intersect1d(trial_inds, ar_exclude)
+    else:
+        print('WARNING: ARM not excluded!')
+
+    if include_unrewardedhit is False:
+        uhr_excluded = np.where(session.unrewarded_hits == False)[0]
+        if verbose == 2:
+            print(f'{np.sum(session.unrewarded_hits)} unrewarded_hits found and excluded')
+        trial_inds = np.intersect1d(trial_inds, uhr_excluded)
+    else:
+        print('WARNING: URH not excluded!')
+
+    if include_too_early is False:
+        too_early_excl = np.where(session.outcome != 'too_')[0]
+        trial_inds = np.intersect1d(trial_inds, too_early_excl)
+    else:
+        print('WARNING: too early not excluded!')
+
+    if equalize_n_trials_per_tt:
+        # print('start', len(trial_inds))#, session.outcome[trial_inds])
+        dict_trials_per_tt = {x: np.where(session.outcome[trial_inds] == x)[0] for x in list_tt_training if x is not 'spont'}
+        dict_firstlick_per_tt = {x: session.first_lick[trial_inds][dict_trials_per_tt[x]] for x in list_tt_training if x is not 'spont'}
+        # dict_firstlick_per_tt['spont'] = session.first_lick_spont  # add manually
+
+        if 'spont' not in list_tt_training:
+            if hard_set_10_trials is False:
+                min_n_trials = np.min([len(v) for v in dict_trials_per_tt.values()])
+            elif hard_set_10_trials:
+                min_n_trials = 10  # use to control for n_trials of spont
+                # print('only using 10 trials per trial type!!')  # always give warning
+        elif 'spont' in list_tt_training and 'hit' in list_tt_training and len(list_tt_training) == 2:
+            min_n_trials = 10
+        else:
+            # assert 'spont' not in list_tt_training, 'if spont is used for training, this results in a slight bias towards no-PS'
+            min_n_trials = np.minimum(np.min([len(v) for v in dict_trials_per_tt.values()]), 10)
+            if min_n_trials != 10:
+                print(f'{min_n_trials} trials')
+        new_trial_inds = np.array([], dtype='int')
+        for tt, v in dict_trials_per_tt.items():  # loop through trial type + all corresponding trial inds
+            # new_trial_inds = np.concatenate((new_trial_inds, v[-min_n_trials:]))  # late trials subsampe (or early with :min_n_trials)
+            if tt == 'hit':
+                sample_according_to_spont_lick_time_distr = True
+            else:  # no need to match for CR etc
+                sample_according_to_spont_lick_time_distr = False
+
+            if sample_according_to_spont_lick_time_distr:
+                sorted_v, new_density_v = pop.subsample_lick_times(truth_lick_times=all_spont_lick_times,  # use distr across all mice to get better distr (because of low number of reward-only trials per recording, which can lead to large zero-density gaps in distr)
+                                                                    # truth_lick_times=dict_firstlick_per_tt['spont'],  # alternative; only use lick times of this recording
+                                                                    sampled_lick_times=dict_firstlick_per_tt[tt],
+                                                                    sampled_data=v, n_bins=5)
+                new_trial_inds = np.concatenate((new_trial_inds, np.random.choice(a=sorted_v, size=min_n_trials, replace=False, p=new_density_v)))  # random subsample of trials, using density of spont lick times
+            else:
+                new_trial_inds = np.concatenate((new_trial_inds, np.random.choice(a=v, size=min_n_trials, replace=False)))  # random subsample of trials
+        trial_inds = trial_inds[new_trial_inds]
+        # print('end', len(trial_inds))#, session.outcome[trial_inds])
+
+    ## set evaluation only indices
+    eval_only_inds = np.concatenate((np.where(session.autorewarded == True)[0],
+                                        np.where(session.unrewarded_hits == True)[0]))
+    eval_only_labels = ['arm'] * np.sum(session.autorewarded) + ['urh'] * np.sum(session.unrewarded_hits)
+    assert len(eval_only_inds) == np.sum(session.autorewarded) + np.sum(session.unrewarded_hits)
+
+    for tt in ['hit', 'miss', 'fp', 'cr']:
+        if tt not in list_tt_training:
+            eval_only_inds = np.concatenate((eval_only_inds, np.where(session.outcome == tt)[0]))
+            eval_only_labels = eval_only_labels + [tt] * len(np.where(session.outcome == tt)[0])
+    return trial_inds, eval_only_inds, eval_only_labels
+
+def get_trial_labels_session(session, trial_inds, n_spont_trials=0, spont_used_for_training=False,
+                             include_lick_times=False, list_save_covs=[]):
+    """Get labels of trials trial_inds of session (used in train_test_all_sessions()). If spont_used_for_training,
+    n_spont_trials reward only trials are appended.
+
+    Parameters
+    ----------
+    session : Session
+        session
+    trial_inds : np.array
+        selected trials (see select_trials_session())
+    n_spont_trials : int, default=0
+        number of reward only trials
+    spont_used_for_training : bool, default=False
+        whether reward only trials are appended to trial_inds
+    include_lick_times : bool, default=False
+        if True, also return first lick times
+    list_save_covs : list, default=[]
+        names of covariates (in session.cov_dict) to return
+
+    Returns
+    -------
+    dict_labels : dict
+        with keys 'outcome', 'stim', 'dec', 'n_stim', 'reward', 'autorewarded', 'unrewarded_hits',
+        'first_lick' (None if not include_lick_times), 'cov' and 'cov_reward_only'
+    """
+    first_lick = None
+    cov_dict, cov_dict_reward_only = {}, {}
+    trial_outcomes = session.outcome[trial_inds]
+    if spont_used_for_training:
+        trial_outcomes = np.concatenate((trial_outcomes, ['spont'] * n_spont_trials))
+        stim_trials = np.concatenate((session.photostim[trial_inds], np.zeros(n_spont_trials, dtype='int')))
+        dec_trials = np.concatenate((session.decision[trial_inds], np.ones(n_spont_trials, dtype='int')))
+        detailed_ps_labels = np.concatenate((session.trial_subsets[trial_inds].astype('int'), np.zeros(n_spont_trials, dtype='int')))
+        rewarded_trials = np.concatenate((np.array([x in ['hit', 'too_', 'arm'] for x in session.outcome[trial_inds]]), np.ones(n_spont_trials, dtype='int')))
+        autorewarded = np.concatenate((session.autorewarded[trial_inds], np.zeros(n_spont_trials, dtype='bool')))
+        rewarded_trials[autorewarded] = True
+        unrewarded_hits = np.concatenate((session.unrewarded_hits[trial_inds], np.zeros(n_spont_trials, dtype='bool')))
+        rewarded_trials[unrewarded_hits] = False
+        if include_lick_times:
+            first_lick = np.concatenate((session.first_lick[trial_inds], session.first_lick_spont))
+        if len(list_save_covs) > 0:
+            for name_cov in list_save_covs:
+                cov_dict[name_cov] = np.concatenate((session.cov_dict[name_cov][trial_inds], session.cov_dict_reward_only[name_cov]))
+    else:
+        stim_trials = session.photostim[trial_inds]
+        dec_trials = session.decision[trial_inds]
+        detailed_ps_labels = session.trial_subsets[trial_inds].astype('int')
+        rewarded_trials = np.array([x in ['hit', 'too_', 'arm'] for x in session.outcome[trial_inds]])
+        autorewarded = session.autorewarded[trial_inds]
+        rewarded_trials[autorewarded] = True
+        unrewarded_hits = session.unrewarded_hits[trial_inds]
+        rewarded_trials[unrewarded_hits] = False
+        if include_lick_times:
+            first_lick = session.first_lick[trial_inds]
+        if len(list_save_covs) > 0:
+            for name_cov in list_save_covs:
+                cov_dict[name_cov] = session.cov_dict[name_cov][trial_inds]
+                cov_dict_reward_only[name_cov] = session.cov_dict_reward_only[name_cov]
+
+    dict_labels = {'outcome': trial_outcomes, 'stim': stim_trials, 'dec': dec_trials,
+                   'n_stim': detailed_ps_labels, 'reward': rewarded_trials, 
+                   'autorewarded': autorewarded, 'unrewarded_hits': unrewarded_hits,
+                   'first_lick': first_lick, 'cov': cov_dict, 'cov_reward_only': cov_dict_reward_only}
+    return dict_labels
+
+def get_zscore_statistics(session, data_use_mat_norm, data_spont_mat_norm):
+    """Mean and std per neuron and frame (n_neurons x n_frames) across all behaviour and spont trials 
+    of the normalised tensors of session (see pop.normalise_raster_data()), used to z-score data in 
+    train_test_all_sessions(). NaNs are ignored and std = 0 is set to 1 (as sklearn's StandardScaler).
+
+    The statistics are stored in session._zscore_stats_cache, and only recomputed if other tensors are
+    passed (eg after the normalised raster cache was reset), so every time point or time window of a 
+    session is standardised by broadcasting the same statistics.
+    """
+    cache = getattr(session, '_zscore_stats_cache', None)
+    if cache is not None and cache[0] is data_use_mat_norm and cache[1] is data_spont_mat_norm:
+        return cache[2], cache[3]
+    n_values = np.sum(~np.isnan(data_use_mat_norm), 1) + np.sum(~np.isnan(data_spont_mat_norm), 1)
+    zscore_mean = (np.nansum(data_use_mat_norm, 1) + np.nansum(data_spont_mat_norm, 1)) / n_values
+    zscore_var = (np.nansum((data_use_mat_norm - zscore_mean[:, np.newaxis, :]) ** 2, 1) + 
+                  np.nansum((data_spont_mat_norm - zscore_mean[:, np.newaxis, :]) ** 2, 1)) / n_values
+    zscore_std = np.sqrt(zscore_var)
+    zscore_std[zscore_std == 0] = 1
+    zscore_mean = zscore_mean.astype(data_use_mat_norm.dtype)  # (n_values is int, so keep session dtype, see Session.set_dtype())
+    zscore_std = zscore_std.astype(data_use_mat_norm.dtype)
+    session._zscore_stats_cache = (data_use_mat_norm, data_spont_mat_norm, zscore_mean, zscore_std)
+    return zscore_mean, zscore_std
+
 def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test=['dec', 'stim'],
                             list_tt_training=['hit', 'miss', 'fp', 'cr', 'spont'], include_150=False,
                             return_decoder_weights=False, zscore_data=False,
@@ -178,7 +488,7 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
                             C_value=0.2, reg_type='l2', train_projected=False, proj_dir='different',
                             concatenate_sessions_per_mouse=True, hard_set_10_trials=False,
                             list_save_covs=[], equalize_n_trials_per_tt=True,
-                            include_lick_times=False):
+                            include_lick_times=False, return_table=False):
     """Major function that trains the decoders. It trains the decoders specified in
     list_test, for the time trial_times_use, for all sessions in sessions. The trials
     are folded n_split times (stratified over session.outcome), new decoders
@@ -199,20 +509,28 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
         if true, include n_PS=150 trials
     return_decoder_weights : bool, default=False
         if True, also return decoder weights
+    zscore_data : bool, default=False
+        if True, z-score data per neuron and frame, with the mean & std of all trials of the session
+        (see get_zscore_statistics())
     n_split : int, default=4
         number of data Folds
     include_autoreward : bool, default=True
         if True, include autoreward trials
     neurons_selection : str:, default='all'
         which neurons to include. possibilities: 'all', 's1', 's2'
-    C_value : float, default=0.2
+    C_value : float or np.array, default=0.2
         regularisation value (if reg_type is an adeqaute regulariser type for sklearn.linear_model.LogisticRegression)
+        If an array of C values, the full regularisation path is fitted per fold (warm-started from the previous C, in
+        increasing order of C), and all outputs are dicts keyed by C.
     reg_type : str, default='l2'
         regulariser type, possibilities: 'l2', 'l1', 'none' (and elastic net I think)
     train_projected : bool, default=False
         if True, also evaluate decoders on projected data
     proj_dir : str. default'different
         if train_projected is True, specifies on which axis to project. possibilities: 'different' or 'same'
+    return_table : bool, default=False
+        if True, return the PredictionTable of train and test results (of all mice and C values, with 
+        mouse/session/region/time/fold columns) instead of dicts of pd.DataFrames per mouse
 
     Returns
     -------
@@ -223,6 +541,7 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
     if return_decoder_weights:
         dec_weights: dict
             weights of all decoders
+    (if C_value is an array, df_prediction_train, df_prediction_test and dec_weights are dicts with C values as keys)
 
     """
     if train_projected:
@@ -236,16 +555,14 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
         print('WARNING: only using 10 trials per trial type!!')
 
     ## If trial types used for training are all of the same response type for either stim or dec, do not train that decoder
-    dict_response_matrix = {'hit': [1, 1], 'miss': [1, 0], 'fp': [0, 1], 'cr': [0, 0], 'spont': [0, 1]}
-    stim_response_list, dec_response_list = [], []
-    for tt in list_tt_training:
-        stim_response_list.append(dict_response_matrix[tt][0])
-        dec_response_list.append(dict_response_matrix[tt][1])
-    list_test = ['dec', 'stim']
-    if len(np.unique(stim_response_list)) < 2 and 'stim' in list_test:
-        list_test.remove('stim')
-    if len(np.unique(dec_response_list)) < 2 and 'dec' in list_test:
-        list_test.remove('dec')
+    list_test = get_decoder_list(list_tt_training=list_tt_training)
+
+    ## Regularisation path: fit C values in increasing order (from strong to weak regularisation), warm-starting from previous C
+    C_path = np.atleast_1d(C_value)
+    use_C_path = np.ndim(C_value) > 0
+    if use_C_path:
+        assert train_projected is False, 'regularisation path not implemented for projected data'
+        C_path = np.sort(C_path)
  
     name_list = ['autorewarded_miss', 'unrewarded_hit', 'outcome']  # names of details to save - whether autorewrd trial or not
     for nn in list_test:
@@ -257,9 +574,8 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
         for name_cov in list_save_covs:
             name_list.append(name_cov)
 
-    df_prediction_train, df_prediction_test = dict(), dict()
     if return_decoder_weights:
-        dec_weights = {xx: {} for xx in list_test}
+        dec_weights = {C: {xx: {} for xx in list_test} for C in C_path}
     
     if concatenate_sessions_per_mouse:
         mouse_list = np.unique([ss.mouse for _, ss in sessions.items()])
@@ -274,18 +590,14 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
             all_spont_lick_times = np.concatenate((all_spont_lick_times, ss.first_lick_spont))
         assert len(all_spont_lick_times) == (len(sessions) * 10)
     
-    angle_decoders = np.zeros((len(sessions), n_split))
+    ## Select trials & prepare data of all sessions first, so that the result tables can be allocated up front:
+    list_session_data = []
     for mouse in mouse_list:
-        dict_predictions_train, dict_predictions_test = create_dict_pred(nl=name_list, train_proj=train_projected, lt=list_test)
-        if include_lick_times:
-            dict_predictions_train['first_lick_train'] = np.array([])
-            dict_predictions_test['first_lick_test'] = np.array([])
-        dict_predictions_test['used_for_training'] = np.array([])
         if concatenate_sessions_per_mouse:  # get sessions that correspond to this mouse identity 
             curr_sessions = {i_session: session for i_session, session in sessions.items() if session.mouse == mouse}
         else:  # get the one session that corresponds to this session signature (called mouse_list for historical reasons)
             curr_sessions = {i_session: session for i_session, session in sessions.items() if session.signature == mouse}
-        for i_session, session in curr_sessions.items():  # loop through sessions/runs and concatenate results (in dicts)
+        for i_session, session in curr_sessions.items():  # loop through sessions/runs and concatenate results (in tables)
             
             # if session.mouse == mouse:
             if concatenate_sessions_per_mouse:
@@ -320,86 +632,11 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
             ## Set trial inds
             ## trial_inds: used for training & testing
             ## eval_only_inds: only used for testing (Auto Rew Miss; Un Rew Hit)
-            trial_inds = np.array([], dtype='int')
-            for tt in list_tt_training:
-                curr_tt_trials = np.where(session.outcome == tt)[0]
-                trial_inds = np.concatenate((trial_inds, curr_tt_trials))
-
-            if include_150 is False:
-                trial_inds = np.intersect1d(trial_inds, np.where(session.photostim < 2)[0])
-            else:
-                print('150 n_stim is Used!!')
-            if include_autoreward is False:
-                ar_exclude = np.where(session.autorewarded == False)[0]
-                if verbose == 2:
-                    print(f'{np.sum(session.autorewarded)} autorewarded trials found and excluded')
-                trial_inds = np.intersect1d(trial_inds, ar_exclude)
-            else:
-                print('WARNING: ARM not excluded!')
-
-            if include_unrewardedhit is False:
-                uhr_excluded = np.where(session.unrewarded_hits == False)[0]
-                if verbose == 2:
-                    print(f'{np.sum(session.unrewarded_hits)} unrewarded_hits found and excluded')
-                trial_inds = np.intersect1d(trial_inds, uhr_excluded)
-            else:
-                print('WARNING: URH not excluded!')
-
-            if include_too_early is False:
-                too_early_excl = np.where(session.outcome != 'too_')[0]
-                trial_inds = np.intersect1d(trial_inds, too_early_excl)
-            else:
-                print('WARNING: too early not excluded!')
-
-            if equalize_n_trials_per_tt:
-                # print('start', len(trial_inds))#, session.outcome[trial_inds])
-                dict_trials_per_tt = {x: np.where(session.outcome[trial_inds] == x)[0] for x in list_tt_training if x is not 'spont'}
-                dict_firstlick_per_tt = {x: session.first_lick[trial_inds][dict_trials_per_tt[x]] for x in list_tt_training if x is not 'spont'}
-                # dict_firstlick_per_tt['spont'] = session.first_lick_spont  # add manually
-
-                if 'spont' not in list_tt_training:
-                    if hard_set_10_trials is False:
-                        min_n_trials = np.min([len(v) for v in dict_trials_per_tt.values()])
-                    elif hard_set_10_trials:
-                        min_n_trials = 10  # use to control for n_trials of spont
-                        # print('only using 10 trials per trial type!!')  # always give warning
-                elif 'spont' in list_tt_training and 'hit' in list_tt_training and len(list_tt_training) == 2:
-                    min_n_trials = 10
-                else:
-                    # assert 'spont' not in list_tt_training, 'if spont is used for training, this results in a slight bias towards no-PS'
-                    min_n_trials = np.minimum(np.min([len(v) for v in dict_trials_per_tt.values()]), 10)
-                    if min_n_trials != 10:
-                        print(f'{min_n_trials} trials')
-                new_trial_inds = np.array([], dtype='int')
-                for tt, v in dict_trials_per_tt.items():  # loop through trial type + all corresponding trial inds
-                    # new_trial_inds = np.concatenate((new_trial_inds, v[-min_n_trials:]))  # late trials subsampe (or early with :min_n_trials)
-                    if tt == 'hit':
-                        sample_according_to_spont_lick_time_distr = True
-                    else:  # no need to match for CR etc
-                        sample_according_to_spont_lick_time_distr = False
-
-                    if sample_according_to_spont_lick_time_distr:
-                        sorted_v, new_density_v = pop.subsample_lick_times(truth_lick_times=all_spont_lick_times,  # use distr across all mice to get better distr (because of low number of reward-only trials per recording, which can lead to large zero-density gaps in distr)
-                                                                            # truth_lick_times=dict_firstlick_per_tt['spont'],  # alternative; only use lick times of this recording
-                                                                            sampled_lick_times=dict_firstlick_per_tt[tt],
-                                                                            sampled_data=v, n_bins=5)
-                        new_trial_inds = np.concatenate((new_trial_inds, np.random.choice(a=sorted_v, size=min_n_trials, replace=False, p=new_density_v)))  # random subsample of trials, using density of spont lick times
-                    else:
-                        new_trial_inds = np.concatenate((new_trial_inds, np.random.choice(a=v, size=min_n_trials, replace=False)))  # random subsample of trials
-                trial_inds = trial_inds[new_trial_inds]
-                # print('end', len(trial_inds))#, session.outcome[trial_inds])
-            
-            ## set evaluation only indices
-            eval_only_inds = np.concatenate((np.where(session.autorewarded == True)[0],
-                                                np.where(session.unrewarded_hits == True)[0]))
-            eval_only_labels = ['arm'] * np.sum(session.autorewarded) + ['urh'] * np.sum(session.unrewarded_hits)
-            assert len(eval_only_inds) == np.sum(session.autorewarded) + np.sum(session.unrewarded_hits)
-
-            for tt in ['hit', 'miss', 'fp', 'cr']:
-                if tt not in list_tt_training:
-                    eval_only_inds = np.concatenate((eval_only_inds, np.where(session.outcome == tt)[0]))
-                    eval_only_labels = eval_only_labels + [tt] * len(np.where(session.outcome == tt)[0])
-            trial_outcomes = session.outcome[trial_inds]
+            trial_inds, eval_only_inds, eval_only_labels = select_trials_session(session=session, list_tt_training=list_tt_training, include_150=include_150,
+                                                                                 include_autoreward=include_autoreward, include_unrewardedhit=include_unrewardedhit,
+                                                                                 include_too_early=include_too_early, equalize_n_trials_per_tt=equalize_n_trials_per_tt,
+                                                                                 hard_set_10_trials=hard_set_10_trials, all_spont_lick_times=all_spont_lick_times if equalize_n_trials_per_tt else None,
+                                                                                 verbose=verbose)
 
             ## Prepare data with selections
 
@@ -428,232 +665,233 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
             if n_spont_trials == 0:
                 print('NO SPONT TRIALS in ', session)
 
-            cov_dict = {}
+            ## Z-score per neuron & frame, using statistics of all trials of the session (computed once per session)
+            if zscore_data:
+                zscore_mean, zscore_std = get_zscore_statistics(session=session, data_use_mat_norm=data_use_mat_norm,
+                                                                data_spont_mat_norm=data_spont_mat_norm)
+                zscore_mean = zscore_mean[neurons_include, :][:, np.newaxis, trial_frames_use]
+                zscore_std = zscore_std[neurons_include, :][:, np.newaxis, trial_frames_use]
+                data_use = (data_use - zscore_mean) / zscore_std
+                data_eval = (data_eval - zscore_mean) / zscore_std
+                data_spont = (data_spont - zscore_mean) / zscore_std
+
+            dict_labels = get_trial_labels_session(session=session, trial_inds=trial_inds, n_spont_trials=n_spont_trials,
+                                                   spont_used_for_training=spont_used_for_training,
+                                                   include_lick_times=include_lick_times, list_save_covs=list_save_covs)
             if spont_used_for_training:
                 data_use = np.hstack((data_use, data_spont))
-                trial_outcomes = np.concatenate((trial_outcomes, ['spont'] * n_spont_trials))
-                stim_trials = np.concatenate((session.photostim[trial_inds], np.zeros(n_spont_trials, dtype='int')))
-                dec_trials = np.concatenate((session.decision[trial_inds], np.ones(n_spont_trials, dtype='int')))
-                detailed_ps_labels = np.concatenate((session.trial_subsets[trial_inds].astype('int'), np.zeros(n_spont_trials, dtype='int')))
-                rewarded_trials = np.concatenate((np.array([x in ['hit', 'too_', 'arm'] for x in session.outcome[trial_inds]]), np.ones(n_spont_trials, dtype='int')))
-                autorewarded = np.concatenate((session.autorewarded[trial_inds], np.zeros(n_spont_trials, dtype='bool')))
-                rewarded_trials[autorewarded] = True
-                unrewarded_hits = np.concatenate((session.unrewarded_hits[trial_inds], np.zeros(n_spont_trials, dtype='bool')))
-                rewarded_trials[unrewarded_hits] = False
-                if include_lick_times:
-                    first_lick = np.concatenate((session.first_lick[trial_inds], session.first_lick_spont))
-                if len(list_save_covs) > 0:
-                    for name_cov in list_save_covs:
-                        cov_dict[name_cov] = np.concatenate((session.cov_dict[name_cov][trial_inds], session.cov_dict_reward_only[name_cov]))
-            else:
-                cov_dict_reward_only = {}
-                stim_trials = session.photostim[trial_inds]
-                dec_trials = session.decision[trial_inds]
-                detailed_ps_labels = session.trial_subsets[trial_inds].astype('int')
-                rewarded_trials = np.array([x in ['hit', 'too_', 'arm'] for x in session.outcome[trial_inds]])
-                autorewarded = session.autorewarded[trial_inds]
-                rewarded_trials[autorewarded] = True
-                unrewarded_hits = session.unrewarded_hits[trial_inds]
-                rewarded_trials[unrewarded_hits] = False
-                if include_lick_times:
-                    first_lick = session.first_lick[trial_inds]
-                if len(list_save_covs) > 0:
-                    for name_cov in list_save_covs:
-                        cov_dict[name_cov] = session.cov_dict[name_cov][trial_inds]
-                        cov_dict_reward_only[name_cov] = session.cov_dict_reward_only[name_cov]
 
-            assert len(trial_outcomes) == data_use.shape[1]
+            assert len(dict_labels['outcome']) == data_use.shape[1]
             ## Squeeze time frames
             data_use = fun_return_2d(data_use)
             data_eval = fun_return_2d(data_eval)
             data_spont = fun_return_2d(data_spont)
 
-            ## Stack & fit scaler
-            if zscore_data:
-                assert False, 'z score is used'
-                if spont_used_for_training:
-                    data_stacked = np.hstack((data_use, data_eval))  # stack for scaling (spont already included)
-                    assert (data_stacked[:, (len(trial_inds) + n_spont_trials):(len(trial_inds) + len(eval_only_inds) + n_spont_trials)] == data_eval).all()
-                else:
-                    data_stacked = np.hstack((data_use, data_eval, data_spont))  # stack for scaling
-                    assert (data_stacked[:, len(trial_inds):(len(trial_inds) + len(eval_only_inds))] == data_eval).all()
-                stand_scale = sklearn.preprocessing.StandardScaler().fit(data_stacked.T) # use all data to fit scaler, then scale indiviudally
-                ## Scale
-                data_use = stand_scale.transform(data_use.T)
-                data_eval = stand_scale.transform(data_eval.T)
-                data_spont = stand_scale.transform(data_spont.T)
-                data_use = data_use.T
-                data_eval = data_eval.T
-                data_spont = data_spont.T
-
-            sss = sklearn.model_selection.StratifiedKFold(n_splits=n_split)  # split into n_split data folds of trials (strat shuffle split is not appropriate generally because it changes the test set)
-            if verbose == 2:
-                if np.abs(trial_times_use[0] + 3) < 0.1:
-                    print(f'Number of licks: {np.sum(session.decision[trial_inds])}')
-                    dict_outcomes = {x: np.sum(trial_outcomes == x) for x in np.unique(trial_outcomes)}
-                    print(f'Possible trial outcomes: {dict_outcomes}')
-                    dict_n_ps = {x: np.sum(session.trial_subsets[trial_inds] == x) for x in np.unique(session.trial_subsets[trial_inds])}
-                    print(f'Possible stimulations: {dict_n_ps}')
-
-            i_loop = 0
-            if return_decoder_weights:
+            list_session_data.append({'mouse': mouse, 'i_session': i_session, 'session': session, 
+                                      'neurons_include': neurons_include, 'trial_inds': trial_inds, 
+                                      'eval_only_inds': eval_only_inds, 'eval_only_labels': eval_only_labels,
+                                      'n_spont_trials': n_spont_trials, 'dict_labels': dict_labels,
+                                      'data_use': data_use, 'data_eval': data_eval, 'data_spont': data_spont})
+
+    ## Allocate result tables (every trial is in the train set of n_split - 1 folds and in the test set of 1 fold):
+    n_rows_train = np.sum([sd['data_use'].shape[1] * (n_split - 1) for sd in list_session_data])
+    n_rows_test = np.sum([sd['data_use'].shape[1] + len(sd['eval_only_inds']) + 
+                          (sd['n_spont_trials'] if spont_used_for_training is False else 0) for sd in list_session_data])
+    dict_columns_train, dict_columns_test = create_dict_pred(nl=name_list, train_proj=train_projected, lt=list_test)
+    if include_lick_times:
+        dict_columns_train['first_lick_train'] = None
+        dict_columns_test['first_lick_test'] = None
+    dict_columns_test['used_for_training'] = None
+    first_lick_dtype = np.float64
+    if include_lick_times:  # object if there are None values
+        first_lick_dtype = np.result_type(np.float64, *[sd['session'].first_lick.dtype for sd in list_session_data])
+    dtypes = {'outcome_train': object, 'outcome_test': object, 'first_lick_train': first_lick_dtype, 'first_lick_test': first_lick_dtype}
+    table_train = PredictionTable(n_rows=n_rows_train, columns=dict_columns_train.keys(), dtypes=dtypes, C_path=C_path,
+                                  prediction_columns=[x for x in dict_columns_train.keys() if x.startswith('pred_')])
+    table_test = PredictionTable(n_rows=n_rows_test, columns=dict_columns_test.keys(), dtypes=dtypes, C_path=C_path,
+                                 prediction_columns=[x for x in dict_columns_test.keys() if x.startswith('pred_')])
+    time_use = np.mean(trial_times_use) if trial_times_use is not None else np.nan
+
+    ## Train & test decoders:
+    angle_decoders = np.zeros((len(sessions), n_split))
+    for sd in list_session_data:
+        mouse, i_session, session = sd['mouse'], sd['i_session'], sd['session']
+        neurons_include, trial_inds, eval_only_inds, eval_only_labels = sd['neurons_include'], sd['trial_inds'], sd['eval_only_inds'], sd['eval_only_labels']
+        data_use, data_eval, data_spont, n_spont_trials, dict_labels = sd['data_use'], sd['data_eval'], sd['data_spont'], sd['n_spont_trials'], sd['dict_labels']
+        trial_outcomes, stim_trials, dec_trials = dict_labels['outcome'], dict_labels['stim'], dict_labels['dec']
+        detailed_ps_labels, rewarded_trials = dict_labels['n_stim'], dict_labels['reward']
+        autorewarded, unrewarded_hits = dict_labels['autorewarded'], dict_labels['unrewarded_hits']
+        first_lick, cov_dict, cov_dict_reward_only = dict_labels['first_lick'], dict_labels['cov'], dict_labels['cov_reward_only']
+        ids = {'mouse': mouse, 'session': session.signature, 'region': neurons_selection, 'time': time_use}
+
+        sss = sklearn.model_selection.StratifiedKFold(n_splits=n_split)  # split into n_split data folds of trials (strat shuffle split is not appropriate generally because it changes the test set)
+        if verbose == 2:
+            if np.abs(trial_times_use[0] + 3) < 0.1:
+                print(f'Number of licks: {np.sum(session.decision[trial_inds])}')
+                dict_outcomes = {x: np.sum(trial_outcomes == x) for x in np.unique(trial_outcomes)}
+                print(f'Possible trial outcomes: {dict_outcomes}')
+                dict_n_ps = {x: np.sum(session.trial_subsets[trial_inds] == x) for x in np.unique(session.trial_subsets[trial_inds])}
+                print(f'Possible stimulations: {dict_n_ps}')
+
+        i_loop = 0
+        if return_decoder_weights:
+            for C in C_path:
                 for x in list_test:
-                    dec_weights[x][session.signature] = np.zeros((n_split, len(neurons_include)))
+                    dec_weights[C][x][session.signature] = np.zeros((n_split, len(neurons_include)))
 
-            n_trials = data_use.shape[1]
-            if verbose == 2:
-                print(f'Total number of trials is {n_trials}. Number of splits is {n_split}')
-
-            pred_proba_eval = {x: {} for x in range(n_split)} # dict per cv loop, average later.
-            pred_proba_spont = {x: {} for x in range(n_split)}
-            for train_inds, test_inds in sss.split(X=np.zeros(n_trials), y=trial_outcomes):  # loop through different train/test folds, concat results
-                train_data, test_data = data_use[:, train_inds], data_use[:, test_inds]
-                if i_loop == 0:
-                    if verbose == 2:
-                        print(f'Shape train data {train_data.shape}, test data {test_data.shape}')
-
-                ## Get labels and categories of trials
-                train_labels = {'stim': stim_trials[train_inds],
-                                'dec': dec_trials[train_inds]}
-                test_labels = {'stim': stim_trials[test_inds],
-                                'dec': dec_trials[test_inds]}
+        n_trials = data_use.shape[1]
+        if verbose == 2:
+            print(f'Total number of trials is {n_trials}. Number of splits is {n_split}')
+
+        pred_proba_eval = {C: {x: {} for x in range(n_split)} for C in C_path} # dict per cv loop, average later.
+        pred_proba_spont = {C: {x: {} for x in range(n_split)} for C in C_path}
+        for train_inds, test_inds in sss.split(X=np.zeros(n_trials), y=trial_outcomes):  # loop through different train/test folds, concat results
+            train_data, test_data = data_use[:, train_inds], data_use[:, test_inds]
+            if i_loop == 0:
                 if verbose == 2:
-                    print(f' Number of test licks {np.sum(test_labels["dec"])}')
-                assert len(train_labels['dec']) == train_data.shape[1]
-                assert len(test_labels['stim']) == test_data.shape[1]
+                    print(f'Shape train data {train_data.shape}, test data {test_data.shape}')
 
-                ## Train logistic regression model on train data
-                dec = {}
-                for x in list_test:
-                    assert len(np.unique(train_labels[x])) == 2 , f'{x} training will be perfect'
-                    assert len(np.unique(test_labels[x])) == 2, 'not stricitly necessary, could be loosened'
-                    # cw_dict = {ww: np.sum(train_labels[x] == ww) / len(train_labels[x]) for ww in [0, 1]}
-                    dec[x] = sklearn.linear_model.LogisticRegression(penalty=reg_type, C=C_value, class_weight='balanced').fit(
-                                    X=train_data.transpose(), y=train_labels[x])
+            ## Get labels and categories of trials
+            train_labels = {'stim': stim_trials[train_inds],
+                            'dec': dec_trials[train_inds]}
+            test_labels = {'stim': stim_trials[test_inds],
+                            'dec': dec_trials[test_inds]}
+            if verbose == 2:
+                print(f' Number of test licks {np.sum(test_labels["dec"])}')
+            assert len(train_labels['dec']) == train_data.shape[1]
+            assert len(test_labels['stim']) == test_data.shape[1]
+
+            ## Train logistic regression model on train data (for each C value) & predict
+            dec = {}
+            pred_proba_train, pred_proba_test = {C: {} for C in C_path}, {C: {} for C in C_path}
+            for x in list_test:
+                assert len(np.unique(train_labels[x])) == 2 , f'{x} training will be perfect'
+                assert len(np.unique(test_labels[x])) == 2, 'not stricitly necessary, could be loosened'
+                # cw_dict = {ww: np.sum(train_labels[x] == ww) / len(train_labels[x]) for ww in [0, 1]}
+                dec[x] = sklearn.linear_model.LogisticRegression(penalty=reg_type, C=C_path[0], class_weight='balanced',
+                                                                 warm_start=use_C_path)
+                for C in C_path:  # warm start: each fit starts from solution of previous C
+                    dec[x].set_params(C=C).fit(X=train_data.transpose(), y=train_labels[x])
                     # print(train_labels[x])
                     if return_decoder_weights:
-                        dec_weights[x][session.signature][i_loop, :] = dec[x].coef_.copy()
-
-                if len(list_test) == 2:
-                    angle_decoders[i_session, i_loop] = None #angle_vecs(dec[list_test[0]].coef_, dec[list_test[1]].coef_)
-
-                if train_projected:  # project and re decode
-                    assert False, 'proj not implemented'
-                    dec_proj = {}
-                    assert len(list_test) == 2  # hard coded that len==2 further on
-                    for i_x, x in enumerate(list_test):
-                        i_y = 1 - i_x
-                        y = list_test[i_y]
-                        assert x != y
-                        if proj_dir == 'same':
-                            enc_vector = dec[x].coef_ / np.linalg.norm(dec[x].coef_)
-                        elif proj_dir == 'different':
-                            enc_vector = dec[y].coef_ / np.linalg.norm(dec[y].coef_)
-                        train_data_proj = enc_vector.copy() * train_data.transpose()
-                        test_data_proj = enc_vector.copy() * test_data.transpose()
-                        dec_proj[x] = sklearn.linear_model.LogisticRegression(penalty=reg_type, C=C_value, class_weight='balanced').fit(
-                                        X=train_data_proj, y=train_labels[x])
-                        
-                ## Predict test data
-                pred_proba_train = {x: dec[x].predict_proba(X=train_data.transpose())[:, 1] for x in list_test}
-                pred_proba_test = {x: dec[x].predict_proba(X=test_data.transpose())[:, 1] for x in list_test}
-                pred_proba_eval[i_loop] = {x: dec[x].predict_proba(X=data_eval.transpose())[:, 1] for x in list_test}
-                pred_proba_spont[i_loop] = {x: dec[x].predict_proba(X=data_spont.transpose())[:, 1] for x in list_test}
-
-                if train_projected:
-                    pred_proba_train_proj = {x: dec_proj[x].predict_proba(X=train_data_proj)[:, 1] for x in list_test}
-                    pred_proba_test_proj = {x: dec_proj[x].predict_proba(X=test_data_proj)[:, 1] for x in list_test}
-
-                ## Save results
+                        dec_weights[C][x][session.signature][i_loop, :] = dec[x].coef_.copy()
+                    pred_proba_train[C][x] = dec[x].predict_proba(X=train_data.transpose())[:, 1]
+                    pred_proba_test[C][x] = dec[x].predict_proba(X=test_data.transpose())[:, 1]
+                    pred_proba_eval[C][i_loop][x] = dec[x].predict_proba(X=data_eval.transpose())[:, 1]
+                    pred_proba_spont[C][i_loop][x] = dec[x].predict_proba(X=data_spont.transpose())[:, 1]
+
+            if len(list_test) == 2:
+                angle_decoders[i_session, i_loop] = None #angle_vecs(dec[list_test[0]].coef_, dec[list_test[1]].coef_)
+
+            if train_projected:  # project and re decode
+                assert False, 'proj not implemented'
+                dec_proj = {}
+                assert len(list_test) == 2  # hard coded that len==2 further on
+                for i_x, x in enumerate(list_test):
+                    i_y = 1 - i_x
+                    y = list_test[i_y]
+                    assert x != y
+                    if proj_dir == 'same':
+                        enc_vector = dec[x].coef_ / np.linalg.norm(dec[x].coef_)
+                    elif proj_dir == 'different':
+                        enc_vector = dec[y].coef_ / np.linalg.norm(dec[y].coef_)
+                    train_data_proj = enc_vector.copy() * train_data.transpose()
+                    test_data_proj = enc_vector.copy() * test_data.transpose()
+                    dec_proj[x] = sklearn.linear_model.LogisticRegression(penalty=reg_type, C=C_value, class_weight='balanced').fit(
+                                    X=train_data_proj, y=train_labels[x])
+                    
+            ## Save results
+            predictions_train = {C: {f'pred_{x}_train': pred_proba_train[C][x] for x in list_test} for C in C_path}
+            predictions_test = {C: {f'pred_{x}_test': pred_proba_test[C][x] for x in list_test} for C in C_path}
+            if train_projected:
                 for x in list_test:
-                    dict_predictions_train[f'pred_{x}_train'] = np.concatenate((dict_predictions_train[f'pred_{x}_train'], pred_proba_train[x]))
-                    dict_predictions_test[f'pred_{x}_test'] = np.concatenate((dict_predictions_test[f'pred_{x}_test'], pred_proba_test[x]))
-                    if train_projected:
-                        dict_predictions_train[f'pred_{x}_train_proj'] = np.concatenate((dict_predictions_train[f'pred_{x}_train_proj'], pred_proba_train_proj[x]))
-                        dict_predictions_test[f'pred_{x}_test_proj'] = np.concatenate((dict_predictions_test[f'pred_{x}_test_proj'], pred_proba_test_proj[x]))
-                if len(list_test) == 2:
-                    dict_predictions_train['angle_decoders'] = np.concatenate((dict_predictions_train['angle_decoders'], np.zeros_like(pred_proba_train[x]) + angle_decoders[i_session, i_loop]))
-                dict_predictions_train['true_stim_train'] = np.concatenate((dict_predictions_train['true_stim_train'], detailed_ps_labels[train_inds]))
-                dict_predictions_test['true_stim_test'] = np.concatenate((dict_predictions_test['true_stim_test'], detailed_ps_labels[test_inds]))
-                dict_predictions_train['true_reward_train'] = np.concatenate((dict_predictions_train['true_reward_train'], rewarded_trials[train_inds]))
-                dict_predictions_test['true_reward_test'] = np.concatenate((dict_predictions_test['true_reward_test'], rewarded_trials[test_inds]))
-                dict_predictions_train['outcome_train'] = np.concatenate((dict_predictions_train['outcome_train'], trial_outcomes[train_inds]))
-                dict_predictions_test['outcome_test'] = np.concatenate((dict_predictions_test['outcome_test'], trial_outcomes[test_inds]))
-                dict_predictions_train['autorewarded_miss_train'] = np.concatenate((dict_predictions_train['autorewarded_miss_train'], autorewarded[train_inds]))
-                dict_predictions_test['autorewarded_miss_test'] = np.concatenate((dict_predictions_test['autorewarded_miss_test'], autorewarded[test_inds]))
-                dict_predictions_train['unrewarded_hit_train'] = np.concatenate((dict_predictions_train['unrewarded_hit_train'], unrewarded_hits[train_inds]))
-                dict_predictions_test['unrewarded_hit_test'] = np.concatenate((dict_predictions_test['unrewarded_hit_test'], unrewarded_hits[test_inds]))
-                dict_predictions_train['true_dec_train'] = np.concatenate((dict_predictions_train['true_dec_train'], train_labels['dec']))
-                dict_predictions_test['true_dec_test'] = np.concatenate((dict_predictions_test['true_dec_test'], test_labels['dec']))
-                if include_lick_times:
-                    dict_predictions_train['first_lick_train'] = np.concatenate((dict_predictions_train['first_lick_train'], first_lick[train_inds]))
-                    dict_predictions_test['first_lick_test'] = np.concatenate((dict_predictions_test['first_lick_test'], first_lick[test_inds]))
-                dict_predictions_test['used_for_training'] = np.concatenate((dict_predictions_test['used_for_training'], np.ones(len(test_inds))))
-                if len(list_save_covs) > 0:
-                    for name_cov in list_save_covs:
-                        dict_predictions_train[name_cov + '_train'] = np.concatenate((dict_predictions_train[name_cov + '_train'], cov_dict[name_cov][train_inds]))
-                        dict_predictions_test[name_cov + '_test'] = np.concatenate((dict_predictions_test[name_cov + '_test'], cov_dict[name_cov][test_inds]))
-                i_loop += 1
-
-            ## Add results of eval_only trials (average of decoder CVs):
-
-            ## eval onlY:
-            assert (np.array(list(pred_proba_eval.keys())) == np.arange(n_split)).all()
+                    predictions_train[C_path[0]][f'pred_{x}_train_proj'] = dec_proj[x].predict_proba(X=train_data_proj)[:, 1]
+                    predictions_test[C_path[0]][f'pred_{x}_test_proj'] = dec_proj[x].predict_proba(X=test_data_proj)[:, 1]
+            values_train = {'true_stim_train': detailed_ps_labels[train_inds], 'true_reward_train': rewarded_trials[train_inds],
+                            'outcome_train': trial_outcomes[train_inds], 'autorewarded_miss_train': autorewarded[train_inds],
+                            'unrewarded_hit_train': unrewarded_hits[train_inds], 'true_dec_train': train_labels['dec']}
+            values_test = {'true_stim_test': detailed_ps_labels[test_inds], 'true_reward_test': rewarded_trials[test_inds],
+                           'outcome_test': trial_outcomes[test_inds], 'autorewarded_miss_test': autorewarded[test_inds],
+                           'unrewarded_hit_test': unrewarded_hits[test_inds], 'true_dec_test': test_labels['dec'],
+                           'used_for_training': 1}
+            if len(list_test) == 2:
+                values_train['angle_decoders'] = angle_decoders[i_session, i_loop]
+            if include_lick_times:
+                values_train['first_lick_train'] = first_lick[train_inds]
+                values_test['first_lick_test'] = first_lick[test_inds]
+            for name_cov in list_save_covs:
+                values_train[name_cov + '_train'] = cov_dict[name_cov][train_inds]
+                values_test[name_cov + '_test'] = cov_dict[name_cov][test_inds]
+            table_train.add_rows(len(train_inds), predictions=predictions_train, fold=i_loop, **ids, **values_train)
+            table_test.add_rows(len(test_inds), predictions=predictions_test, fold=i_loop, **ids, **values_test)
+            i_loop += 1
+
+        ## Add results of eval_only trials (average of decoder CVs):
+
+        ## eval onlY:
+        predictions_eval = {C: {} for C in C_path}
+        for C in C_path:
+            assert (np.array(list(pred_proba_eval[C].keys())) == np.arange(n_split)).all()
             for x in list_test:
-                mat_predictions = np.array([pred_proba_eval[nn][x] for nn in range(n_split)])
+                mat_predictions = np.array([pred_proba_eval[C][nn][x] for nn in range(n_split)])
                 assert mat_predictions.shape[0] == n_split
-                dict_predictions_test[f'pred_{x}_test'] = np.concatenate((dict_predictions_test[f'pred_{x}_test'], np.mean(mat_predictions, 0)))
-            dict_predictions_test['true_stim_test'] = np.concatenate((dict_predictions_test['true_stim_test'], session.trial_subsets[eval_only_inds].astype('int')))
-            tmp_rewarded_all_trials = np.logical_or(session.outcome == 'hit', session.outcome == 'too_')
-            tmp_rewarded_all_trials[session.autorewarded] = True
-            tmp_rewarded_all_trials[session.unrewarded_hits] = False
-            dict_predictions_test['true_reward_test'] = np.concatenate((dict_predictions_test['true_reward_test'], tmp_rewarded_all_trials[eval_only_inds]))
-            dict_predictions_test['outcome_test'] = np.concatenate((dict_predictions_test['outcome_test'], eval_only_labels))
-            dict_predictions_test['autorewarded_miss_test'] = np.concatenate((dict_predictions_test['autorewarded_miss_test'], session.autorewarded[eval_only_inds]))
-            dict_predictions_test['unrewarded_hit_test'] = np.concatenate((dict_predictions_test['unrewarded_hit_test'], session.unrewarded_hits[eval_only_inds]))
-            dict_predictions_test['true_dec_test'] = np.concatenate((dict_predictions_test['true_dec_test'], session.decision[eval_only_inds]))
-            if include_lick_times:
-                dict_predictions_test['first_lick_test'] = np.concatenate((dict_predictions_test['first_lick_test'], session.first_lick[eval_only_inds]))
-            dict_predictions_test['used_for_training'] = np.concatenate((dict_predictions_test['used_for_training'], np.zeros(len(eval_only_inds))))
-            if len(list_save_covs) > 0:
-                for name_cov in list_save_covs:
-                    dict_predictions_test[name_cov + '_test'] = np.concatenate((dict_predictions_test[name_cov + '_test'], session.cov_dict[name_cov][eval_only_inds])) 
-                
-            ## spontaneous:
-            if n_spont_trials > 0 and (spont_used_for_training is False):
-                assert (np.array(list(pred_proba_spont.keys())) == np.arange(n_split)).all()
+                predictions_eval[C][f'pred_{x}_test'] = np.mean(mat_predictions, 0)
+        tmp_rewarded_all_trials = np.logical_or(session.outcome == 'hit', session.outcome == 'too_')
+        tmp_rewarded_all_trials[session.autorewarded] = True
+        tmp_rewarded_all_trials[session.unrewarded_hits] = False
+        values_eval = {'true_stim_test': session.trial_subsets[eval_only_inds].astype('int'), 
+                       'true_reward_test': tmp_rewarded_all_trials[eval_only_inds],
+                       'outcome_test': eval_only_labels, 'autorewarded_miss_test': session.autorewarded[eval_only_inds],
+                       'unrewarded_hit_test': session.unrewarded_hits[eval_only_inds], 
+                       'true_dec_test': session.decision[eval_only_inds], 'used_for_training': 0}
+        if include_lick_times:
+            values_eval['first_lick_test'] = session.first_lick[eval_only_inds]
+        for name_cov in list_save_covs:
+            values_eval[name_cov + '_test'] = session.cov_dict[name_cov][eval_only_inds]
+        table_test.add_rows(len(eval_only_inds), predictions=predictions_eval, fold=-1, **ids, **values_eval)
+            
+        ## spontaneous:
+        if n_spont_trials > 0 and (spont_used_for_training is False):
+            predictions_spont = {C: {} for C in C_path}
+            for C in C_path:
+                assert (np.array(list(pred_proba_spont[C].keys())) == np.arange(n_split)).all()
                 for x in list_test:
-                    mat_predictions = np.array([pred_proba_spont[nn][x] for nn in range(n_split)])
+                    mat_predictions = np.array([pred_proba_spont[C][nn][x] for nn in range(n_split)])
                     assert mat_predictions.shape[0] == n_split, mat_predictions.shape[1] == n_spont_trials
-                    dict_predictions_test[f'pred_{x}_test'] = np.concatenate((dict_predictions_test[f'pred_{x}_test'], np.mean(mat_predictions, 0)))
-                dict_predictions_test['true_stim_test'] = np.concatenate((dict_predictions_test['true_stim_test'], np.zeros(n_spont_trials)))
-                dict_predictions_test['true_reward_test'] = np.concatenate((dict_predictions_test['true_reward_test'], np.ones(n_spont_trials)))
-                dict_predictions_test['outcome_test'] = np.concatenate((dict_predictions_test['outcome_test'], np.array(['spont'] * n_spont_trials)))
-                dict_predictions_test['autorewarded_miss_test'] = np.concatenate((dict_predictions_test['autorewarded_miss_test'], np.zeros(n_spont_trials)))
-                dict_predictions_test['unrewarded_hit_test'] = np.concatenate((dict_predictions_test['unrewarded_hit_test'], np.zeros(n_spont_trials)))
-                dict_predictions_test['true_dec_test'] = np.concatenate((dict_predictions_test['true_dec_test'], np.ones(n_spont_trials)))
-                if include_lick_times:
-                    if n_spont_trials != len(session.first_lick_spont):
-                        ## All sessions have 10 spont trials (and associated first_lick_spont), but for 2 sessions we only have imaging data of 9 trials. We think this is because imaging was not ready/corrupted for the first trial (as it was start of experiment), so selecting [1:] lick times to match the df/f data should be right. However, to be sure, check session.build_trials_multi() where pre-reward trials that only contains NaNs are filtered, these must be the missing ones (OR alternatively we could match frame times of reward delivery and imaging). For now we don't need this anyway, so this is for future ref
-                        ## See explanation above: I'll put the lick times to nan for now
-                        # print(n_spont_trials, len(session.first_lick_spont))
-                        # print(session)
-                        # print(session.first_lick_spont)
-                        # spont_lick_times = session.first_lick_spont[1:]
-                        spont_lick_times = np.zeros(n_spont_trials) + np.nan
-                    else:
-                        spont_lick_times = session.first_lick_spont
-                    dict_predictions_test['first_lick_test'] = np.concatenate((dict_predictions_test['first_lick_test'], spont_lick_times))
-                dict_predictions_test['used_for_training'] = np.concatenate((dict_predictions_test['used_for_training'], np.zeros(n_spont_trials)))
-                if len(list_save_covs) > 0:
-                    for name_cov in list_save_covs:
-                        dict_predictions_test[name_cov + '_test'] = np.concatenate((dict_predictions_test[name_cov + '_test'], cov_dict_reward_only[name_cov]))
+                    predictions_spont[C][f'pred_{x}_test'] = np.mean(mat_predictions, 0)
+            values_spont = {'true_stim_test': 0, 'true_reward_test': 1, 'outcome_test': 'spont',
+                            'autorewarded_miss_test': 0, 'unrewarded_hit_test': 0, 'true_dec_test': 1,
+                            'used_for_training': 0}
+            if include_lick_times:
+                if n_spont_trials != len(session.first_lick_spont):
+                    ## All sessions have 10 spont trials (and associated first_lick_spont), but for 2 sessions we only have imaging data of 9 trials. We think this is because imaging was not ready/corrupted for the first trial (as it was start of experiment), so selecting [1:] lick times to match the df/f data should be right. However, to be sure, check session.build_trials_multi() where pre-reward trials that only contains NaNs are filtered, these must be the missing ones (OR alternatively we could match frame times of reward delivery and imaging). For now we don't need this anyway, so this is for future ref
+                    ## See explanation above: I'll put the lick times to nan for now
+                    # print(n_spont_trials, len(session.first_lick_spont))
+                    # print(session)
+                    # print(session.first_lick_spont)
+                    # spont_lick_times = session.first_lick_spont[1:]
+                    spont_lick_times = np.zeros(n_spont_trials) + np.nan
+                else:
+                    spont_lick_times = session.first_lick_spont
+                values_spont['first_lick_test'] = spont_lick_times
+            for name_cov in list_save_covs:
+                values_spont[name_cov + '_test'] = cov_dict_reward_only[name_cov]
+            table_test.add_rows(n_spont_trials, predictions=predictions_spont, fold=-1, **ids, **values_spont)
 
-        if verbose == 2:
-            print(f'length test: {len(dict_predictions_test["true_dec_test"])}')
-        ## Put dictionary results into dataframes:
-        df_prediction_train[mouse] = pd.DataFrame(dict_predictions_train)
-        df_prediction_test[mouse] = pd.DataFrame(dict_predictions_test)
+    assert table_train.n_filled == table_train.n_rows and table_test.n_filled == table_test.n_rows
+    if verbose == 2:
+        print(f'length test: {table_test.n_rows}')
+
+    if return_table:
+        df_prediction_train, df_prediction_test = table_train, table_test
+    else:
+        ## Put results into dataframes per mouse (one per C value, only the predictions differ):
+        df_prediction_train = {C: {mouse: table_train.to_dataframe(C=C, include_ids=False, mouse=mouse) for mouse in mouse_list} for C in C_path}
+        df_prediction_test = {C: {mouse: table_test.to_dataframe(C=C, include_ids=False, mouse=mouse) for mouse in mouse_list} for C in C_path}
+        if use_C_path is False:  # single C value, return results directly
+            df_prediction_train, df_prediction_test = df_prediction_train[C_path[0]], df_prediction_test[C_path[0]]
+    if return_decoder_weights and use_C_path is False:
+        dec_weights = dec_weights[C_path[0]]
 
     if return_decoder_weights is False:
         return df_prediction_train, df_prediction_test, None, (data_use, trial_outcomes)
@@ -662,6 +900,481 @@ def train_test_all_sessions(sessions, trial_times_use=None, verbose=2, list_test
 
 
 ## Some functions that can be used as accuracy assessment
+def _fit_predict_single_tp(train_data, train_labels, list_pred_data, dec):
+    """Fit decoder dec on train_data (n_trials x n_neurons) and return P(label=1) for all data sets
+    in list_pred_data, and the decoder weights & intercept (used by fit_decoders_time_points())."""
+    dec.fit(X=train_data, y=train_labels)
+    return [dec.predict_proba(X=pred_data)[:, 1] for pred_data in list_pred_data], dec.coef_[0].copy(), dec.intercept_[0]
+
+def fit_decoders_time_points(train_data, train_labels, list_pred_data, C_value=0.2, reg_type='l2', n_jobs=1,
+                             return_intercepts=False):
+    """Fit a logistic regression decoder for every time point, and predict data sets list_pred_data.
+
+    If n_jobs == 1, a single warm-started solver is used that initialises each time point with the solution
+    of the previous time point (neighbouring time points have similar decoders, so this converges fast).
+    Otherwise, time points are fitted in parallel with joblib.
+
+    Parameters
+    ----------
+    train_data : np.array of shape (n_timepoints, n_trials, n_neurons)
+        training data
+    train_labels : np.array of shape (n_trials,)
+        binary training labels
+    list_pred_data : list of np.arrays of shape (n_timepoints, n_trials_pred, n_neurons)
+        data sets to predict
+    C_value : float, default=0.2
+        regularisation strength (C in sklearn)
+    reg_type : str, default='l2'
+        regulariser type
+    n_jobs : int, default=1
+        number of joblib jobs
+    return_intercepts : bool, default=False
+        if True, also return decoder intercepts
+
+    Returns
+    -------
+    list_pred : list of np.arrays of shape (n_timepoints, n_trials_pred)
+        predicted probabilities, one array per element of list_pred_data
+    coefs : np.array of shape (n_timepoints, n_neurons)
+        decoder weights
+    intercepts : np.array of shape (n_timepoints,)
+        decoder intercepts (only if return_intercepts)
+    """
+    n_tp = train_data.shape[0]
+    assert len(np.unique(train_labels)) == 2, 'training will be perfect'
+    for pred_data in list_pred_data:
+        assert pred_data.shape[0] == n_tp and pred_data.shape[2] == train_data.shape[2]
+
+    if n_jobs == 1:
+        dec = sklearn.linear_model.LogisticRegression(penalty=reg_type, C=C_value, class_weight='balanced', warm_start=True)
+        results = [_fit_predict_single_tp(train_data=train_data[i_tp], train_labels=train_labels,
+                                          list_pred_data=[x[i_tp] for x in list_pred_data], dec=dec) for i_tp in range(n_tp)]
+    else:
+        results = joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(_fit_predict_single_tp)(
+                                    train_data=train_data[i_tp], train_labels=train_labels,
+                                    list_pred_data=[x[i_tp] for x in list_pred_data],
+                                    dec=sklearn.linear_model.LogisticRegression(penalty=reg_type, C=C_value, class_weight='balanced')) 
+                                    for i_tp in range(n_tp))
+
+    list_pred = [np.array([res[0][i_data] for res in results]) for i_data in range(len(list_pred_data))]
+    coefs = np.array([res[1] for res in results])
+    if return_intercepts:
+        return list_pred, coefs, np.array([res[2] for res in results])
+    return list_pred, coefs
+
+def get_time_point_frames(session, time_array):
+    """Convert time points (in seconds) to frames of session. Elements of time_array can be
+    floats or np.arrays of time points (that are averaged with fun_return_2d()).
+
+    Returns
+    -------
+    list_frames : list of np.arrays
+        frames per element of time_array
+    """
+    list_frames = []
+    for tp in time_array:
+        tp = np.atleast_1d(tp)
+        list_frames.append(np.array([session.filter_ps_array[np.where(session.filter_ps_time == tt)[0][0]] for tt in tp]))  # this will throw an error if tt not in filter_ps_time
+    return list_frames
+
+def get_frame_cumsum(session, data_mat_norm):
+    """Cumulative sum along the frame axis of normalised tensor data_mat_norm (n_neurons x n_trials x n_frames) 
+    of session, with a leading 0 frame, such that the sum of frames [a, b) is cumsum[:, :, b] - cumsum[:, :, a].
+    NaNs are counted separately (nan_cumsum, None if there are no NaNs), so that they do not propagate.
+    The cumulative sum has the dtype of data_mat_norm (see Session.set_dtype()).
+    The result is stored per session (session._frame_cumsum_cache) and only recomputed if data_mat_norm 
+    is a different array (eg after the normalised raster cache was reset). Entries of tensors that are no longer 
+    in the normalised raster cache (see pop.get_normalised_raster_tensors()) are removed.
+
+    Returns
+    -------
+    cumsum : np.array of shape (n_neurons, n_trials, n_frames + 1)
+    nan_cumsum : np.array of shape (n_neurons, n_trials, n_frames + 1) or None
+    """
+    if not hasattr(session, '_frame_cumsum_cache'):
+        session._frame_cumsum_cache = {}
+    cache = session._frame_cumsum_cache
+    if id(data_mat_norm) in cache and cache[id(data_mat_norm)][0] is data_mat_norm:
+        return cache[id(data_mat_norm)][1:]
+    norm_tensors = [x for _, _, result in getattr(session, '_norm_raster_cache', {}).values() for x in result]
+    session._frame_cumsum_cache = cache = {key: value for key, value in cache.items() 
+                                           if np.any([value[0] is x for x in norm_tensors])}
+    nan_mask = np.isnan(data_mat_norm)
+    cumsum = np.zeros(data_mat_norm.shape[:2] + (data_mat_norm.shape[2] + 1,), dtype=data_mat_norm.dtype)
+    np.cumsum(np.where(nan_mask, 0, data_mat_norm), axis=2, out=cumsum[:, :, 1:])
+    nan_cumsum = None
+    if nan_mask.any():
+        nan_cumsum = np.zeros(cumsum.shape, dtype=np.int32)
+        np.cumsum(nan_mask, axis=2, out=nan_cumsum[:, :, 1:])
+    cache[id(data_mat_norm)] = (data_mat_norm, cumsum, nan_cumsum)
+    return cumsum, nan_cumsum
+
+def get_window_means(session, data_mat_norm, list_frames, neurons=None, trials=None):
+    """Mean of normalised tensor data_mat_norm (n_neurons x n_trials x n_frames) of session over the frames of 
+    every element of list_frames (as fun_return_2d()), for selected neurons and trials. Windows of consecutive frames
+    are computed from the (cached) cumulative sum along the frame axis (see get_frame_cumsum()), so the cost per 
+    window does not depend on its length and overlapping windows do not recompute their shared frames.
+
+    Parameters
+    ----------
+    session : Session
+    data_mat_norm : np.array of shape (n_neurons, n_trials, n_frames)
+        eg data_use_mat_norm of pop.normalise_raster_data()
+    list_frames : list of np.arrays
+        frames per window (see get_time_point_frames())
+    neurons, trials : np.array or None
+        indices of neurons and trials to return (default all)
+
+    Returns
+    -------
+    window_means : np.array of shape (n_windows, n_trials, n_neurons)
+    """
+    if neurons is None:
+        neurons = np.arange(data_mat_norm.shape[0])
+    if trials is None:
+        trials = np.arange(data_mat_norm.shape[1])
+    window_means = np.zeros((len(list_frames), len(trials), len(neurons)), dtype=data_mat_norm.dtype)
+    is_consecutive = np.array([np.all(np.diff(frames) == 1) for frames in list_frames])
+    if np.any(is_consecutive):
+        cumsum, nan_cumsum = get_frame_cumsum(session=session, data_mat_norm=data_mat_norm)
+        starts = np.array([frames[0] for frames, cons in zip(list_frames, is_consecutive) if cons])
+        stops = np.array([frames[-1] + 1 for frames, cons in zip(list_frames, is_consecutive) if cons])
+        inds_start, inds_stop = np.ix_(neurons, trials, starts), np.ix_(neurons, trials, stops)
+        means = (cumsum[inds_stop] - cumsum[inds_start]) / (stops - starts).astype(cumsum.dtype)  # n_neurons x n_trials x n_windows
+        if nan_cumsum is not None:
+            means[(nan_cumsum[inds_stop] - nan_cumsum[inds_start]) > 0] = np.nan  # as np.mean
+        window_means[is_consecutive] = means.transpose((2, 1, 0))
+    for i_window in np.where(~is_consecutive)[0]:  # eg windows across the PS artefact gap
+        window_means[i_window] = fun_return_2d(data_mat_norm[np.ix_(neurons, trials, list_frames[i_window])]).T
+    return window_means
+
+def train_test_all_sessions_multi_tp(sessions, time_array, verbose=0, list_tt_training=['hit', 'miss', 'fp', 'cr', 'spont'], 
+                                     include_150=False, n_split=4, include_autoreward=False, include_unrewardedhit=False,
+                                     neurons_selection='all', include_too_early=False, C_value=0.2, reg_type='l2',
+                                     concatenate_sessions_per_mouse=True, hard_set_10_trials=False, list_save_covs=[],
+                                     equalize_n_trials_per_tt=True, include_lick_times=False, n_jobs=1):
+    """Batched version of train_test_all_sessions() that trains decoders for all time points of time_array at once.
+    Trial selection, labels and data folds are computed once per session (so the same random trial subsample
+    is used for all time points), and all time points of a fold are fitted with fit_decoders_time_points().
+    Returns the test predictions in the same format as train_test_all_sessions(), per time point.
+
+    Parameters
+    ----------
+    sessions : dict
+        dictionary of sessions
+    time_array : np.array
+        time points (s) to decode. Elements can also be np.arrays of time points (which are averaged), 
+        eg sliding windows of create_sliding_time_windows()
+    n_jobs : int, default=1
+        if 1, use warm-started fits across time points, else fit time points in parallel with joblib
+    other parameters:
+        see train_test_all_sessions()
+
+    Returns
+    -------
+    dict_df_prediction_test : dict
+        with keys i_tp (index of time_array), values dict of pd.DataFrame per mouse (as df_prediction_test of train_test_all_sessions())
+    """
+    spont_used_for_training = 'spont' in list_tt_training
+    list_test = get_decoder_list(list_tt_training=list_tt_training)
+    n_tp = len(time_array)
+
+    if concatenate_sessions_per_mouse:
+        mouse_list = np.unique([ss.mouse for _, ss in sessions.items()])
+    else:
+        mouse_list = [ss.signature for ss in sessions.values()]
+
+    all_spont_lick_times = None
+    if equalize_n_trials_per_tt:
+        all_spont_lick_times = np.concatenate([ss.first_lick_spont for ss in sessions.values()])  # distr of lick times of reward only trials
+        assert len(all_spont_lick_times) == (len(sessions) * 10)
+
+    name_list = ['autorewarded_miss', 'unrewarded_hit', 'outcome', 'true_dec', 'true_stim', 'true_reward'] + list(list_save_covs)
+    if include_lick_times:
+        name_list.append('first_lick')
+
+    dict_df_prediction_test = {i_tp: {} for i_tp in range(n_tp)}
+    for mouse in mouse_list:
+        if concatenate_sessions_per_mouse:
+            curr_sessions = {i_session: session for i_session, session in sessions.items() if session.mouse == mouse}
+        else:
+            curr_sessions = {i_session: session for i_session, session in sessions.items() if session.signature == mouse}
+        dict_labels_test = {x + '_test': [] for x in name_list}  # lists of arrays, concatenated per mouse
+        dict_labels_test['used_for_training'] = []
+        dict_pred_test = {x: [] for x in list_test}  # lists of (n_tp x n_trials) arrays
+        for i_session, session in curr_sessions.items():
+            if verbose >= 1:
+                print(f'Mouse {mouse}, Starting loop {i_session + 1}/{len(sessions)}')
+            list_frames = get_time_point_frames(session=session, time_array=time_array)
+
+            ## Set neuron inds
+            if neurons_selection == 'all':
+                neurons_include = np.arange(session.behaviour_trials.shape[0])
+            elif neurons_selection == 's1':
+                neurons_include = np.where(session.s1_bool)[0]
+            elif neurons_selection == 's2':
+                neurons_include = np.where(session.s2_bool)[0]
+
+            ## Set trial inds (once for all time points)
+            trial_inds, eval_only_inds, eval_only_labels = select_trials_session(session=session, list_tt_training=list_tt_training, include_150=include_150,
+                                                                                 include_autoreward=include_autoreward, include_unrewardedhit=include_unrewardedhit,
+                                                                                 include_too_early=include_too_early, equalize_n_trials_per_tt=equalize_n_trials_per_tt,
+                                                                                 hard_set_10_trials=hard_set_10_trials, all_spont_lick_times=all_spont_lick_times,
+                                                                                 verbose=verbose)
+            assert len(eval_only_inds) > 0, f'ERROR: {session} has no eval-only trials, which has not been really taken care of here'
+
+            ## Retrieve normalized data (cached per session):
+            (data_use_mat_norm, _, _, data_spont_mat_norm, _, _, _, _, _, _) = pop.normalise_raster_data(session, sort_neurons=False, start_time=session.filter_ps_time.min(), 
+                                                                                                          end_time=session.filter_ps_time.max(), filter_150_stim=False)
+            assert data_use_mat_norm.shape[1] == session.behaviour_trials.shape[1]
+
+            ## Select & squeeze time frames for all time points: (n_tp x n_trials x n_neurons)
+            ## Time windows are averaged with the cumulative sum of the normalised tensors (see get_window_means())
+            data_use = get_window_means(session=session, data_mat_norm=data_use_mat_norm, list_frames=list_frames,
+                                        neurons=neurons_include, trials=trial_inds)
+            data_eval = get_window_means(session=session, data_mat_norm=data_use_mat_norm, list_frames=list_frames,
+                                         neurons=neurons_include, trials=eval_only_inds)
+            data_spont = get_window_means(session=session, data_mat_norm=data_spont_mat_norm, list_frames=list_frames,
+                                          neurons=neurons_include)
+            n_spont_trials = data_spont.shape[1]
+            assert n_spont_trials == 10 or n_spont_trials == 9
+
+            dict_labels = get_trial_labels_session(session=session, trial_inds=trial_inds, n_spont_trials=n_spont_trials,
+                                                   spont_used_for_training=spont_used_for_training,
+                                                   include_lick_times=include_lick_times, list_save_covs=list_save_covs)
+            trial_outcomes = dict_labels['outcome']
+            if spont_used_for_training:
+                data_use = np.concatenate((data_use, data_spont), axis=1)
+            assert len(trial_outcomes) == data_use.shape[1]
+
+            ## Folds are identical for all time points:
+            n_trials = data_use.shape[1]
+            sss = sklearn.model_selection.StratifiedKFold(n_splits=n_split)
+            list_folds = list(sss.split(X=np.zeros(n_trials), y=trial_outcomes))
+            test_order = np.concatenate([test_inds for _, test_inds in list_folds])  # order of test trials in output
+            
+            pred_test = {x: np.zeros((n_tp, n_trials)) for x in list_test}
+            pred_eval = {x: np.zeros((n_tp, len(eval_only_inds))) for x in list_test}
+            pred_spont = {x: np.zeros((n_tp, n_spont_trials)) for x in list_test}
+            for train_inds, test_inds in list_folds:
+                for x in list_test:
+                    train_labels, test_labels = dict_labels[x][train_inds], dict_labels[x][test_inds]
+                    assert len(np.unique(train_labels)) == 2 , f'{x} training will be perfect'
+                    assert len(np.unique(test_labels)) == 2, 'not stricitly necessary, could be loosened'
+                    (tmp_test, tmp_eval, tmp_spont), _ = fit_decoders_time_points(train_data=data_use[:, train_inds, :], train_labels=train_labels,
+                                                                                  list_pred_data=[data_use[:, test_inds, :], data_eval, data_spont],
+                                                                                  C_value=C_value, reg_type=reg_type, n_jobs=n_jobs)
+                    pred_test[x][:, test_inds] = tmp_test
+                    pred_eval[x] += tmp_eval / n_split  # average of decoder CVs
+                    pred_spont[x] += tmp_spont / n_split
+
+            ## Save results, in the same order as train_test_all_sessions():
+            tmp_rewarded_all_trials = np.logical_or(session.outcome == 'hit', session.outcome == 'too_')
+            tmp_rewarded_all_trials[session.autorewarded] = True
+            tmp_rewarded_all_trials[session.unrewarded_hits] = False
+            add_spont = n_spont_trials > 0 and (spont_used_for_training is False)
+            for x in list_test:
+                dict_pred_test[x] += [pred_test[x][:, test_order], pred_eval[x]]
+                if add_spont:
+                    dict_pred_test[x].append(pred_spont[x])
+            dict_labels_test['true_stim_test'] += [dict_labels['n_stim'][test_order], session.trial_subsets[eval_only_inds].astype('int')]
+            dict_labels_test['true_reward_test'] += [dict_labels['reward'][test_order], tmp_rewarded_all_trials[eval_only_inds]]
+            dict_labels_test['outcome_test'] += [trial_outcomes[test_order], np.array(eval_only_labels)]
+            dict_labels_test['autorewarded_miss_test'] += [dict_labels['autorewarded'][test_order], session.autorewarded[eval_only_inds]]
+            dict_labels_test['unrewarded_hit_test'] += [dict_labels['unrewarded_hits'][test_order], session.unrewarded_hits[eval_only_inds]]
+            dict_labels_test['true_dec_test'] += [dict_labels['dec'][test_order], session.decision[eval_only_inds]]
+            dict_labels_test['used_for_training'] += [np.ones(n_trials), np.zeros(len(eval_only_inds))]
+            if include_lick_times:
+                dict_labels_test['first_lick_test'] += [dict_labels['first_lick'][test_order], session.first_lick[eval_only_inds]]
+            for name_cov in list_save_covs:
+                dict_labels_test[name_cov + '_test'] += [dict_labels['cov'][name_cov][test_order], session.cov_dict[name_cov][eval_only_inds]]
+            if add_spont:
+                dict_labels_test['true_stim_test'].append(np.zeros(n_spont_trials))
+                dict_labels_test['true_reward_test'].append(np.ones(n_spont_trials))
+                dict_labels_test['outcome_test'].append(np.array(['spont'] * n_spont_trials))
+                dict_labels_test['autorewarded_miss_test'].append(np.zeros(n_spont_trials))
+                dict_labels_test['unrewarded_hit_test'].append(np.zeros(n_spont_trials))
+                dict_labels_test['true_dec_test'].append(np.ones(n_spont_trials))
+                dict_labels_test['used_for_training'].append(np.zeros(n_spont_trials))
+                if include_lick_times:
+                    if n_spont_trials != len(session.first_lick_spont):  # see train_test_all_sessions()
+                        dict_labels_test['first_lick_test'].append(np.zeros(n_spont_trials) + np.nan)
+                    else:
+                        dict_labels_test['first_lick_test'].append(session.first_lick_spont)
+                for name_cov in list_save_covs:
+                    dict_labels_test[name_cov + '_test'].append(dict_labels['cov_reward_only'][name_cov])
+
+        ## Put results into dataframes, one per time point (only predictions differ between time points):
+        dict_labels_test = {k: np.concatenate(v) for k, v in dict_labels_test.items()}
+        dict_pred_test = {x: np.concatenate(v, axis=1) for x, v in dict_pred_test.items()}
+        for i_tp in range(n_tp):
+            dict_predictions_test = {f'pred_{x}_test': dict_pred_test[x][i_tp] for x in list_test}
+            dict_predictions_test.update(dict_labels_test)
+            dict_df_prediction_test[i_tp][mouse] = pd.DataFrame(dict_predictions_test)
+
+    return dict_df_prediction_test
+
+def train_test_temporal_generalisation(sessions, time_array, region_list=['s1', 's2'], verbose=0,
+                                       list_tt_training=['hit', 'miss', 'fp', 'cr', 'spont'], include_150=False, n_split=4,
+                                       include_autoreward=False, include_unrewardedhit=False, include_too_early=False,
+                                       C_value=0.2, reg_type='l2', hard_set_10_trials=False, equalize_n_trials_per_tt=True, n_jobs=1):
+    """Cross-temporal generalisation of decoders: decoders are trained at each time point of time_array and
+    tested at every time point of time_array. Per fold, the decoders of all time points are fitted with 
+    fit_decoders_time_points(), and the test trials of all time points are projected onto the weights of all 
+    decoders with one matrix product, so that testing (n_tp x n_tp) combinations costs one matmul per fold.
+    Trial selection and folds are shared by all regions of a session (as train_test_all_sessions_multi_tp()).
+
+    Parameters
+    ----------
+    sessions : dict
+        dictionary of sessions
+    time_array : np.array
+        time points (s) to train & test. Elements can also be np.arrays of time points (which are averaged),
+        eg sliding windows of create_sliding_time_windows()
+    region_list : list, default=['s1', 's2']
+        neuron selections to decode from ('all', 's1' or 's2')
+    other parameters:
+        see train_test_all_sessions_multi_tp()
+
+    Returns
+    -------
+    dict_acc : dict
+        with keys decoder name ('dec', 'stim'), values dicts with keys session.signature, values dicts with keys region, 
+        values np.array of shape (n_tp_train, n_tp_test) of class-averaged accuracy (as class_av_mean_accuracy()) 
+        of cross-validated test trials. The diagonal is the accuracy of train_test_all_sessions_multi_tp().
+    """
+    spont_used_for_training = 'spont' in list_tt_training
+    list_test = get_decoder_list(list_tt_training=list_tt_training)
+    n_tp = len(time_array)
+
+    all_spont_lick_times = None
+    if equalize_n_trials_per_tt:
+        all_spont_lick_times = np.concatenate([ss.first_lick_spont for ss in sessions.values()])  # distr of lick times of reward only trials
+        assert len(all_spont_lick_times) == (len(sessions) * 10)
+
+    dict_acc = {x: {} for x in list_test}
+    for i_session, session in sessions.items():
+        if verbose >= 1:
+            print(f'Session {session.signature}, Starting loop {i_session + 1}/{len(sessions)}')
+        list_frames = get_time_point_frames(session=session, time_array=time_array)
+
+        ## Set trial inds & labels (once for all time points and regions)
+        trial_inds, _, _ = select_trials_session(session=session, list_tt_training=list_tt_training, include_150=include_150,
+                                                 include_autoreward=include_autoreward, include_unrewardedhit=include_unrewardedhit,
+                                                 include_too_early=include_too_early, equalize_n_trials_per_tt=equalize_n_trials_per_tt,
+                                                 hard_set_10_trials=hard_set_10_trials, all_spont_lick_times=all_spont_lick_times,
+                                                 verbose=verbose)
+        (data_use_mat_norm, _, _, data_spont_mat_norm, _, _, _, _, _, _) = pop.normalise_raster_data(session, sort_neurons=False, start_time=session.filter_ps_time.min(), 
+                                                                                                      end_time=session.filter_ps_time.max(), filter_150_stim=False)
+        assert data_use_mat_norm.shape[1] == session.behaviour_trials.shape[1]
+        n_spont_trials = data_spont_mat_norm.shape[1] if spont_used_for_training else 0
+        dict_labels = get_trial_labels_session(session=session, trial_inds=trial_inds, n_spont_trials=n_spont_trials,
+                                               spont_used_for_training=spont_used_for_training)
+        trial_outcomes = dict_labels['outcome']
+        n_trials = len(trial_outcomes)
+        sss = sklearn.model_selection.StratifiedKFold(n_splits=n_split)
+        list_folds = list(sss.split(X=np.zeros(n_trials), y=trial_outcomes))
+
+        for x in list_test:
+            dict_acc[x][session.signature] = {}
+        for reg in region_list:
+            if reg == 'all':
+                neurons_include = np.arange(session.behaviour_trials.shape[0])
+            elif reg == 's1':
+                neurons_include = np.where(session.s1_bool)[0]
+            elif reg == 's2':
+                neurons_include = np.where(session.s2_bool)[0]
+
+            ## (n_tp x n_trials x n_neurons):
+            data_use = get_window_means(session=session, data_mat_norm=data_use_mat_norm, list_frames=list_frames,
+                                        neurons=neurons_include, trials=trial_inds)
+            if spont_used_for_training:
+                data_spont = get_window_means(session=session, data_mat_norm=data_spont_mat_norm, list_frames=list_frames,
+                                              neurons=neurons_include)
+                data_use = np.concatenate((data_use, data_spont), axis=1)
+            assert data_use.shape[1] == n_trials
+
+            for x in list_test:
+                pred_test = np.zeros((n_tp, n_tp, n_trials))  # train tp x test tp x trials
+                for train_inds, test_inds in list_folds:
+                    train_labels = dict_labels[x][train_inds]
+                    assert len(np.unique(dict_labels[x][test_inds])) == 2, 'not stricitly necessary, could be loosened'
+                    _, coefs, intercepts = fit_decoders_time_points(train_data=data_use[:, train_inds, :], train_labels=train_labels,
+                                                                    list_pred_data=[], C_value=C_value, reg_type=reg_type,
+                                                                    n_jobs=n_jobs, return_intercepts=True)
+                    ## Project test trials of all time points onto decoders of all time points at once:
+                    test_data = data_use[:, test_inds, :].reshape((n_tp * len(test_inds), -1))
+                    logits = np.dot(coefs, test_data.T).reshape((n_tp, n_tp, len(test_inds))) + intercepts[:, None, None]
+                    pred_test[:, :, test_inds] = scipy.special.expit(logits)  # P(label=1), as LogisticRegression.predict_proba()
+
+                ## Class-averaged accuracy for all (train tp, test tp) combinations:
+                labels = dict_labels[x]
+                classes = np.unique(labels)  # predictions are P(label=classes[1])
+                dict_acc[x][session.signature][reg] = 0.5 * (np.mean(pred_test[:, :, labels == classes[1]], 2) + 
+                                                             np.mean(1 - pred_test[:, :, labels == classes[0]], 2))
+    return dict_acc
+
+def check_dtype_decoder_accuracy(sessions, trial_times_use, dtype='float32', tolerance=0.01, seed=0,
+                                 verbose=1, **kwargs_train):
+    """Regression check of reduced-precision analysis mode (see Session.set_dtype()). Decoders are trained 
+    with train_test_all_sessions() on float64 and on dtype copies of sessions (with the same random seed), 
+    and the class-averaged accuracies (class_av_mean_accuracy()) of test trials are compared per mouse & decoder.
+
+    Parameters
+    ----------
+    sessions : dict of Session
+        data (not modified, shallow copies are made per dtype)
+    trial_times_use : np.array
+        time points to use (see train_test_all_sessions())
+    dtype : str, default='float32'
+        dtype to compare to float64
+    tolerance : float, default=0.01
+        maximum allowed absolute difference in accuracy
+    seed : int, default=0
+        random seed, set before training with each dtype
+    verbose : int, default=1
+        verbosiness
+    **kwargs_train : 
+        other arguments of train_test_all_sessions()
+
+    Returns
+    -------
+    df_acc : pd.DataFrame
+        accuracy per mouse, decoder and dtype, and their absolute difference
+    passed : bool
+        True if all differences are within tolerance
+    """
+    dtype = str(np.dtype(dtype))
+    dict_acc = {'mouse': [], 'decoder': [], 'float64': [], dtype: []}
+    for i_dt, dt in enumerate(['float64', dtype]):
+        sessions_dt = {}
+        for key, ss in sessions.items():
+            ss_dt = copy.copy(ss)  # shallow copy, set_dtype() reassigns trial tensors only
+            pop.clear_normalised_raster_cache(ss_dt)  # do not share cache with original session
+            ss_dt.set_dtype(dt)
+            sessions_dt[key] = ss_dt
+        np.random.seed(seed)
+        _, df_prediction_test, _, _ = train_test_all_sessions(sessions=sessions_dt, trial_times_use=trial_times_use,
+                                                              verbose=0, **kwargs_train)
+        for mouse, df in df_prediction_test.items():
+            df = df[df['used_for_training'] == 1]
+            truth = {'dec': df['true_dec_test'].values, 'stim': (df['true_stim_test'] > 0).astype('int').values}
+            for x in truth.keys():
+                if f'pred_{x}_test' not in df.columns:
+                    continue
+                if i_dt == 0:
+                    dict_acc['mouse'].append(mouse)
+                    dict_acc['decoder'].append(x)
+                dict_acc[dt].append(class_av_mean_accuracy(binary_truth=truth[x], estimate=df[f'pred_{x}_test'].values)[0])
+    df_acc = pd.DataFrame(dict_acc)
+    df_acc['abs_diff'] = np.abs(df_acc['float64'] - df_acc[dtype])
+    passed = bool((df_acc['abs_diff'] <= tolerance).all())
+    if verbose > 0:
+        print(f'Max accuracy difference float64 vs {dtype}: {df_acc["abs_diff"].max():.4f} (tolerance {tolerance})')
+        if not passed:
+            print(f'WARNING: {dtype} decoder accuracies are not within tolerance of float64')
+    return df_acc, passed
+
 def prob_correct(binary_truth, estimate):
     """Return probability of correct estimate, where bt = {0, 1} and est = (0, 1).
 
@@ -1061,29 +1774,33 @@ def compute_accuracy_time_array_average_per_mouse(sessions, time_array, average_
             else:
                 assert type(tp) == np.float64
                 use_tp = np.array([tp])
-            df_prediction_train, df_prediction_test, dec_w, _ = train_test_all_sessions(sessions=sessions, trial_times_use=use_tp,
-                                                                                        verbose=0, include_150=False, list_tt_training=list_tt_training,
-                                                                                        include_autoreward=False, C_value=regularizer, reg_type=reg_type,
-                                                                                        train_projected=projected_data, return_decoder_weights=True,
-                                                                                        neurons_selection=reg, concatenate_sessions_per_mouse=concatenate_sessions_per_mouse,
-                                                                                        hard_set_10_trials=hard_set_10_trials, include_lick_times=include_lick_times)
+            table_train, table_test, dec_w, _ = train_test_all_sessions(sessions=sessions, trial_times_use=use_tp,
+                                                                        verbose=0, include_150=False, list_tt_training=list_tt_training,
+                                                                        include_autoreward=False, C_value=regularizer, reg_type=reg_type,
+                                                                        train_projected=projected_data, return_decoder_weights=True,
+                                                                        neurons_selection=reg, concatenate_sessions_per_mouse=concatenate_sessions_per_mouse,
+                                                                        hard_set_10_trials=hard_set_10_trials, include_lick_times=include_lick_times,
+                                                                        return_table=True)
+            ## columns (views) of results tables per mouse:
+            df_prediction_train = {mouse: table_train.get_columns(mouse=mouse) for mouse in table_train.unique('mouse')}
+            df_prediction_test = {mouse: table_test.get_columns(mouse=mouse) for mouse in table_test.unique('mouse')}
             if return_full_dfs:
-                dict_full_dfs[i_tp][reg]['train'] = df_prediction_train
-                dict_full_dfs[i_tp][reg]['test'] = df_prediction_test
+                dict_full_dfs[i_tp][reg]['train'] = {mouse: table_train.to_dataframe(include_ids=False, mouse=mouse) for mouse in df_prediction_train.keys()}
+                dict_full_dfs[i_tp][reg]['test'] = {mouse: table_test.to_dataframe(include_ids=False, mouse=mouse) for mouse in df_prediction_test.keys()}
             for xx in dec_w.keys():
                 for signat in signature_list:
                     decoder_weights[f'{reg}_{xx}'][signat][:, i_tp] = np.mean(dec_w[xx][signat], 0)
 
             for mouse in df_prediction_train.keys():
-                assert df_prediction_test[mouse][df_prediction_test[mouse]['used_for_training'] == 1]['unrewarded_hit_test'].sum() == 0
-                assert df_prediction_test[mouse][df_prediction_test[mouse]['used_for_training'] == 1]['autorewarded_miss_test'].sum() == 0
+                assert np.sum(df_prediction_test[mouse]['unrewarded_hit_test'][df_prediction_test[mouse]['used_for_training'] == 1]) == 0
+                assert np.sum(df_prediction_test[mouse]['autorewarded_miss_test'][df_prediction_test[mouse]['used_for_training'] == 1]) == 0
 
                 inds_training = np.where(df_prediction_test[mouse]['used_for_training'] == 1)[0]
                 lick = df_prediction_test[mouse]['true_dec_test'].copy()
                 ps = (df_prediction_test[mouse]['true_stim_test'] > 0).astype('int').copy()
                 n_stim = df_prediction_test[mouse]['true_stim_test'].copy()
 
-                if 'pred_dec_test' in df_prediction_test[mouse].columns:
+                if 'pred_dec_test' in df_prediction_test[mouse]:
                     if projected_data is False:
                         pred_lick = df_prediction_test[mouse]['pred_dec_test'].copy()
                     else:
@@ -1101,7 +1818,7 @@ def compute_accuracy_time_array_average_per_mouse(sessions, time_array, average_
                         arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_lick[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]]), 
                                                            np.std(pred_lick[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]])]
 
-                if 'pred_stim_test' in df_prediction_test[mouse].columns:
+                if 'pred_stim_test' in df_prediction_test[mouse]:
                     if projected_data is False:
                         pred_ps = df_prediction_test[mouse]['pred_stim_test']
                     else:
@@ -1126,7 +1843,7 @@ def compute_accuracy_time_array_average_per_mouse(sessions, time_array, average_
                             arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_ps[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]]), 
                                                                 np.std(pred_ps[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]])]
 
-                if 'angle_decoders' in df_prediction_train[mouse].columns:
+                if 'angle_decoders' in df_prediction_train[mouse]:
                     angle_dec[mouse + '_' + reg][i_tp] = np.mean(df_prediction_train[mouse]['angle_decoders'])
 
     if return_full_dfs:
@@ -1140,7 +1857,8 @@ def compute_prediction_time_array_average_per_mouse_split(sessions, time_array,
                                                         list_tt_training=['hit', 'miss', 'fp', 'cr', 'spont'],
                                                         tt_list=['hit', 'fp', 'miss', 'cr', 'arm', 'urh', 'spont'],
                                                         concatenate_sessions_per_mouse=True, hard_set_10_trials=False,
-                                                        list_save_covs=[]):
+                                                        list_save_covs=[], batch_time_points=False, n_jobs=1,
+                                                        window_length=None, window_stride=None):
     """Compute accuracy of decoders for all time steps in time_array, for all sessions (concatenated per mouse)
 
     Parameters
@@ -1155,10 +1873,22 @@ def compute_prediction_time_array_average_per_mouse_split(sessions, time_array,
         type of regularisation
     region_list : str, default=['s1', 's2']
         list of regions to compute
-    regularizer : float
-        if reg_type == 'l2', this is the reg strength (C in scikit-learn)
+    regularizer : float or np.array
+        if reg_type == 'l2', this is the reg strength (C in scikit-learn). If an array, the regularisation path
+        is fitted at once (see train_test_all_sessions()) and a dict with C values as keys and result tuples as values is returned.
     projected_data : bool, default=False
         if true, also compute test prediction on projected data (see train_test_all_sessions())
+    batch_time_points : bool, default=False
+        if True, use train_test_all_sessions_multi_tp() to train all time points at once (with the same 
+        trial selection & folds for all time points). If False, train_test_all_sessions() is called per time point.
+    n_jobs : int, default=1
+        if batch_time_points, number of joblib jobs (1 = warm-started fits across time points)
+    window_length : float or None, default=None
+        if not None, decode sliding windows of window_length seconds over the time points of time_array instead
+        (see create_sliding_time_windows()), with batch_time_points. The results are then indexed by window, and
+        returned together with the window centres (see Returns).
+    window_stride : float or None, default=None
+        time (s) between sliding windows (default window_length, ie non-overlapping)
 
     Returns
     -------
@@ -1177,10 +1907,17 @@ def compute_prediction_time_array_average_per_mouse_split(sessions, time_array,
             angle between decoders
         decoder_weights)
             weights of decoders
+    window_centres : np.array
+        only if window_length is not None, (results, window_centres) is returned, where window_centres is
+        the centre time (s) of each window (ie the time axis of the results)
 
     """
     ## Prepare variables:
     assert projected_data is False, 'see old function for template of how to implement if True'
+    window_centres = None
+    if window_length is not None:  # sliding windows, of which the means are computed at once in train_test_all_sessions_multi_tp()
+        time_array, window_centres = create_sliding_time_windows(time_array=time_array, window_length=window_length, stride=window_stride)
+        batch_time_points = True
     if concatenate_sessions_per_mouse:
         mouse_list = np.unique([ss.mouse for _, ss in sessions.items()])
     else:
@@ -1199,34 +1936,45 @@ def compute_prediction_time_array_average_per_mouse_split(sessions, time_array,
             for name_cov in list_save_covs:
                 assert name_cov in ss.cov_dict.keys(), f'{ss} cov_dict does not contain {name_cov}'
 
-    ## Accuracy & prediction split by trial type
-    ps_pred_split_tt = {x: {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list} for x in tt_list}
-    lick_pred_split_tt = {x: {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list} for x in tt_list}  # split per tt
+    C_path = np.atleast_1d(regularizer)  # one or multiple C values
+    use_C_path = np.ndim(regularizer) > 0
+    if use_C_path:
+        assert batch_time_points is False, 'regularisation path not implemented for batched time points'
 
     nstim_name_dict = {'n0': np.array([0]), 'n1': np.array([5, 10]), 
                        'n2': np.array([20, 30]), 'n3': np.array([40, 50])}
-    ps_pred_split_tt_nstim, lick_pred_split_tt_nstim = {}, {}
-    
     nstim_selection_dict, tt_selection_dict = {}, {}
     for nstim_name, nstim_list in nstim_name_dict.items():
         for tt in tt_list:
             key_name = tt + '_' + nstim_name
             nstim_selection_dict[key_name] = nstim_list.copy()
             tt_selection_dict[key_name] = tt 
+    covar_perc_dict = {'c1': [0, 33.3], 'c2': [33.3001, 66.7], 'c3': [66.7001, 100]}
+
+    def create_empty_pred_dicts():
+        ## Accuracy & prediction split by trial type
+        ps_pred_split_tt = {x: {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list} for x in tt_list}
+        lick_pred_split_tt = {x: {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list} for x in tt_list}  # split per tt
+
+        ps_pred_split_tt_nstim, lick_pred_split_tt_nstim = {}, {}
+        for key_name in nstim_selection_dict.keys():
             ps_pred_split_tt_nstim[key_name] = {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list}
             lick_pred_split_tt_nstim[key_name] = {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list}
 
-    if len(list_save_covs) > 0:
-        covar_perc_dict = {'c1': [0, 33.3], 'c2': [33.3001, 66.7], 'c3': [66.7001, 100]}
-        ps_pred_split_tt_covar, lick_pred_split_tt_covar = {x: {} for x in list_save_covs}, {x: {} for x in list_save_covs}
-        for cov_name in list_save_covs:
-            for covar_perc_key, perc_value in covar_perc_dict.items():
-                for tt in tt_list:        
-                    key_name = tt + '_' + covar_perc_key
-                    ps_pred_split_tt_covar[cov_name][key_name] = {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list}
-                    lick_pred_split_tt_covar[cov_name][key_name] = {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list}
-    else:
-        ps_pred_split_tt_covar, lick_pred_split_tt_covar = None, None
+        if len(list_save_covs) > 0:
+            ps_pred_split_tt_covar, lick_pred_split_tt_covar = {x: {} for x in list_save_covs}, {x: {} for x in list_save_covs}
+            for cov_name in list_save_covs:
+                for covar_perc_key, perc_value in covar_perc_dict.items():
+                    for tt in tt_list:        
+                        key_name = tt + '_' + covar_perc_key
+                        ps_pred_split_tt_covar[cov_name][key_name] = {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list}
+                        lick_pred_split_tt_covar[cov_name][key_name] = {mouse: np.zeros((n_timepoints, 2)) for mouse in mouse_s_list}
+        else:
+            ps_pred_split_tt_covar, lick_pred_split_tt_covar = None, None
+        return (lick_pred_split_tt, lick_pred_split_tt_nstim, lick_pred_split_tt_covar,
+                ps_pred_split_tt, ps_pred_split_tt_nstim, ps_pred_split_tt_covar)
+
+    dict_results = {C: create_empty_pred_dicts() for C in C_path}  # one set of results per C value
 
     # angle_dec = {mouse: np.zeros(n_timepoints) for mouse in mouse_s_list}
     # decoder_weights = {'s1_stim': {session.signature: np.zeros((np.sum(session.s1_bool), len(time_array))) for _, session in sessions.items()},
@@ -1235,96 +1983,112 @@ def compute_prediction_time_array_average_per_mouse_split(sessions, time_array,
     #                    's2_dec': {session.signature: np.zeros((np.sum(session.s2_bool), len(time_array))) for _, session in sessions.items()}}
 
     ## Train decoders & extract relevant results:
+    if batch_time_points:  # train all time points at once
+        dict_df_prediction_test = {reg: train_test_all_sessions_multi_tp(sessions=sessions, time_array=time_array, verbose=0, include_150=False, 
+                                                                         list_tt_training=list_tt_training, include_autoreward=False, 
+                                                                         C_value=regularizer, reg_type=reg_type, neurons_selection=reg, 
+                                                                         concatenate_sessions_per_mouse=concatenate_sessions_per_mouse,
+                                                                         hard_set_10_trials=hard_set_10_trials, list_save_covs=list_save_covs,
+                                                                         n_jobs=n_jobs) for reg in region_list}
     for i_tp, tp in tqdm(enumerate(time_array)):  # time array IN SECONDS
         for reg in region_list:
-            df_prediction_train, df_prediction_test, dec_w, _ = train_test_all_sessions(sessions=sessions, trial_times_use=np.array([tp]),
-                                                                                        verbose=0, include_150=False, list_tt_training=list_tt_training,
-                                                                                        include_autoreward=False, C_value=regularizer, reg_type=reg_type,
-                                                                                        train_projected=projected_data, return_decoder_weights=True,
-                                                                                        neurons_selection=reg, concatenate_sessions_per_mouse=concatenate_sessions_per_mouse,
-                                                                                        hard_set_10_trials=hard_set_10_trials,
-                                                                                        list_save_covs=list_save_covs)  # train decoders
-            # for xx in dec_w.keys():  # extract decoder weights
-            #     for signat in signature_list:
-            #         decoder_weights[f'{reg}_{xx}'][signat][:, i_tp] = np.mean(dec_w[xx][signat], 0)
-            # return df_prediction_train, df_prediction_test
-            for mouse in df_prediction_train.keys():  # extract decoder predictions per mouse
-                assert df_prediction_test[mouse][df_prediction_test[mouse]['used_for_training'] == 1]['unrewarded_hit_test'].sum() == 0
-                assert df_prediction_test[mouse][df_prediction_test[mouse]['used_for_training'] == 1]['autorewarded_miss_test'].sum() == 0
-
-                inds_training = np.where(df_prediction_test[mouse]['used_for_training'] == 1)[0]  # this excludes stuff like arm and urh
-                lick = df_prediction_test[mouse]['true_dec_test'].copy()
-                ps = (df_prediction_test[mouse]['true_stim_test'] > 0).astype('int').copy()
-                n_stim = df_prediction_test[mouse]['true_stim_test'].copy()
+            if batch_time_points:
+                dict_df_prediction_test_C = {C_path[0]: dict_df_prediction_test[reg][i_tp]}
+            else:
+                _, table_test, _, _ = train_test_all_sessions(sessions=sessions, trial_times_use=np.array([tp]),
+                                                              verbose=0, include_150=False, list_tt_training=list_tt_training,
+                                                              include_autoreward=False, C_value=regularizer, reg_type=reg_type,
+                                                              train_projected=projected_data, return_decoder_weights=False,
+                                                              neurons_selection=reg, concatenate_sessions_per_mouse=concatenate_sessions_per_mouse,
+                                                              hard_set_10_trials=hard_set_10_trials,
+                                                              list_save_covs=list_save_covs, return_table=True)  # train decoders
+                ## columns (views) of results table per mouse, per C value:
+                dict_df_prediction_test_C = {C: {mouse: table_test.get_columns(C=C, mouse=mouse) for mouse in table_test.unique('mouse')} 
+                                             for C in C_path}
+            for C, df_prediction_test in dict_df_prediction_test_C.items():
+                (lick_pred_split_tt, lick_pred_split_tt_nstim, lick_pred_split_tt_covar,
+                 ps_pred_split_tt, ps_pred_split_tt_nstim, ps_pred_split_tt_covar) = dict_results[C]
+                for mouse in df_prediction_test.keys():  # extract decoder predictions per mouse
+                    assert np.sum(df_prediction_test[mouse]['unrewarded_hit_test'][df_prediction_test[mouse]['used_for_training'] == 1]) == 0
+                    assert np.sum(df_prediction_test[mouse]['autorewarded_miss_test'][df_prediction_test[mouse]['used_for_training'] == 1]) == 0
+
+                    inds_training = np.where(df_prediction_test[mouse]['used_for_training'] == 1)[0]  # this excludes stuff like arm and urh
+                    lick = df_prediction_test[mouse]['true_dec_test'].copy()
+                    ps = (df_prediction_test[mouse]['true_stim_test'] > 0).astype('int').copy()
+                    n_stim = df_prediction_test[mouse]['true_stim_test'].copy()
                 
-                ## 1 or 2 classifiers could be have trained (decision & stimulus):
-                if 'pred_dec_test' in df_prediction_test[mouse].columns:
-                    pred_lick = df_prediction_test[mouse]['pred_dec_test'].copy()
-                    ## Prediction split by trial type:
-                    for x, arr in lick_pred_split_tt.items():
-                        arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_lick[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]]), 
-                                                           np.std(pred_lick[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]])]
-
-                    ## Prediction split by trial type AND n cells stimulated:
-                    for x, arr in lick_pred_split_tt_nstim.items():
-                        trial_selection = np.where(np.logical_and(df_prediction_test[mouse]['outcome_test'] == tt_selection_dict[x],
-                                                                  np.isin(df_prediction_test[mouse]['true_stim_test'], nstim_selection_dict[x])))[0]
-                        arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_lick[trial_selection]), 
-                                                           np.std(pred_lick[trial_selection])]
-
-                    ## Prediction split by trial type AND covariate
-                    if len(list_save_covs) > 0:
-                        for cov_name in list_save_covs:
-                            for x, arr in lick_pred_split_tt_covar[cov_name].items():
-                                arr_covar = df_prediction_test[mouse][cov_name + '_test']
-                                # assert np.sum(np.isnan(arr_covar)) == 0, f'NaNs in {mouse} and {cov_name}'
-                                covar_perc_key = x.split('_')[1]  # second part of name 
-                                perc_min = np.percentile(arr_covar, covar_perc_dict[covar_perc_key][0])
-                                perc_max = np.percentile(arr_covar, covar_perc_dict[covar_perc_key][1])
-                                tt_name = x.split('_')[0]
-                                trial_selection = np.where(np.logical_and(np.logical_and(arr_covar <= perc_max,
-                                                                          arr_covar >= perc_min),
-                                                                          df_prediction_test[mouse]['outcome_test'] == tt_name))[0]
-                                arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_lick[trial_selection]), 
-                                                                   np.std(pred_lick[trial_selection])]
-
-                if 'pred_stim_test' in df_prediction_test[mouse].columns:
-                    pred_ps = df_prediction_test[mouse]['pred_stim_test'].copy()
-                    ## Prediction split by trial types: 
-                    for x, arr in ps_pred_split_tt.items():
-                        arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_ps[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]]), 
-                                                           np.std(pred_ps[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]])]
-
-                    ## Prediction split by trial type AND n cells stimulated:
-                    for x, arr in ps_pred_split_tt_nstim.items():
-                        trial_selection = np.where(np.logical_and(df_prediction_test[mouse]['outcome_test'] == tt_selection_dict[x],
-                                                                  np.isin(df_prediction_test[mouse]['true_stim_test'], nstim_selection_dict[x])))[0]
-                        arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_ps[trial_selection]), 
-                                                           np.std(pred_ps[trial_selection])]
-
-                    ## Prediction split by trial type AND covariate
-                    if len(list_save_covs) > 0:
-                        for cov_name in list_save_covs:
-                            for x, arr in ps_pred_split_tt_covar[cov_name].items():
-                                arr_covar = df_prediction_test[mouse][cov_name + '_test']
-                                # assert np.sum(np.isnan(arr_covar)) == 0, f'NaNs in {mouse} and {cov_name}'
-                                covar_perc_key = x.split('_')[1]  # second part of name 
-                                tt_name = x.split('_')[0]
-                                perc_min = np.percentile(arr_covar, covar_perc_dict[covar_perc_key][0])
-                                perc_max = np.percentile(arr_covar, covar_perc_dict[covar_perc_key][1])
-                                trial_selection = np.where(np.logical_and(np.logical_and(arr_covar <= perc_max,
-                                                                                         arr_covar >= perc_min),
-                                                                          df_prediction_test[mouse]['outcome_test'] == tt_name))[0]
-                                # print(arr_covar, np.sum(np.isnan(arr_covar)), trial_selection, perc_min, perc_max, x)
-                                # break
-                                arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_ps[trial_selection]), 
-                                                                   np.std(pred_ps[trial_selection])]
-
-                # if 'angle_decoders' in df_prediction_train[mouse].columns:
-                #     angle_dec[mouse + '_' + reg][i_tp] = np.mean(df_prediction_train[mouse]['angle_decoders'])
+                    ## 1 or 2 classifiers could be have trained (decision & stimulus):
+                    if 'pred_dec_test' in df_prediction_test[mouse]:  # (columns of pd.DataFrame or dict)
+                        pred_lick = df_prediction_test[mouse]['pred_dec_test'].copy()
+                        ## Prediction split by trial type:
+                        for x, arr in lick_pred_split_tt.items():
+                            arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_lick[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]]), 
+                                                               np.std(pred_lick[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]])]
+
+                        ## Prediction split by trial type AND n cells stimulated:
+                        for x, arr in lick_pred_split_tt_nstim.items():
+                            trial_selection = np.where(np.logical_and(df_prediction_test[mouse]['outcome_test'] == tt_selection_dict[x],
+                                                                      np.isin(df_prediction_test[mouse]['true_stim_test'], nstim_selection_dict[x])))[0]
+                            arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_lick[trial_selection]), 
+                                                               np.std(pred_lick[trial_selection])]
+
+                        ## Prediction split by trial type AND covariate
+                        if len(list_save_covs) > 0:
+                            for cov_name in list_save_covs:
+                                for x, arr in lick_pred_split_tt_covar[cov_name].items():
+                                    arr_covar = df_prediction_test[mouse][cov_name + '_test']
+                                    # assert np.sum(np.isnan(arr_covar)) == 0, f'NaNs in {mouse} and {cov_name}'
+                                    covar_perc_key = x.split('_')[1]  # second part of name 
+                                    perc_min = np.percentile(arr_covar, covar_perc_dict[covar_perc_key][0])
+                                    perc_max = np.percentile(arr_covar, covar_perc_dict[covar_perc_key][1])
+                                    tt_name = x.split('_')[0]
+                                    trial_selection = np.where(np.logical_and(np.logical_and(arr_covar <= perc_max,
+                                                                              arr_covar >= perc_min),
+                                                                              df_prediction_test[mouse]['outcome_test'] == tt_name))[0]
+                                    arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_lick[trial_selection]), 
+                                                                       np.std(pred_lick[trial_selection])]
+
+                    if 'pred_stim_test' in df_prediction_test[mouse]:  # (columns of pd.DataFrame or dict)
+                        pred_ps = df_prediction_test[mouse]['pred_stim_test'].copy()
+                        ## Prediction split by trial types: 
+                        for x, arr in ps_pred_split_tt.items():
+                            arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_ps[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]]), 
+                                                               np.std(pred_ps[np.where(df_prediction_test[mouse]['outcome_test'] == x)[0]])]
+
+                        ## Prediction split by trial type AND n cells stimulated:
+                        for x, arr in ps_pred_split_tt_nstim.items():
+                            trial_selection = np.where(np.logical_and(df_prediction_test[mouse]['outcome_test'] == tt_selection_dict[x],
+                                                                      np.isin(df_prediction_test[mouse]['true_stim_test'], nstim_selection_dict[x])))[0]
+                            arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_ps[trial_selection]), 
+                                                               np.std(pred_ps[trial_selection])]
+
+                        ## Prediction split by trial type AND covariate
+                        if len(list_save_covs) > 0:
+                            for cov_name in list_save_covs:
+                                for x, arr in ps_pred_split_tt_covar[cov_name].items():
+                                    arr_covar = df_prediction_test[mouse][cov_name + '_test']
+                                    # assert np.sum(np.isnan(arr_covar)) == 0, f'NaNs in {mouse} and {cov_name}'
+                                    covar_perc_key = x.split('_')[1]  # second part of name 
+                                    tt_name = x.split('_')[0]
+                                    perc_min = np.percentile(arr_covar, covar_perc_dict[covar_perc_key][0])
+                                    perc_max = np.percentile(arr_covar, covar_perc_dict[covar_perc_key][1])
+                                    trial_selection = np.where(np.logical_and(np.logical_and(arr_covar <= perc_max,
+                                                                                             arr_covar >= perc_min),
+                                                                              df_prediction_test[mouse]['outcome_test'] == tt_name))[0]
+                                    # print(arr_covar, np.sum(np.isnan(arr_covar)), trial_selection, perc_min, perc_max, x)
+                                    # break
+                                    arr[mouse + '_' + reg][i_tp, :] = [np.mean(pred_ps[trial_selection]), 
+                                                                       np.std(pred_ps[trial_selection])]
+
+                    # if 'angle_decoders' in df_prediction_train[mouse].columns:
+                    #     angle_dec[mouse + '_' + reg][i_tp] = np.mean(df_prediction_train[mouse]['angle_decoders'])
     angle_dec, decoder_weights = None, None
-    return (lick_pred_split_tt, lick_pred_split_tt_nstim, lick_pred_split_tt_covar,
-            ps_pred_split_tt, ps_pred_split_tt_nstim, ps_pred_split_tt_covar)
+    if use_C_path:
+        return dict_results
+    elif window_centres is not None:
+        return dict_results[C_path[0]], window_centres
+    else:
+        return dict_results[C_path[0]]
 
 
 def get_acc_array(pred_dict, decoder_name='hit/cr', covar_name=None, tt='hit', region='s1',
@@ -2206,13 +2970,13 @@ def select_cells_and_frames(lm, region='s1', frames='pre'):
     return flu
 
 def get_covariates(lm, region, match_tnums=False, prereward=False, hitmiss_only=False,
-                    filter_150=False):
+                    filter_150=False, use_store=True):
     
     covariate_dict, y = lm.prepare_data(frames='all', model='partial', n_comps_include=0,
                                         outcomes=(['hit', 'miss'] if hitmiss_only else np.unique(lm.session.outcome)), 
                                         prereward=prereward,
                                         region=region, return_matrix=False,
-                                        remove_easy=filter_150)
+                                        remove_easy=filter_150, use_store=use_store)
     # if prereward is False:
     #     assert (np.where(np.isin(lm.session.outcome, ['hit', 'miss']))[0] == covariate_dict['trial_number_original']).all()
     covariate_dict['y'] = y
@@ -2231,14 +2995,17 @@ def get_covariates(lm, region, match_tnums=False, prereward=False, hitmiss_only=
     
     return covariate_dict
 
-def add_vcr_to_lm(lm_list, hard_reset=True, zscore=True):
+def add_vcr_to_lm(lm_list, hard_reset=True, zscore=True, use_store=True):
+    '''Add variance of cell rates (VCR) of S1 and S2 of every trial to linear_model.session.cov_dict
+    (and cov_dict_reward_only). If use_store, covariates are loaded from the covariate store 
+    (see linear_model.CovariateStore) when they have been computed before.'''
     for ilm, linear_model in tqdm(enumerate(lm_list)):
         if (hard_reset is True) or ((hard_reset is False) and (hasattr(linear_model.session, 'cov_dict') is False)):  # make dict:
             linear_model.session.cov_dict = {}
             linear_model.session.cov_dict_reward_only = {}
         for reg in ['s1', 's2']:
             ## Regular trials:
-            cov_dict = get_covariates(linear_model, reg)
+            cov_dict = get_covariates(linear_model, reg, use_store=use_store)
             tmp_arr = np.zeros(len(linear_model.session.outcome)) + np.nan 
             if zscore:
                 tmp_arr[cov_dict['trial_number_original']] = scipy.stats.zscore(cov_dict['variance_cell_rates'])
@@ -2247,7 +3014,7 @@ def add_vcr_to_lm(lm_list, hard_reset=True, zscore=True):
             linear_model.session.cov_dict['variance_cell_rates_' + reg] = copy.deepcopy(tmp_arr)
 
             ## Reward only trials:
-            cov_dict = get_covariates(linear_model, reg, prereward=True)
+            cov_dict = get_covariates(linear_model, reg, prereward=True, use_store=use_store)
             tmp_arr = np.zeros(linear_model.session.pre_rew_trials.shape[1]) + np.nan 
             if zscore:
                 tmp_arr[cov_dict['trial_number_original']] = scipy.stats.zscore(cov_dict['variance_cell_rates'])
@@ -2486,6 +3253,37 @@ def log_reg_covars(covar_dict, list_x_var=['mean_pre', 'corr_pre', 'variance_cel
             
     return mean_pred_dict, var_pred_dict
 
+def create_sliding_time_windows(time_array, window_length=0.5, stride=None, min_time=None, max_time=None):
+    """Sliding time windows of window_length seconds, with a new window every stride seconds (default: 
+    window_length, ie non-overlapping windows), over the time points of time_array (eg tp_dict['mutual']) 
+    between min_time and max_time. Windows that contain a gap in time_array (eg the PS artefact) are skipped.
+    Decode with train_test_all_sessions_multi_tp(time_array=windows) (or compute_prediction_time_array_average_per_mouse_split()
+    with window_length & window_stride), which computes all window means at once (see get_window_means()).
+
+    Returns
+    -------
+    windows : list of np.arrays
+        time points per window
+    window_centres : np.array
+        centre time per window
+    """
+    time_array = np.sort(time_array)
+    if min_time is not None:
+        time_array = time_array[time_array >= min_time]
+    if max_time is not None:
+        time_array = time_array[time_array <= max_time]
+    dt = np.median(np.diff(time_array))
+    n_window = int(np.round(window_length / dt))
+    n_stride = n_window if stride is None else int(np.round(stride / dt))
+    assert n_window >= 1 and n_stride >= 1, f'window length ({window_length}s) and stride ({stride}s) must be at least 1 frame ({dt}s)'
+    windows = []
+    for i_start in range(0, len(time_array) - n_window + 1, n_stride):
+        window = time_array[i_start:(i_start + n_window)]
+        if np.all(np.diff(window) < 1.5 * dt):  # no gap in window
+            windows.append(window)
+    window_centres = np.array([np.mean(window) for window in windows])
+    return windows, window_centres
+
 def create_large_time_windows_for_decoders(tp_dict, n_window=60, min_time = -2.5, max_time=None,   
                                            pre_stim_art_time=-0.07, post_stim_art_time=0.35,
                                            verbose=0):
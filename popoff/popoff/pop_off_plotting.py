@@ -782,7 +782,7 @@ def plot_single_cell_all_trials(session, n=0, start_time=-4, stim_window=0.35,
     ax[1][2].axis('off')
     ax[1][2].text(s=f'Traces smoothed with {2 * osws + 1}-frames window', x=0, y=0.5)
     ax[1][2].text(s=f'Cell ID: {n}, session {str(session)}, Suite-2P ID {session.suite2p_id[n]}', x=-0.2, y=0.8, fontdict={'weight': 'bold'})
-    ax[1][2].text(s=f'This cell was targeted {int(np.sum(np.mean(session.is_target[n, :, :], 1)))} times', x=0, y=0.2)
+    ax[1][2].text(s=f'This cell was targeted {int(np.sum(session.get_is_target_2d()[n, :]))} times', x=0, y=0.2)
 
 
 def sort_data_matrix(data, session=None, reg=None, sorting_method='euclidean'):
@@ -800,7 +800,7 @@ def sort_data_matrix(data, session=None, reg=None, sorting_method='euclidean'):
         assert len(arg_max_pos) == data.shape[0]
         sorting = np.argsort(arg_max_pos)
     elif sorting_method == 'n_targeted':
-        neuron_targ = np.mean(session.is_target, (1, 2))
+        neuron_targ = np.mean(session.get_is_target_2d(), 1)
         if reg == 's1':
             assert np.sum(session.s1_bool) == data.shape[0]
             neuron_targ_reg = neuron_targ[session.s1_bool]  # select region
@@ -819,11 +819,107 @@ def sort_data_matrix(data, session=None, reg=None, sorting_method='euclidean'):
         sorting = np.argsort(sum_data)[::-1]
     return sorting
 
+NORM_RASTER_CACHE_SIZE = 2  # max number of (normalisation frames) entries in cache per session, least recently used is dropped
+
+def clear_normalised_raster_cache(session):
+    '''Remove all cached normalised tensors of session (see normalise_raster_data()).
+    Only required if session.behaviour_trials or session.pre_rew_trials are modified in place,
+    reassignment of these arrays is detected automatically. Also removes the z-score statistics 
+    and frame cumulative sums that were derived from these tensors (see pof.get_zscore_statistics() 
+    and pof.get_frame_cumsum()).'''
+    if hasattr(session, '_norm_raster_cache'):
+        del session._norm_raster_cache
+    if hasattr(session, '_zscore_stats_cache'):
+        del session._zscore_stats_cache
+    if hasattr(session, '_frame_cumsum_cache'):
+        del session._frame_cumsum_cache
+
+def get_normalised_raster_tensors(session, start_frame, end_frame, start_baseline_frame,
+                                  pre_stim_frame, filter_150_stim=False, baseline_by_prestim=True,
+                                  use_cache=True):
+    '''Return baseline-subtracted & time-cropped behaviour and pre-reward tensors of session.
+
+    The result is stored per session (in session._norm_raster_cache), keyed on the normalisation frames,
+    so that repeated calls (eg by train_test_all_sessions() for every time point and region) do not
+    recompute the full tensors. The cache is reset when session.behaviour_trials, session.pre_rew_trials
+    (or session.photostim if filter_150_stim) are reassigned or change shape. Cached arrays are read-only.
+    At most NORM_RASTER_CACHE_SIZE entries (full tensor pairs) are kept per session (least recently used is dropped).
+
+    Parameters
+    ----------
+    session : Session
+        session to normalise
+    start_frame, end_frame : int
+        first and last (exclusive) frame to return
+    start_baseline_frame, pre_stim_frame : int
+        baseline period used for subtraction
+    filter_150_stim : bool, default=False
+        if True, discard trials with 150 cells stimulated
+    baseline_by_prestim : bool, default=True
+        if True, subtract mean pre-stim activity per neuron & trial
+    use_cache : bool, default=True
+        if False, always recompute (and do not store result)
+
+    Returns
+    -------
+    data_use_mat_norm : np.array
+        normalised behaviour_trials (n_neurons x n_trials x n_frames)
+    data_spont_mat_norm : np.array
+        normalised pre_rew_trials (n_neurons x n_trials x n_frames)
+    '''
+    source_arrays = [session.behaviour_trials, session.pre_rew_trials]
+    if filter_150_stim:
+        source_arrays.append(session.photostim)
+    cache_key = (int(start_frame), int(end_frame), int(start_baseline_frame), int(pre_stim_frame),
+                 filter_150_stim, baseline_by_prestim)
+
+    if use_cache:
+        if not hasattr(session, '_norm_raster_cache'):
+            session._norm_raster_cache = {}
+        cache = session._norm_raster_cache
+        if cache_key in cache:
+            cached_sources, cached_shapes, cached_result = cache[cache_key]
+            if (len(cached_sources) == len(source_arrays) and 
+                    np.all([x is y for x, y in zip(cached_sources, source_arrays)]) and 
+                    cached_shapes == [x.shape for x in source_arrays]):
+                cache[cache_key] = cache.pop(cache_key)  # move to end (most recently used)
+                return cached_result
+            else:  # trial arrays have changed, so all entries are invalid
+                cache.clear()
+
+    if filter_150_stim:  # discard 150 cells if necessary
+        data_use_mat = session.behaviour_trials[:, session.photostim < 2, :]
+    else:
+        data_use_mat = session.behaviour_trials
+    data_spont_mat = session.pre_rew_trials
+
+    if baseline_by_prestim:
+        data_use_mat_norm = data_use_mat - np.mean(data_use_mat[:, :, start_baseline_frame:pre_stim_frame], 2)[:, :, None]  # normalize by pre-stim activity per neuron
+        # data_use_mat_norm = data_use_mat - np.mean(data_use_mat[:, :, start_baseline_frame:pre_stim_frame], (0, 2))[None, :, None]  # normalize by pre-stim activity averaged across neurons
+        data_spont_mat_norm = data_spont_mat - np.mean(data_spont_mat[:, :, start_baseline_frame:pre_stim_frame], 2)[:, :, None]
+    else:
+        print('WARNING: not normalized')
+        data_use_mat_norm = data_use_mat #- np.mean(data_use_mat[:, :, start_baseline_frame:pre_stim_frame], 2)[:, :, None]  # normalize by pre-stim activity per neuron
+        data_spont_mat_norm = data_spont_mat #- np.mean(data_spont_mat[:, :, start_baseline_frame:pre_stim_frame], 2)[:, :, None]
+
+    data_use_mat_norm = data_use_mat_norm[:, :, start_frame:end_frame]  # discarded pre -4 seconds
+    data_spont_mat_norm = data_spont_mat_norm[:, :, start_frame:end_frame]
+
+    if use_cache:
+        data_use_mat_norm.setflags(write=False)  # protect cache against in-place changes by callers
+        data_spont_mat_norm.setflags(write=False)
+        while len(session._norm_raster_cache) >= NORM_RASTER_CACHE_SIZE:  # drop least recently used entries
+            session._norm_raster_cache.pop(next(iter(session._norm_raster_cache)))
+        session._norm_raster_cache[cache_key] = (source_arrays, [x.shape for x in source_arrays],
+                                                 (data_use_mat_norm, data_spont_mat_norm))
+    return data_use_mat_norm, data_spont_mat_norm
+
 def normalise_raster_data(session, start_time=-2, start_baseline_time=-2.1, end_time=4.1,
                           pre_stim_window=-0.07, post_stim_window=None, filter_150_stim=False,
                           sorting_method='euclidean', sort_tt_list=['hit', 'miss', 'spont'],
-                          sort_neurons=True, baseline_by_prestim=True):
-    '''overrides session.outcome with ARM and URH types!!'''
+                          sort_neurons=True, baseline_by_prestim=True, use_cache=True):
+    '''overrides session.outcome with ARM and URH types!!
+    Normalised tensors are cached per session, see get_normalised_raster_tensors()'''
     if post_stim_window is None:
         if filter_150_stim:
             post_stim_window = 0.83
@@ -841,25 +937,11 @@ def normalise_raster_data(session, start_time=-2, start_baseline_time=-2.1, end_
     time_tick_labels = [str(np.round(x, 1)) for x in session.filter_ps_time[start_frame:][time_ticks]]
     # print(start_frame, start_baseline_frame, pre_stim_frame, pre_stim_frame - start_frame, post_stim_frame)
 
-    ## Sort neurons by pearosn corr of post-stim response of sort_tt_list
-    if filter_150_stim:  # discard 150 cells if necessary
-        data_use_mat = session.behaviour_trials[:, session.photostim < 2, :]
-    else:
-        data_use_mat = session.behaviour_trials
-    data_spont_mat = session.pre_rew_trials
-
-    if baseline_by_prestim:
-        data_use_mat_norm = data_use_mat - np.mean(data_use_mat[:, :, start_baseline_frame:pre_stim_frame], 2)[:, :, None]  # normalize by pre-stim activity per neuron
-        # data_use_mat_norm = data_use_mat - np.mean(data_use_mat[:, :, start_baseline_frame:pre_stim_frame], (0, 2))[None, :, None]  # normalize by pre-stim activity averaged across neurons
-        data_spont_mat_norm = data_spont_mat - np.mean(data_spont_mat[:, :, start_baseline_frame:pre_stim_frame], 2)[:, :, None]
-    else:
-        print('WARNING: not normalized')
-        data_use_mat_norm = data_use_mat #- np.mean(data_use_mat[:, :, start_baseline_frame:pre_stim_frame], 2)[:, :, None]  # normalize by pre-stim activity per neuron
-        data_spont_mat_norm = data_spont_mat #- np.mean(data_spont_mat[:, :, start_baseline_frame:pre_stim_frame], 2)[:, :, None]
-
-
-    data_use_mat_norm = data_use_mat_norm[:, :, start_frame:end_frame]  # discarded pre -4 seconds
-    data_spont_mat_norm = data_spont_mat_norm[:, :, start_frame:end_frame]
+    ## Baseline-subtract & crop (cached per session):
+    data_use_mat_norm, data_spont_mat_norm = get_normalised_raster_tensors(session=session, start_frame=start_frame, end_frame=end_frame,
+                                                                           start_baseline_frame=start_baseline_frame, pre_stim_frame=pre_stim_frame,
+                                                                           filter_150_stim=filter_150_stim, baseline_by_prestim=baseline_by_prestim,
+                                                                           use_cache=use_cache)
     # start_baseline_frame = start_baseline_frame - start_frame  # correct for cutting off data at start_frame
     # pre_stim_frame = pre_stim_frame - start_frame
     post_stim_frame = post_stim_frame - start_frame
@@ -988,21 +1070,19 @@ def plot_single_raster_plot(data_mat, session, ax=None, cax=None, reg='S1', tt='
             reg_bool = session.s1_bool
         elif reg == 'S2':
             reg_bool = session.s2_bool
-        assert len(np.unique(session.is_target.mean((0, 1)))) == 1  # same for all time points
+        target_mat = session.get_is_target_2d()  # [n_cells x n_trials]
         if filter_150_artefact:  # 150 not included
-            target_mat = session.is_target[:, session.photostim < 2, :]
-        else:
-            target_mat = session.is_target
+            target_mat = target_mat[:, session.photostim < 2]
         if spec_target_trial is None: 
             if target_tt_specific:  # get hit/miss specific targets
                 if filter_150_artefact:
                     tt_spec_arr = session.outcome[session.photostim < 2] == tt
                 else:
                     tt_spec_arr = session.outcome == tt
-                target_mat = target_mat[:, tt_spec_arr, :]
-            neuron_targ = np.mean(target_mat, (1, 2))
+                target_mat = target_mat[:, tt_spec_arr]
+            neuron_targ = np.mean(target_mat, 1)
         else:
-            neuron_targ = np.mean(target_mat, 2)
+            neuron_targ = target_mat.astype('float')
             neuron_targ = neuron_targ[:, spec_target_trial]
         neuron_targ_reg = neuron_targ[reg_bool]  # select region
         if reg == 'S1':
@@ -3362,16 +3442,16 @@ def get_plot_trace(lm, ax=None, targets=False, region='s1',
     if color_dict is None:
         color_dict = color_dict_stand
     if targets:
-        mask = ~lm.session.is_target  # flip bool (with ~) because np.ma.array later only saves False, and masks True
+        mask = ~lm.session.get_is_target_2d()  # flip bool (with ~) because np.ma.array later only saves False, and masks True
     else:
-        mask = lm.session.is_target
+        mask = lm.session.get_is_target_2d()
 
     (data_use_mat_norm, data_use_mat_norm_s1, data_use_mat_norm_s2, data_spont_mat_norm, ol_neurons_s1, ol_neurons_s2, outcome_arr,
         time_ticks, time_tick_labels, time_axis) = normalise_raster_data(session=lm.session,
                                     filter_150_stim=False, 
                                     sort_neurons=False, end_time=6, baseline_by_prestim=baseline_by_prestim)
 
-    mask = mask[lm.region_map[region], :, :]
+    mask = mask[lm.region_map[region], :]
     if region == 's1':
         flu = data_use_mat_norm_s1
     elif region == 's2':
@@ -3383,9 +3463,7 @@ def get_plot_trace(lm, ax=None, targets=False, region='s1',
     if verbose > 0:
         print(lm.session.outcome[stim_idx])
     flu = flu[:, stim_idx, :]
-    mask = mask[:, stim_idx, :]
-
-    mask = np.mean(mask, 2)
+    mask = mask[:, stim_idx]
     mask = np.repeat(mask[:, :, None], flu.shape[2], axis=2)
 
     # Fluoresence averaged across cells with (non)targets filtered
@@ -33,6 +33,16 @@ sys.path.append(os.path.join(path_to_vape, 'jupyter'))
 sys.path.append(os.path.join(path_to_vape, 'utils'))
 
 import numpy as np
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:  # numpy < 1.20 (requirements.txt)
+    from numpy.lib.stride_tricks import as_strided
+    def sliding_window_view(x, window_shape, axis):
+        """Read-only view of all windows of length window_shape along axis (last dimension of the output)."""
+        shape = list(x.shape)
+        shape[axis] = x.shape[axis] - window_shape + 1
+        return as_strided(x, shape=tuple(shape) + (window_shape,), strides=x.strides + (x.strides[axis],),
+                          writeable=False)
 from tqdm import tqdm
 import copy
 import matplotlib.pyplot as plt
@@ -45,6 +55,9 @@ from subsets_analysis import Subsets
 import pickle
 import sklearn.decomposition
 from cycler import cycler
+from Session import (set_trial_tensors_dtype, get_trial_frames_single, get_trial_frames_matrix,  # shared with Session.py
+                     build_flu_array_single, map_cells, _deconvolve_cell, S1S2_BORDER_PATH, 
+                     load_s1s2_borders, get_roi_centroids, get_s2_bool)
 
 # OASIS gives a useless warning
 import warnings
@@ -56,110 +69,6 @@ warnings.simplefilter("ignore", UserWarning)
 plt.rcParams['axes.prop_cycle'] = cycler(color=sns.color_palette('colorblind'))
 
 
-def get_trial_frames_single(clock, start, pre_frames, post_frames, fs=30, paq_rate=20000):
-    """Get frames that indicate trial start.
-
-    Parameters:
-    ----------------
-        clock: ??
-            ??
-        start: ??
-            ??
-        pre_frames: int
-            number of frames before stim to include in trial
-        post_frames: int
-            number of frames after stim to include in trial
-        fs: int, default=30
-            frame rate of imaging
-        paq_rate: int, default=20000
-            ??
-
-    Returns:
-    ---------------
-        trial_frames: ??
-            ??
-    """
-    # the frames immediately preceeding stim
-    frame_idx = utils.closest_frame_before(clock, start)
-    trial_frames = np.arange(frame_idx-pre_frames, frame_idx+post_frames)
-
-    # is the trial outside of the frame clock
-    is_beyond_clock = np.max(trial_frames) >= len(clock) or np.min(trial_frames) < 0
-
-    if is_beyond_clock:
-        return None
-
-    frame_to_start = (start - clock[frame_idx]) / paq_rate  # time (s) from frame to trial_start
-    frame_time_diff = np.diff(clock[trial_frames]) / paq_rate  # ifi (s)
-
-    # did the function find the correct frame
-    is_not_correct_frame = clock[frame_idx+1]  < start or clock[frame_idx] > start
-    # the nearest frame to trial start was not during trial
-    trial_not_running = frame_to_start > 1/fs
-    #
-    frames_not_consecutive = np.max(frame_time_diff) > 1/(fs-1)
-
-    if trial_not_running or frames_not_consecutive:
-        return None
-    return trial_frames
-
-
-def build_flu_array_single(run, use_spks=False, prereward=False, pre_frames=30, post_frames=80, fs=30):
-    ''' Build an trial by trial fluoresence array of shape [n_cells x n_frames x n_trials].
-
-    Parameters:
-    ---------------
-        run: run object
-            run object containing data
-        pre_frames: int, default=30
-            number of frames before stim to include in trial
-        post_frames: int, default=80
-            number of frames after stim to include in trial
-        fs: int, default=30
-            frame rate of imaging
-
-    Returns:
-    ---------------
-        flu_array: 3D np.array
-            matrix of fluorescence data
-    '''
-
-    if not use_spks:
-        flu = run.flu
-    else:
-        flu = run.spks
-
-    # the frames that were actually imaged and the time (samples) that they occured
-    clock = run.paqio_frames
-
-    if prereward:
-        # Time of prereward trial starts in paq samples
-        trial_start = run.prereward_aligner.A_to_B(run.pre_reward)
-    else:
-        # Times of main behaviour trial start in paq samples
-        trial_start = run.spiral_start
-        # check that the number of trial starts detected by x galvo thresholding
-        # matches the number of trials reported by pycontrol
-        assert len(trial_start) == len(run.trial_start)
-
-    for i, start in enumerate(trial_start):
-
-        trial_frames = get_trial_frames_single(clock, start, pre_frames, post_frames)
-
-        if trial_frames is None:
-            flu_trial = np.full([flu.shape[0], pre_frames+post_frames], np.nan)
-        else:
-            flu_trial = flu[:, trial_frames]
-
-        if i == 0:
-            flu_array = flu_trial
-        else:
-
-            flu_array = np.dstack((flu_array, flu_trial))
-
-
-    return np.swapaxes(flu_array,2,1)
-
 def get_bad_frames(run, fs=30):    
 
     # Give it a three frame buffer pre-stim
@@ -170,20 +79,12 @@ def get_bad_frames(run, fs=30):
     paqio_frames = utils.tseries_finder(run.num_frames, run.frame_clock)
     trial_start = utils.get_spiral_start(run.x_galvo_uncaging, run.paq_rate*6)
 
-    bad_frames = []
-    trial_starts = []
-    for i, start in enumerate(trial_start):
-        
-        frames, start_idx = utils.get_trial_frames(paqio_frames, start, 
-                                                   pre_frames, post_frames, 
-                                                   paq_rate=run.paq_rate, 
-                                                   fs=fs)
-        trial_starts.append(start_idx)
-        bad_frames.append(frames)
-
-
-    flattened = [bf for bf in bad_frames if bf is not None]
-    flattened = [item for sublist in flattened for item in sublist]
+    trial_frames, valid_trials = get_trial_frames_matrix(paqio_frames, trial_start, 
+                                                         pre_frames, post_frames, 
+                                                         fs=fs, paq_rate=run.paq_rate)
+    # None for rejected trials
+    bad_frames = [frames if valid else None for frames, valid in zip(trial_frames, valid_trials)]
+    trial_starts = [frames[pre_frames] if valid else None for frames, valid in zip(trial_frames, valid_trials)]
 
 
     return trial_starts, bad_frames
@@ -194,19 +95,12 @@ def fill_nan(A):
     '''
     inds = np.arange(A.shape[0])
     good = np.where(np.isfinite(A))
-    f = interpolate.interp1d(inds[good], A[good],bounds_error=False)
-    B = np.where(np.isfinite(A),A,f(inds))
+    B = np.where(np.isfinite(A), A, np.interp(inds, inds[good], A[good], left=np.nan, right=np.nan))
     return B
 
-def artifact_suppress(run, set_to=0, copy_run=False, interpolate=False, plot=False):
-
-    if interpolate:
-        set_to = np.nan
-
+def get_artifact_frames(run):
+    """Sorted indices of all photostim artefact frames of run (identical for all cells), and frame rate."""
     if run.mouse_id == 'J048' or run.mouse_id == 'RL048':
-
-        print('got a 5 here boi')
-
         fs = 5
         #ssf = uf.stim_start_frame_mat(run.trial_start, run.frames_ms)
         ssf = uf.stim_start_frame_mat(run.aligner.B_to_A(run.spiral_start), run.frames_ms)
@@ -215,84 +109,129 @@ def artifact_suppress(run, set_to=0, copy_run=False, interpolate=False, plot=Fal
 
         pre_frames = 2 #math.ceil(1*fs)
         post_frames = 6 #math.ceil(1*fs)
-
-        bad_frames = []
-
-        for stim in stim_start:
-            bad_frames.append(np.arange(stim-pre_frames, stim+post_frames))
-
-        bad_frames = np.concatenate(bad_frames).astype('int')
-
-        if not copy_run:
-            run.flu[:, bad_frames] = set_to
-
-            if interpolate:
-                run.flu = fill_nan(run.flu)
-
-            arr = uf.build_flu_array(run, run.trial_start)
-
-        else:
-            run_copy = copy.deepcopy(run)
-            run_copy.flu[:, bad_frames] = set_to
-
-            if interpolate:
-                run_copy.flu = np.array([fill_nan(f) for f in run_copy.flu])
-
-            #arr = uf.build_flu_array(run_copy, run_copy.trial_start)
-            arr = uf.build_flu_array(run_copy, run_copy.aligner.B_to_A(run.spiral_start))
-
+        bad_frames = (stim_start[:, np.newaxis] + np.arange(-pre_frames, post_frames)).ravel().astype('int')
     else:
-        print('oooh 30 here we go')
         fs = 30
-        trial_starts, bad = get_bad_frames(run)
-        bad = [b for b in bad if b is not None]
-        bad = np.concatenate(bad)
-
-        run.flu[:, bad] = set_to
+        trial_starts, bad = get_bad_frames(run, fs=fs)
+        bad_frames = np.concatenate([b for b in bad if b is not None])
+    return np.unique(bad_frames), fs
+
+def mask_frames(flu, frames, set_to=0, interpolate=False, inplace=False):
+    """Set frames (indices, identical for all cells) of flu (n_cells x n_frames) to set_to, 
+    or linearly interpolate them from the nearest good frames (NaN outside the range of good 
+    frames, as fill_nan()). As the gaps are identical for all cells, the interpolation weights are 
+    computed once and all cells are interpolated at once. Cells with other non-finite values 
+    are interpolated separately with fill_nan().
+
+    Works on flu in place if inplace, otherwise on a copy of flu (float)."""
+    if not inplace:
+        flu = np.array(flu, dtype=(flu.dtype if np.issubdtype(flu.dtype, np.floating) else np.float64))
+    frames = np.unique(frames)
+    if not interpolate:
+        flu[:, frames] = set_to
+        return flu
+
+    n_frames = flu.shape[1]
+    good_frames = np.setdiff1d(np.arange(n_frames), frames)
+    i_right = np.searchsorted(good_frames, frames)  # first good frame after every bad frame
+    in_range = np.logical_and(i_right > 0, i_right < len(good_frames))
+    left = good_frames[np.clip(i_right - 1, 0, len(good_frames) - 1)]
+    right = good_frames[np.clip(i_right, 0, len(good_frames) - 1)]
+    weight = np.where(in_range, (frames - left) / np.maximum(right - left, 1), 0)
+    cells_other_nan = ~np.all(np.isfinite(flu[:, good_frames]), axis=1)
+    flu[:, frames] = (1 - weight) * flu[:, left] + weight * flu[:, right]
+    flu[:, frames[~in_range]] = np.nan
+    for i_cell in np.where(cells_other_nan)[0]:  # gaps differ from other cells
+        flu[i_cell, frames] = np.nan
+        flu[i_cell] = fill_nan(flu[i_cell])
+    return flu
 
-        if interpolate:
-            run.flu = np.array([fill_nan(f) for f in run.flu])
-
-        arr  = build_flu_array_single(run)
+def artifact_suppress(run, set_to=0, copy_run=False, interpolate=False, plot=False):
+    """Mask (set to set_to, or interpolate) photostim artefact frames of run.flu. 
+    If copy_run, run.flu is unchanged and a masked copy of run.flu is returned (the rest
+    of run is not copied). Otherwise run.flu is masked in place and returned."""
+    bad_frames, fs = get_artifact_frames(run)
+    flu = mask_frames(run.flu, bad_frames, set_to=set_to, interpolate=interpolate, inplace=not copy_run)
+    if not copy_run:
+        run.flu = flu
 
     if plot:
+        run_masked = copy.copy(run)  # shallow copy, only flu differs
+        run_masked.flu = flu
+        if fs == 5:
+            arr = uf.build_flu_array(run_masked, (run.aligner.B_to_A(run.spiral_start) if copy_run else run.trial_start))
+        else:
+            arr = build_flu_array_single(run_masked)
         plt.plot(np.nanmean(arr, (0,1)), '.')
         #plt.ylim((-0.01, 0.15))
 
-    return run.flu
+    return flu
+
+def spike_triggered_averages(dff, spks, theta, window=5*30):
+    """Spike triggered average of dff, triggered on frames where spks > theta, for one cell 
+    (dff and spks of shape (n_frames,)) or for all cells at once (shape (n_cells, n_frames)). 
+    Spikes that are within window frames of the end of the recording count as zero traces.
+    The triggered traces are summed with a masked sum over a sliding window view of dff,
+    so without copying traces per spike."""
+    single_cell = np.ndim(dff) == 1
+    dff, spks = np.atleast_2d(dff), np.atleast_2d(spks)
+    n_frames = dff.shape[1]
+    spike_mask = spks > theta
+    n_spks = np.sum(spike_mask, axis=1)
+    n_trigger = max(n_frames - window, 0)  # spikes that have a full window (spike + window < n_frames)
+    if n_trigger > 0:
+        windows = sliding_window_view(dff, window, axis=1)[:, :n_trigger]  # n_cells x n_trigger x window (view)
+        triggered_sum = np.einsum('ct,ctw->cw', spike_mask[:, :n_trigger].astype(dff.dtype), windows)
+    else:
+        triggered_sum = np.zeros((dff.shape[0], window))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        triggered_average = triggered_sum / n_spks[:, np.newaxis]
+    triggered_average = np.nan_to_num(triggered_average, nan=0, posinf=0, neginf=0)
+    return triggered_average[0] if single_cell else triggered_average
 
-def calc_spikeTriggeredAverage(dff, spks, theta, tau, fs, window=5*30):
-    spks_idx = np.where(spks > theta)[0]
-    n_spks = spks_idx.shape[0]
-    triggered_dff = np.zeros((n_spks,window))
-    for i in range(n_spks):
-        if spks_idx[i]+window < dff.shape[0]:
-            triggered_dff[i] = dff[spks_idx[i]:spks_idx[i]+window]
-    triggered_average = np.nan_to_num(np.average(triggered_dff, axis=0), nan=0, 
-            posinf=0, neginf=0)
-    
+def _fit_spikeTriggeredAverage(triggered_average, tau, fs, window=5*30):
     fit_func = lambda t,A,c: A*np.exp(-t/(fs*tau/1000)) + c
     try:
         popt, pcov = curve_fit(fit_func, np.arange(window), triggered_average)
     except:
         popt, pcov = (np.zeros(2), np.zeros((2,2)))
-    return triggered_average, popt, np.diagonal(pcov)
+    return popt, np.diagonal(pcov)
 
-
-def fit_tau(act, fs, numboot = 100, k_arr = None, method='sm'):
-    print("act")
-    print(act)
-    print("k arr")
-    print(k_arr) 
+def calc_spikeTriggeredAverage(dff, spks, theta, tau, fs, window=5*30):
+    triggered_average = spike_triggered_averages(dff, spks, theta, window=window)
+    popt, pcov = _fit_spikeTriggeredAverage(triggered_average, tau, fs, window=window)
+    return triggered_average, popt, pcov
+
+def calc_spikeTriggeredAverage_cells(dff, spks, theta, tau, fs, window=5*30):
+    """calc_spikeTriggeredAverage() for all cells at once: dff and spks are (n_cells x n_frames), 
+    tau is an array of time scales (n_cells). Returns triggered averages (n_cells x window),
+    fitted params (n_cells x 2) and their variances (n_cells x 2)."""
+    triggered_average = spike_triggered_averages(dff, spks, theta, window=window)
+    popt, pcov = np.zeros((len(triggered_average), 2)), np.zeros((len(triggered_average), 2))
+    for i_cell in range(len(triggered_average)):
+        popt[i_cell], pcov[i_cell] = _fit_spikeTriggeredAverage(triggered_average[i_cell], tau[i_cell], 
+                                                                fs, window=window)
+    return triggered_average, popt, pcov
+
+
+def fit_tau(act, fs, numboot = 100, k_arr = None, method='sm', verbose=0):
+    """Autocorrelation time scale of act with mrestimator (coefficients & exponential offset fit).
+    Returns (tau, tau quantiles, coefficients); zeros if the fit failed. verbose > 0 prints 
+    intermediate results (note: interleaved if called from parallel processes, see map_cells())."""
+    if verbose > 0:
+        print("act")
+        print(act)
+        print("k arr")
+        print(k_arr) 
     try:
-        print("I'm the new fit_tau!")
         coeff_res = mre.coefficients(act, method, k_arr, dt=(1/fs) * 1000, 
                 numboot=100)
-        print(coeff_res)
-        print("coeff_res worked")
+        if verbose > 0:
+            print(coeff_res)
         tau_res = mre.fit(coeff_res, fitfunc='exponentialoffset', 
                 quantiles=[.125, .25, .375, .5, .625, .75, .875], numboot=10)
-        print(tau_res)
+        if verbose > 0:
+            print(tau_res)
         #print(tau_res.quantiles)
         #print(numboot)
         #print(tau_res.tauquantiles)
@@ -303,11 +242,176 @@ def fit_tau(act, fs, numboot = 100, k_arr = None, method='sm'):
         return (0, np.zeros(7), np.zeros(k_arr.shape))        
 
 
+def autocorrelation_coefficients(act, k_arr):
+    """Lagged autocorrelation coefficients of all rows (time series) of act at lags k_arr, 
+    computed at once with FFT-based correlation. Per row, as mrestimator's stationary mean 
+    method ('sm') for single-trial data: r_k = mean_t[(x_t - m)(x_t+k - m)] / mean_t[(x_t - m)^2].
+
+    Parameters
+    ----------
+    act : np.array of shape (n_series, n_frames) (or (n_frames,))
+    k_arr : np.array of int
+        lags in frames (> 0, < n_frames)
+
+    Returns
+    -------
+    coefficients : np.array of shape (n_series, len(k_arr))
+        NaN for series without variance
+    """
+    act = np.atleast_2d(act).astype(np.float64)
+    k_arr = np.asarray(k_arr)
+    n_frames = act.shape[1]
+    act = act - act.mean(axis=1, keepdims=True)
+    n_fft = 2 ** int(np.ceil(np.log2(2 * n_frames - 1)))  # zero padding to prevent circular correlation
+    act_fft = np.fft.rfft(act, n=n_fft, axis=1)
+    autocov = np.fft.irfft(act_fft * np.conj(act_fft), n=n_fft, axis=1)[:, :n_frames]  # sum over t of x_t x_t+k
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coefficients = (autocov[:, k_arr] / (n_frames - k_arr)) / (autocov[:, :1] / n_frames)
+    return coefficients
+
+def fit_exponential_offset(coefficients, steps, tau_grid=None, refine=True):
+    """Fit r(t) = A exp(-t / tau) + O to all rows of coefficients (as mrestimator's 
+    'exponentialoffset' fit). tau is first found for all rows at once on tau_grid 
+    (for which A and O follow from linear least squares), and then (if refine) refined 
+    per row with curve_fit, starting from the grid optimum.
+
+    Parameters
+    ----------
+    coefficients : np.array of shape (n_series, n_steps)
+    steps : np.array of shape (n_steps,)
+        time of lags (eg in ms)
+    tau_grid : np.array or None
+        candidate time scales (same units as steps). By default log-spaced between 
+        steps[0] / 10 and steps[-1] * 100.
+    refine : bool
+
+    Returns
+    -------
+    tau : np.array of shape (n_series,)
+        0 where the fit failed (as fit_tau())
+    """
+    coefficients = np.atleast_2d(coefficients)
+    steps = np.asarray(steps, dtype=np.float64)
+    if tau_grid is None:
+        tau_grid = np.logspace(np.log10(steps[0] / 10), np.log10(steps[-1] * 100), 400)
+    tau = np.zeros(coefficients.shape[0])
+    valid = np.all(np.isfinite(coefficients), axis=1)
+    if not np.any(valid):
+        return tau
+    coefs = coefficients[valid].T  # n_steps x n_valid
+
+    ## Grid search; A and O are solved for all series at once per tau
+    sse = np.zeros((len(tau_grid), coefs.shape[1]))
+    params = np.zeros((len(tau_grid), 2, coefs.shape[1]))
+    for i_tau, tau_candidate in enumerate(tau_grid):
+        basis = np.stack((np.exp(-steps / tau_candidate), np.ones_like(steps)), axis=1)
+        params[i_tau] = np.linalg.lstsq(basis, coefs, rcond=None)[0]
+        sse[i_tau] = np.sum((basis @ params[i_tau] - coefs) ** 2, axis=0)
+    i_best = np.argmin(sse, axis=0)
+    tau_valid = tau_grid[i_best]
+
+    if refine:
+        fit_func = lambda t, tau, A, O: A * np.exp(-t / tau) + O
+        for i_series in range(coefs.shape[1]):
+            p0 = (tau_valid[i_series], *params[i_best[i_series], :, i_series])
+            try:
+                popt = curve_fit(fit_func, steps, coefs[:, i_series], p0=p0, maxfev=1000)[0]
+            except (RuntimeError, ValueError):
+                continue  # keep grid optimum
+            if np.isfinite(popt[0]) and popt[0] > 0:
+                tau_valid[i_series] = popt[0]
+    tau[valid] = tau_valid
+    return tau
+
+def fit_tau_batch(act, fs, k_arr, refine=True):
+    """Batched alternative to fit_tau(), treating every row of act (n_series x n_frames) as 
+    single-trial data. Returns autocorrelation time scale (in ms) per row."""
+    coefficients = autocorrelation_coefficients(act, k_arr=k_arr)
+    return fit_exponential_offset(coefficients, steps=np.asarray(k_arr) * (1 / fs) * 1000, refine=refine)
+
+def check_fit_tau_batch(act, fs=30, k_arr=np.arange(1, 5*30), n_series=5, tolerance=0.05,
+                        coef_tolerance=1e-6, refine=True, seed=0, verbose=1):
+    """Regression check of fit_tau_batch() (used by Session.mre_spks()) against mrestimator's fit_tau().
+    For n_series random rows of act (eg summed spks per trial, as in mre_spks()), autocorrelation coefficients 
+    and time scales are computed with both, and compared.
+
+    Parameters
+    ----------
+    act : np.array of shape (n_series_total, n_frames)
+        time series (rows are fitted as single-trial data)
+    fs : int, default=30
+        sampling rate
+    k_arr : np.array, default=np.arange(1, 150)
+        lags in frames (as mre_spks())
+    n_series : int, default=5
+        number of (random) rows to compare (mrestimator is slow)
+    tolerance : float, default=0.05
+        maximum allowed relative difference of time scales
+    coef_tolerance : float, default=1e-6
+        maximum allowed absolute difference of autocorrelation coefficients
+    refine : bool, default=True
+        see fit_tau_batch()
+    seed : int, default=0
+        random seed for selection of rows
+    verbose : int, default=1
+        verbosiness
+
+    Returns
+    -------
+    tau_batch, tau_mre : np.arrays of shape (n_series,)
+        time scales (ms) of fit_tau_batch() and fit_tau() (0 if the fit failed)
+    passed : bool
+        True if all coefficients and time scales are within tolerance (and fits failed for the same rows)
+    """
+    act = np.atleast_2d(act)
+    inds = np.random.RandomState(seed).choice(act.shape[0], size=min(n_series, act.shape[0]), replace=False)
+    tau_batch = fit_tau_batch(act[inds], fs, k_arr=k_arr, refine=refine)
+    coefs_batch = autocorrelation_coefficients(act[inds], k_arr=k_arr)
+    tau_mre, coefs_mre = np.zeros(len(inds)), np.zeros(coefs_batch.shape)
+    for i_series, ind in enumerate(inds):
+        tau_mre[i_series], _, coefs_mre[i_series] = fit_tau(act[ind][np.newaxis, :], fs=fs, k_arr=k_arr)
+    both_fitted = np.logical_and(tau_batch > 0, tau_mre > 0)
+    same_failed = np.array_equal(tau_batch > 0, tau_mre > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_diff = np.abs(tau_batch - tau_mre)[both_fitted] / tau_mre[both_fitted]
+    max_rel_diff = np.max(rel_diff) if len(rel_diff) > 0 else 0
+    max_coef_diff = np.max(np.abs(coefs_batch - coefs_mre)[both_fitted]) if np.any(both_fitted) else 0
+    passed = bool(same_failed and max_rel_diff <= tolerance and max_coef_diff <= coef_tolerance)
+    if verbose > 0:
+        print(f'Max relative tau difference fit_tau_batch vs mrestimator: {max_rel_diff:.4f} (tolerance {tolerance}), '
+              f'max coefficient difference: {max_coef_diff:.2e} (tolerance {coef_tolerance})')
+        if not same_failed:
+            print(f'WARNING: fits failed for different series (batch: {tau_batch}, mrestimator: {tau_mre})')
+        if not passed:
+            print('WARNING: fit_tau_batch time scales are not within tolerance of mrestimator')
+    return tau_batch, tau_mre, passed
+
+def _fit_tau_cell(i_cell, arrays, fs=30):
+    """Fit timescale of (detrended) dF/F of one cell on 10 min of spont activity, see Session.mre_oasis()."""
+    reshaped_dff = arrays['dff_detrended'][i_cell].reshape((10, 60*fs))
+    fit_res = fit_tau(reshaped_dff, fs=fs, k_arr=np.arange(1,300), numboot=100)
+    arrays['tau_raw'][i_cell] = fit_res[0]
+    arrays['tau_raw_quantiles'][i_cell] = fit_res[1]
+    arrays['raw_coefficients'][i_cell] = fit_res[2]
+    arrays['g_raw'][i_cell] = np.exp(-1 / (fs * fit_res[0] / 1000))
+
+def _oasis_sta_cell(i_cell, arrays, fs=30):
+    """OASIS deconvolution of masked dF/F of one cell and its spike triggered average, see Session.mre_oasis()."""
+    c, s = oasis_nan.oasisAR1(arrays['masked_dff'][i_cell], arrays['g_raw'][i_cell])
+    arrays['spks'][i_cell] = s
+    sta, popt, pcov = calc_spikeTriggeredAverage(np.nan_to_num(arrays['dff_detrended'][i_cell]), 
+                                                 np.nan_to_num(s[:10*60*fs]),
+                                                 0.01, arrays['tau_raw'][i_cell], 
+                                                 fs, window=5*30)
+    arrays['spike_triggered_average'][i_cell] = sta
+    arrays['PCOV'][i_cell] = pcov
+    arrays['POPT'][i_cell] = popt
+
 class Session:
     """Class containing all info and data of 1 imaging session, as saved in a run.pkl file."""
     def __init__(self, mouse, run_number, pkl_path, remove_nan_trials=True,
                 pre_seconds=4, post_seconds=6, pre_gap_seconds=0.2, post_gap_seconds=0.6,
-                verbose=1, filter_threshold=10):
+                verbose=1, filter_threshold=10, dtype='float64'):
         """Initialize parameters and call all Class methods (except shuffle_labels()) to construct attributes.
 
         Parameters
@@ -331,6 +435,8 @@ class Session:
         verbose : int, default=1
             verbosiness;  1: only important info (i.e. user end); 2: all info (debug end)
         filter_threshold : int, default=10 filter neurons with mean(abs(df/f)) > filter_threshold
+        dtype : str, default='float64'
+            dtype of trial tensors (behaviour_trials, pre_rew_trials). 'float32' halves memory, see set_dtype()
         """
         self.mouse = mouse
         self.run_number = run_number
@@ -362,8 +468,13 @@ class Session:
         self.define_s1_s2()   # label s1 and s2 identity of neurons
         self.label_trials(vverbose=self.verbose)  # label trial outcomes
         self.remove_nan_trials_inplace(vverbose=self.verbose)  # remove nan traisl
+        self.set_dtype(dtype)
         delattr(self.run, 'x_galvo_uncaging')   # to free memory
 
+    def set_dtype(self, dtype='float32'):
+        """Set dtype of trial tensors, see Session.set_trial_tensors_dtype()."""
+        set_trial_tensors_dtype(self, dtype=dtype)
+
     def __str__(self):
         """Define name"""
         return self.name
@@ -408,51 +519,42 @@ class Session:
         self.outcome = self.run.outcome
         self.outcome_arr = np.unique(self.outcome)
 
-    def define_s1_s2(self, im_size=1024):  # define border (which is hard-defined at middle of image)
+    def define_s1_s2(self, im_size=1024, border_path=None):  # define border (which is hard-defined at middle of image)
         """Define S1/S2 region borders and label all neurons accordingly.
 
         Parameters:
         -------------------
             im_size: int, default=1024
                 size of imaging window in pixels. This is required because multi-plane data is saved by transposing planes +im_size pixels.
+            border_path: str or None, default=None
+                json file with S1/S2 borders of all sessions. If None, S1S2_BORDER_PATH is used.
         """
         if self.run is None:
             self.load_data()
         self.n_cells = self.run.stat.shape[0]
         assert self.n_cells == self.behaviour_trials.shape[0]
-        self.av_ypix = np.zeros(self.n_cells)
-        self.av_xpix = np.zeros(self.n_cells)
-        self.plane_number = np.zeros(self.n_cells)
-        for neuron_id in range(self.n_cells):# get mean coords of pixels per cell
-            self.av_xpix[neuron_id] = np.mean(self.run.stat[neuron_id]['xpix']) % im_size  # modulo 1024 because different planes are transposed by image size
-            self.av_ypix[neuron_id] = np.mean(self.run.stat[neuron_id]['ypix']) % im_size
-            # JR addition to deal with single plane data that has no iplane
-            try:
-                self.plane_number[neuron_id] = self.run.stat[neuron_id]['iplane']
-            except KeyError:
-                self.plane_number[neuron_id] = 0
+        self.av_xpix, self.av_ypix, self.plane_number = get_roi_centroids(self.run.stat, im_size=im_size)
 
-        with open('/home/jrowland/Documents/code/Vape/s2_position.json') as json_file:
-            s1s2_border_json = json.load(json_file)
-    
-        self.s1s2_border = s1s2_border_json[self.mouse][str(self.run_number)]
-        
-        self.s2_bool = self.av_xpix > self.s1s2_border
+        # This will either be a scalar -> the x coord of a vertical line separating S1 and S2,
+        # or a vector describing a non straight line, in the format [x1,y1,x2,y2]
+        self.s1s2_border = load_s1s2_borders(border_path).get(self.mouse, {}).get(str(self.run_number))
+        assert self.s1s2_border is not None, f'no S1/S2 border of mouse {self.mouse}, run {self.run_number} in {border_path or S1S2_BORDER_PATH}'
+        self.s2_bool = get_s2_bool(self.av_xpix, self.av_ypix, self.s1s2_border)
         self.s1_bool = np.logical_not(self.s2_bool)
 
 
-    def run_oasis(self):
-        """ Build spks array using Oasis deconvolution https://github.com/j-friedrich/OASIS """
+    def run_oasis(self, n_workers=1, chunk_size=None):
+        """ Build spks array using Oasis deconvolution https://github.com/j-friedrich/OASIS 
+        Cells are deconvolved in n_workers parallel processes if n_workers > 1 (see map_cells())."""
 
         flu = self.flu.astype('float64')
 
         denoised_flu = np.empty_like(flu)
         deconved = np.empty_like(flu)
 
-        for idx, cell in enumerate(tqdm(flu)):
-            c, s, b, g, lam = deconvolve(cell, penalty=0)
-            denoised_flu[idx, :] = c
-            deconved[idx, :] = s
+        map_cells(_deconvolve_cell, arrays_in={'flu': flu},
+                  arrays_out={'denoised_flu': denoised_flu, 'deconved': deconved},
+                  n_workers=n_workers, chunk_size=chunk_size)
 
         self.run.flu = deconved  # Come up with a more elegant solution to this
         self.deconved = deconved
@@ -602,7 +704,7 @@ class Session:
             self.autorewarded = self.autorewarded[self.nonnan_trials]
             self.unrewarded_hits = self.unrewarded_hits[self.nonnan_trials]
 
-            self.is_target = self.is_target[:, self.nonnan_trials, :]
+            self.is_target = self.is_target[:, self.nonnan_trials, ...]
             self.n_trials = len(self.nonnan_trials)
 
         if spks:
@@ -639,23 +741,38 @@ class Session:
     def get_targets(self):
         
         gt = rf.GetTargets(self.run)
+        # [n_cells x n_trials]; use get_is_target_3d() for a mask of behaviour_trials
         self.is_target = gt.is_target
-        self.is_target = np.repeat(self.is_target[:, :, np.newaxis], self.n_times, axis=2)
         # Was a cell targeted on any trial?
-        ever_targeted = np.any(self.is_target, axis=(1,2))
+        ever_targeted = np.any(self.is_target, axis=1)
         # Check that all targets are in s1
         for target, s1 in zip(ever_targeted, self.s1_bool):
             if target:
                 assert s1
 
+    def get_is_target_2d(self):
+        """Return is_target as [n_cells x n_trials] boolean matrix 
+        (also for sessions that were saved with the former 3D is_target)."""
+        if self.is_target.ndim == 3:
+            return self.is_target[:, :, 0]
+        return self.is_target
+
+    def get_is_target_3d(self):
+        """Return is_target as [n_cells x n_trials x n_times] boolean mask, for masking 
+        behaviour_trials. This is a read-only broadcast view (identical along time axis), copy if needed."""
+        is_target = self.get_is_target_2d()
+        return np.broadcast_to(is_target[:, :, np.newaxis], is_target.shape + (self.n_times,))
+
 
 class SessionLite(Session):
     ''' Does the same job as Session, using inheritence out of laziness to not combine 
-        todo -- combine classes '''
+        todo -- combine classes 
+        n_workers: number of parallel processes for per-cell deconvolution (see Session.mre_oasis()) 
+        dtype: dtype of trial tensors (see Session.set_dtype()) '''
 
     def __init__(self, mouse, run_number, pkl_path, flu_flavour, remove_nan_trials=True,
                 pre_seconds=4, post_seconds=6, pre_gap_seconds=0.2, post_gap_seconds=0.6,
-                verbose=1, filter_threshold=10):
+                verbose=1, filter_threshold=10, n_workers=1, dtype='float64'):
 
         self.mouse = mouse
         self.run_number = run_number
@@ -720,7 +837,7 @@ class SessionLite(Session):
         print("hey ML")
         print(self.photostim)
         #self.flu_spont = np.copy(self.flu[:,10*60*30])
-        self.mre_oasis()
+        self.mre_oasis(n_workers=n_workers)
         self.spont_spks = np.copy(self.run.spks[:,:10*60*30])
         print("self.spont_spks.shape")
         print(self.spont_spks.shape)
@@ -734,6 +851,7 @@ class SessionLite(Session):
         self.mre_spks()
         # ML change stops
 
+        self.set_dtype(dtype)
         self.clean_obj()
         print("is this going through?")
 
@@ -762,7 +880,7 @@ class SessionLite(Session):
         self.run.flu = self.run.flu[self.filtered_neurons, :]
         self.run.flu_raw = self.run.flu_raw[self.filtered_neurons, :]
         self.run.stat = self.run.stat[self.filtered_neurons]
-        self.is_target = self.is_target[self.filtered_neurons, :, :]
+        self.is_target = self.is_target[self.filtered_neurons, ...]
 
         if vverbose >= 1:
             if len(self.filtered_neurons < self.unfiltered_n_cells):
@@ -780,7 +898,9 @@ class SessionLite(Session):
             print("deleted")
 
     
-    def mre_oasis(self):
+    def mre_oasis(self, n_workers=1, chunk_size=None):
+        """Fit timescale of dF/F per cell and deconvolve dF/F with OASIS (with fitted timescale).
+        Cells are processed in n_workers parallel processes if n_workers > 1 (see map_cells())."""
         fs = 30
         n_cells = self.run.flu.shape[0]
         print("n_cells from self.run.flu")
@@ -797,128 +917,53 @@ class SessionLite(Session):
         # calculate tau_df/F on 10 min of spont activity
         # we want to do this prior to masking the spont_rewards!
         # (because mr. estimator cannot handle nans)
-        for i_cell in range(n_cells):
-            dff_detrended = scipy.signal.detrend(self.run.flu[i_cell,:10*60*30],
-                                                 type='constant', axis=-1)
-            reshaped_dff = dff_detrended.reshape((10,60*30)) 
-            fit_res = fit_tau(reshaped_dff, fs=fs, k_arr=np.arange(1,300),
-                    numboot=100)
-            #print(fit_res)
-            self.tau_raw[i_cell] = fit_res[0]
-            self.tau_raw_quantiles[i_cell] = fit_res[1]
-            self.raw_coefficients[i_cell] = fit_res[2]
-            self.g_raw[i_cell] = np.exp(-1 / (fs* self.tau_raw[i_cell]/1000)) 
+        dff_detrended = scipy.signal.detrend(self.run.flu[:, :10*60*fs], type='constant', axis=-1)  # (copy)
+        map_cells(_fit_tau_cell, arrays_in={'dff_detrended': dff_detrended},
+                  arrays_out={'tau_raw': self.tau_raw, 'tau_raw_quantiles': self.tau_raw_quantiles,
+                              'raw_coefficients': self.raw_coefficients, 'g_raw': self.g_raw},
+                  n_workers=n_workers, chunk_size=chunk_size, fs=fs)
 
         masked_dff = artifact_suppress(self.run, set_to = np.nan, plot=True, 
                                        interpolate=False, copy_run=True)
-        masked_dff = masked_dff.astype('float64')
+        masked_dff = masked_dff.astype('float64', copy=False)
         self.run.spks = np.zeros_like(self.run.flu)
-        for i_cell in range(n_cells):
-            c,s = oasis_nan.oasisAR1(masked_dff[i_cell], self.g_raw[i_cell])
-            self.run.spks[i_cell] = s
-            sta, popt, pcov = calc_spikeTriggeredAverage(np.nan_to_num(dff_detrended), 
-                                                   np.nan_to_num(s[:10*60*30]),
-                                                   0.01, self.tau_raw[i_cell], 
-                                                   30, window=5*30)
-            self.spike_triggered_average[i_cell] = sta
-            self.PCOV[i_cell] = pcov
-            self.POPT[i_cell] = popt
+        ## STA of each cell is computed on its own detrended spont dF/F
+        map_cells(_oasis_sta_cell, 
+                  arrays_in={'masked_dff': masked_dff, 'dff_detrended': dff_detrended, 
+                             'g_raw': self.g_raw, 'tau_raw': self.tau_raw},
+                  arrays_out={'spks': self.run.spks, 'spike_triggered_average': self.spike_triggered_average,
+                              'PCOV': self.PCOV, 'POPT': self.POPT},
+                  n_workers=n_workers, chunk_size=chunk_size, fs=fs)
         self.save_me = {}
         self.save_me['masked_dff'] = masked_dff
         self.save_me['spks'] = self.run.spks
 
-    def mre_spks(self):
+    def mre_spks(self, refine_fit=True):
+        """Autocorrelation time scale and rate of the summed spks (of all, S1 and S2 cells) 
+        per trial, pre and post stim. Time scales of all trials are fitted at once (see fit_tau_batch(); 
+        check_fit_tau_batch() compares it with mrestimator's fit_tau())."""
         fps = 30
         pre_frames = np.arange(0*fps,60*fps)
         post_frames = np.arange(61*fps, 120*fps)
-        n_trials = self.spks_behaviour_trials.shape[1]
         n_frames = pre_frames.shape[0]
+        k_arr = np.arange(1,5*fps)
 
         spks = np.nan_to_num(self.spks_behaviour_trials)
 
-        print("SPKS SHAPE")
-        print(spks.shape)
-        print(pre_frames)
-        print(post_frames)
-
-        spks_pre_all = np.sum(spks[:,:,pre_frames], axis=0)
-        print(spks_pre_all[0].shape)
-        tau_pre_all = np.zeros(n_trials)
-        rate_pre_all = np.zeros(n_trials)
-        #print(spks_pre_all[i_trial-window:i_trial+window].shape)
-        for i_trial in range(n_trials):
-            trial_spks = np.reshape(spks_pre_all[i_trial], (1,n_frames))
-            tau_res = fit_tau(trial_spks, fps, k_arr=np.arange(1,5*fps))
-            print("tau res")
-            print(tau_res)
-            tau_pre_all[i_trial] = tau_res[0]
-            rate_pre_all[i_trial] = np.sum(trial_spks) / n_frames * fps
-        
-        spks_post_all = np.sum(spks[:,:,post_frames], axis=0)
-        tau_post_all = np.zeros(n_trials)
-        rate_post_all = np.zeros(n_trials)
-        for i_trial in range(n_trials):
-            tau_res = fit_tau(spks_post_all[i_trial], fps, k_arr=np.arange(1,5*fps))
-            tau_post_all[i_trial] = tau_res[0]
-            rate_post_all[i_trial] = np.sum(spks_post_all[i_trial]) / n_frames * fps
-
-        # S1 only
-
-        print("S1 bool shape")
-        print(self.s1_bool.shape)
-        print(spks[self.s1_bool][:,:,pre_frames].shape)
-        spks_pre_S1 = np.sum(spks[self.s1_bool][:,:,pre_frames], axis=0)
-        tau_pre_S1 = np.zeros(n_trials)
-        rate_pre_S1 = np.zeros(n_trials)
-
-        for i_trial in range(n_trials):
-            tau_res = fit_tau(spks_pre_S1[i_trial], fps, k_arr=np.arange(1,5*fps))
-            tau_pre_S1[i_trial] = tau_res[0]
-            rate_pre_S1[i_trial] = np.sum(spks_pre_S1[i_trial]) / n_frames * fps
-
-        spks_post_S1 = np.sum(spks[self.s1_bool][:,:,post_frames], axis=0)
-        tau_post_S1 = np.zeros(n_trials)
-        rate_post_S1 = np.zeros(n_trials)
-
-        for i_trial in range(n_trials):
-            tau_res = fit_tau(spks_post_S1[i_trial], fps, k_arr=np.arange(1,5*fps))
-            tau_post_S1[i_trial] = tau_res[0]
-            rate_post_S1[i_trial] = np.sum(spks_post_S1[i_trial]) / n_frames * fps
-
-        # S2 only
-        spks_pre_S2 = np.sum(spks[~self.s1_bool][:,:,pre_frames], axis=0)
-        tau_pre_S2 = np.zeros(n_trials)
-        rate_pre_S2 = np.zeros(n_trials)
-
-        for i_trial in range(n_trials):
-            tau_res = fit_tau(spks_pre_S2[i_trial], fps, k_arr=np.arange(1,5*fps))
-            tau_pre_S2[i_trial] = tau_res[0]
-            rate_pre_S2[i_trial] = np.sum(spks_pre_S2[i_trial]) / n_frames * fps
-
-        spks_post_S2 = np.sum(spks[~self.s1_bool][:,:,post_frames], axis=0)
-        tau_post_S2 = np.zeros(n_trials)
-        rate_post_S2 = np.zeros(n_trials)
-
-        for i_trial in range(n_trials):
-            tau_res = fit_tau(spks_post_S2[i_trial], fps, k_arr=np.arange(1,5*fps))
-            tau_post_S2[i_trial] = tau_res[0]
-            rate_post_S2[i_trial] = np.sum(spks_post_S2[i_trial]) / n_frames * fps
-       
-        print(tau_pre_all)
-        print(tau_post_all)
-        self.tau_dict = {"all_pre":tau_pre_all, "all_post":tau_post_all,
-                         "S1_pre":tau_pre_S1, "S1_post":tau_post_S1,
-                         "S2_pre":tau_pre_S2, "S2_post":tau_post_S2}
-        self.rate_dict = {"all_pre":rate_pre_all, "all_post":rate_post_all,
-                         "S1_pre":rate_pre_S1, "S1_post":rate_post_S1,
-                         "S2_pre":rate_pre_S2, "S2_post":rate_post_S2}
+        self.tau_dict, self.rate_dict = {}, {}
+        for region, cell_bool in [('all', np.ones(spks.shape[0], dtype='bool')), 
+                                  ('S1', self.s1_bool), ('S2', ~self.s1_bool)]:
+            for epoch, frames in [('pre', pre_frames), ('post', post_frames)]:
+                trial_spks = np.sum(spks[cell_bool][:,:,frames], axis=0)  # n_trials x n_frames
+                self.tau_dict[f'{region}_{epoch}'] = fit_tau_batch(trial_spks, fps, k_arr=k_arr, refine=refine_fit)
+                self.rate_dict[f'{region}_{epoch}'] = np.sum(trial_spks, axis=1) / n_frames * fps
 
 
 def only_numerics(seq):
     seq_type= type(seq)
     return seq_type().join(filter(seq_type.isdigit, seq))
 
-def load_files(save_dict, data_dict, folder_path, flu_flavour):
+def load_files(save_dict, data_dict, folder_path, flu_flavour, n_workers=1):
     total_ds = 0
     debug = False
     for mouse in data_dict.keys():
@@ -933,7 +978,7 @@ def load_files(save_dict, data_dict, folder_path, flu_flavour):
 
             session = SessionLite(mouse, run_number, folder_path, 
                                   flu_flavour=flu_flavour, pre_gap_seconds=0,
-                                  post_gap_seconds=0, post_seconds=8)
+                                  post_gap_seconds=0, post_seconds=8, n_workers=n_workers)
 
             if session.has_flu:
                 print("session lite created")
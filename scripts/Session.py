@@ -32,6 +32,12 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import seaborn as sns
 import time, datetime
+import argparse
+import hashlib
+import multiprocessing
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import utils_funcs as utils 
 import run_functions as rf
 from subsets_analysis import Subsets
@@ -99,6 +105,41 @@ def get_trial_frames_single(clock, start, pre_frames, post_frames, fs=30, paq_ra
     return trial_frames
 
 
+def get_trial_frames_matrix(clock, trial_start, pre_frames, post_frames, fs=30, paq_rate=20000):
+    """Get frames of all trials at once. Vectorised version of get_trial_frames_single(), 
+    with the same criteria to reject trials.
+
+    Returns:
+    ---------------
+        trial_frames: 2D np.array of int
+            [n_trials x (pre_frames + post_frames)] frame indices per trial (0 for rejected trials)
+        valid_trials: 1D np.array of bool
+            [n_trials] False for trials that were rejected
+    """
+    clock = np.asarray(clock)
+    trial_start = np.asarray(trial_start)
+    n_clock = len(clock)
+    # the frames immediately preceeding stim (same as utils.closest_frame_before())
+    frame_idx = np.searchsorted(clock, trial_start, side='left') - 1
+    trial_frames = frame_idx[:, np.newaxis] + np.arange(-pre_frames, post_frames)[np.newaxis, :]
+
+    # is the trial outside of the frame clock
+    is_beyond_clock = np.logical_or(frame_idx + post_frames - 1 >= n_clock, frame_idx - pre_frames < 0)
+    safe_frames = np.clip(trial_frames, 0, n_clock - 1)
+
+    frame_to_start = (trial_start - clock[np.clip(frame_idx, 0, n_clock - 1)]) / paq_rate  # time (s) from frame to trial_start
+    frame_time_diff = np.diff(clock) / paq_rate  # ifi (s) of all frames
+    max_frame_time_diff = np.max(frame_time_diff[np.clip(safe_frames[:, :-1], 0, n_clock - 2)], 1)
+
+    # the nearest frame to trial start was not during trial
+    trial_not_running = frame_to_start > 1/fs
+    frames_not_consecutive = max_frame_time_diff > 1/(fs-1)
+
+    valid_trials = ~(is_beyond_clock | trial_not_running | frames_not_consecutive)
+    trial_frames[~valid_trials, :] = 0
+    return trial_frames, valid_trials
+
+
 def build_flu_array_single(run, use_spks=False, use_comps=False, use_pupil=False, 
                            prereward=False, pre_frames=30, post_frames=80, fs=30):
     ''' Build an trial by trial fluoresence array of shape [n_cells x n_frames x n_trials].
@@ -142,30 +183,139 @@ def build_flu_array_single(run, use_spks=False, use_comps=False, use_pupil=False
         # matches the number of trials reported by pycontrol
         assert len(trial_start) == len(run.trial_start)
 
-    for i, start in enumerate(trial_start):
-
-        trial_frames = get_trial_frames_single(clock, start, pre_frames, post_frames)
-
-        if trial_frames is None:
-            flu_trial = np.full([flu.shape[0], pre_frames+post_frames], np.nan)
-        else:
-            flu_trial = flu[:, trial_frames]
-
-        if i == 0:
-            flu_array = flu_trial
-        else:
-
-            flu_array = np.dstack((flu_array, flu_trial))
-
-
-    return np.swapaxes(flu_array,2,1)
+    trial_frames, valid_trials = get_trial_frames_matrix(clock, trial_start, pre_frames, post_frames)
+
+    # Gather all trials at once into preallocated array; rejected trials are NaN
+    dtype = flu.dtype if np.issubdtype(flu.dtype, np.floating) else np.float64
+    flu_array = np.empty((flu.shape[0], len(trial_start), pre_frames + post_frames), dtype=dtype)
+    np.take(flu.astype(dtype, copy=False), trial_frames, axis=1, out=flu_array, mode='clip')  # cast, as out must match dtype
+    flu_array[:, ~valid_trials, :] = np.nan
+
+    return flu_array
+
+
+def get_first_licks(spiral_licks):
+    """First lick time of every trial (None if no licks), from list of lick time arrays per trial 
+    (as run.spiral_licks). The first licks of all trials are selected at once from the concatenated licks."""
+    n_licks = np.array([len(licks) for licks in spiral_licks])
+    has_lick = n_licks > 0
+    if not np.any(has_lick):
+        return np.full(len(spiral_licks), None, dtype=object)
+    offsets = np.concatenate(([0], np.cumsum(n_licks)[:-1]))
+    first_licks = np.concatenate([np.ravel(licks) for licks in spiral_licks])[offsets[has_lick]]
+    if np.all(has_lick):
+        return first_licks
+    first_lick = np.full(len(spiral_licks), None, dtype=object)  # None for trials without licks
+    first_lick[has_lick] = list(first_licks)
+    return first_lick
+
+def set_trial_tensors_dtype(session, dtype='float32'):
+    """Set dtype of trial tensors (behaviour_trials, pre_rew_trials & spks_behaviour_trials) of session
+    (Session.set_dtype(), also used by the sessions of ML_Session.py). Analyses that use these tensors 
+    (normalise_raster_data(), LinearModel, train_test_all_sessions()) keep this dtype. float32 halves 
+    memory (bandwidth); use pop_off_functions.check_dtype_decoder_accuracy() to check that decoder 
+    results are unaffected. Note that sklearn's lbfgs LogisticRegression (decoders) converts its design 
+    matrix to float64, so the logistic regression fits themselves run in float64."""
+    dtype = np.dtype(dtype)
+    assert dtype in [np.float32, np.float64], f'dtype {dtype} not implemented'
+    for attr in ['behaviour_trials', 'pre_rew_trials', 'spks_behaviour_trials']:
+        if hasattr(session, attr):
+            setattr(session, attr, getattr(session, attr).astype(dtype, copy=False))
+    session.dtype = dtype
+
+def _run_cell_chunk(cell_fun, array_paths, cell_inds, kwargs):
+    """Run cell_fun for all cells in cell_inds (in worker process), on memory-mapped arrays."""
+    arrays = {key: np.load(path, mmap_mode='r+') for key, path in array_paths.items()}
+    for i_cell in cell_inds:
+        cell_fun(i_cell, arrays, **kwargs)
+    for arr in arrays.values():
+        arr.flush()
+
+def map_cells(cell_fun, arrays_in, arrays_out, n_workers=1, chunk_size=None, **kwargs):
+    """Call cell_fun(i_cell, arrays, **kwargs) for all cells (rows of the arrays), where arrays 
+    is a dict with all arrays of arrays_in and arrays_out. cell_fun reads its inputs from 
+    arrays and writes its results in place in the (preallocated) arrays of arrays_out.
+
+    If n_workers > 1, cells are processed in chunks of chunk_size cells by parallel processes. 
+    All arrays are then copied once into memory-mapped .npy files (in /dev/shm if available, so they 
+    are not pickled per chunk), and results are copied back into arrays_out at the end. 
+    cell_fun must be a module-level function.
+    """
+    n_cells = len(next(iter(arrays_in.values())))
+    if n_workers == 1:
+        arrays = {**arrays_in, **arrays_out}
+        for i_cell in tqdm(range(n_cells)):
+            cell_fun(i_cell, arrays, **kwargs)
+        return arrays_out
+
+    if chunk_size is None:
+        chunk_size = int(np.ceil(n_cells / (4 * n_workers)))  # ~4 chunks per worker for load balancing
+    chunks = [np.arange(i_start, min(i_start + chunk_size, n_cells)) for i_start in range(0, n_cells, chunk_size)]
+    map_folder = tempfile.mkdtemp(prefix='map_cells_', dir=('/dev/shm' if os.path.isdir('/dev/shm') else None))
+    try:
+        array_paths = {}
+        for key, arr in {**arrays_in, **arrays_out}.items():
+            array_paths[key] = os.path.join(map_folder, f'{key}.npy')
+            np.save(array_paths[key], np.asarray(arr))
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_run_cell_chunk, cell_fun, array_paths, chunk, kwargs) for chunk in chunks]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()  # raise errors of workers
+        for key, arr in arrays_out.items():
+            arr[...] = np.load(array_paths[key])
+    finally:
+        shutil.rmtree(map_folder, ignore_errors=True)
+    return arrays_out
+
+def _deconvolve_cell(i_cell, arrays):
+    """OASIS deconvolution of one cell, see Session.run_oasis()."""
+    from oasis.functions import deconvolve  # imported here to prevent need to clone OASIS to use SessionLite
+    c, s, b, g, lam = deconvolve(arrays['flu'][i_cell], penalty=0)
+    arrays['denoised_flu'][i_cell] = c
+    arrays['deconved'][i_cell] = s
+
+S1S2_BORDER_PATH = os.path.join(path_to_vape, 's2_position.json')  # S1/S2 border per session ({mouse: {run_number: border}})
+_s1s2_border_cache = {}
+
+def load_s1s2_borders(border_path=None):
+    """Load S1/S2 borders of all sessions from json file (default S1S2_BORDER_PATH).
+    Every file is only read once; subsequent calls return the cached dict."""
+    if border_path is None:
+        border_path = S1S2_BORDER_PATH
+    if border_path not in _s1s2_border_cache:
+        with open(border_path) as json_file:
+            _s1s2_border_cache[border_path] = json.load(json_file)
+    return _s1s2_border_cache[border_path]
+
+def get_roi_centroids(stat, im_size=1024):
+    """Mean x and y pixel coords (modulo im_size) and plane number of all ROIs in (suite2p) stat."""
+    n_pix = np.array([len(roi['xpix']) for roi in stat])
+    offsets = np.concatenate(([0], np.cumsum(n_pix)[:-1]))
+    ## sum pixel coords of all ROIs at once
+    av_xpix = np.add.reduceat(np.concatenate([roi['xpix'] for roi in stat]).astype(np.float64), offsets) / n_pix
+    av_ypix = np.add.reduceat(np.concatenate([roi['ypix'] for roi in stat]).astype(np.float64), offsets) / n_pix
+    # JR addition to deal with single plane data that has no iplane
+    plane_number = np.array([roi['iplane'] if 'iplane' in roi else 0 for roi in stat], dtype=np.float64)
+    return av_xpix % im_size, av_ypix % im_size, plane_number  # modulo 1024 because different planes are transposed by image size
+
+def get_s2_bool(av_xpix, av_ypix, s1s2_border):
+    """Boolean array of cells in S2. s1s2_border is either a scalar -> the x coord of a vertical line 
+    separating S1 and S2, or a vector describing a non straight line, in the format [x1,y1,x2,y2]."""
+    if isinstance(s1s2_border, int):
+        # Straight line
+        return av_xpix > s1s2_border
+    else:
+        # Arbitrary line; cells on the positive side of the line are in S1
+        Ax, Ay, Bx, By = s1s2_border
+        position = np.sign((Bx - Ax) * (av_ypix - Ay) - (By - Ay) * (av_xpix - Ax))
+        return position != 1
 
 
 class Session:
     """Class containing all info and data of 1 imaging session, as saved in a run.pkl file."""
     def __init__(self, mouse, run_number, pkl_path, flu_flavour='flu', remove_nan_trials=True,
                 pre_seconds=4, post_seconds=6, pre_gap_seconds=0.2, post_gap_seconds=0.6,
-                verbose=1, filter_threshold=10):
+                verbose=1, filter_threshold=10, dtype='float64'):
         """Initialize parameters and call all Class methods (except shuffle_labels()) to construct attributes.
 
         Parameters
@@ -189,6 +339,8 @@ class Session:
         verbose : int, default=1
             verbosiness;  1: only important info (i.e. user end); 2: all info (debug end)
         filter_threshold : int, default=10 filter neurons with mean(abs(df/f)) > filter_threshold
+        dtype : str, default='float64'
+            dtype of trial tensors (behaviour_trials, pre_rew_trials). 'float32' halves memory, see set_dtype()
         """
         self.mouse = mouse
         self.run_number = run_number
@@ -224,6 +376,7 @@ class Session:
 
         self.remove_nan_trials_inplace(vverbose=self.verbose)  # remove nan trials
         self.get_first_lick_spont()
+        self.set_dtype(dtype)
         delattr(self.run, 'x_galvo_uncaging')   # to free memory
 
     def __str__(self):
@@ -254,8 +407,7 @@ class Session:
         self.trial_start = self.run.trial_start
         assert len(self.trial_start) == len(self.tstart_galvo)
         self.galvo_ms = self.run.aligner.B_to_A(self.tstart_galvo)
-        self.first_lick = np.array([licks[0] if len(licks) > 0 else None 
-                                    for licks in self.run.spiral_licks])
+        self.first_lick = get_first_licks(self.run.spiral_licks)
         if vverbose >= 1:
             print('microcontroller trial starts occur on average {} ms from galvo trial starts'
               .format(round(np.mean(self.trial_start - self.galvo_ms), 2)))
@@ -270,69 +422,41 @@ class Session:
         self.outcome = self.run.outcome
         self.outcome_arr = np.unique(self.outcome)
 
-    def define_s1_s2(self, im_size=1024):  # define border (which is hard-defined at middle of image)
+    def define_s1_s2(self, im_size=1024, border_path=None):  # define border (which is hard-defined at middle of image)
         """Define S1/S2 region borders and label all neurons accordingly.
 
         Parameters:
         -------------------
             im_size: int, default=1024
                 size of imaging window in pixels. This is required because multi-plane data is saved by transposing planes +im_size pixels.
+            border_path: str or None, default=None
+                json file with S1/S2 borders of all sessions. If None, S1S2_BORDER_PATH is used.
         """
         if self.run is None:
             self.load_data()
         self.n_cells = self.run.stat.shape[0]
         assert self.n_cells == self.behaviour_trials.shape[0]
-        self.av_ypix = np.zeros(self.n_cells)
-        self.av_xpix = np.zeros(self.n_cells)
-        self.plane_number = np.zeros(self.n_cells)
-        for neuron_id in range(self.n_cells):# get mean coords of pixels per cell
-            self.av_xpix[neuron_id] = np.mean(self.run.stat[neuron_id]['xpix']) % im_size  # modulo 1024 because different planes are transposed by image size
-            self.av_ypix[neuron_id] = np.mean(self.run.stat[neuron_id]['ypix']) % im_size
-            # JR addition to deal with single plane data that has no iplane
-            try:
-                self.plane_number[neuron_id] = self.run.stat[neuron_id]['iplane']
-            except KeyError:
-                self.plane_number[neuron_id] = 0
-
+        self.av_xpix, self.av_ypix, self.plane_number = get_roi_centroids(self.run.stat, im_size=im_size)
 
         # This will either be a scalar -> the x coord of a vertical line separating S1 and S2,
         # or a vector describing a non straight line, in the format [x1,y1,x2,y2]
-        with open('/home/jrowland/Documents/code/Vape/s2_position.json') as json_file:
-            s1s2_border_json = json.load(json_file)
-    
-        self.s1s2_border = s1s2_border_json[self.mouse][str(self.run_number)]
-        
-
-        if isinstance(self.s1s2_border, int):
-            # Straight line
-            self.s2_bool = self.av_xpix > self.s1s2_border
-        else:
-            # Arbitrary line
-            Ax, Ay, Bx, By = self.s1s2_border
-            self.s2_bool = []
-            for X, Y in zip(self.av_xpix, self.av_ypix):
-                position = np.sign((Bx - Ax) * (Y - Ay) - (By - Ay) * (X - Ax))
-                if position == 1:
-                    self.s2_bool.append(False)
-                else:
-                    self.s2_bool.append(True)
-
-            self.s2_bool = np.array(self.s2_bool)
-                    
+        self.s1s2_border = load_s1s2_borders(border_path).get(self.mouse, {}).get(str(self.run_number))
+        assert self.s1s2_border is not None, f'no S1/S2 border of mouse {self.mouse}, run {self.run_number} in {border_path or S1S2_BORDER_PATH}'
+        self.s2_bool = get_s2_bool(self.av_xpix, self.av_ypix, self.s1s2_border)
         self.s1_bool = np.logical_not(self.s2_bool)
 
-    def run_oasis(self):
-        """ Build spks array using Oasis deconvolution https://github.com/j-friedrich/OASIS """
+    def run_oasis(self, n_workers=1, chunk_size=None):
+        """ Build spks array using Oasis deconvolution https://github.com/j-friedrich/OASIS 
+        Cells are deconvolved in n_workers parallel processes if n_workers > 1 (see map_cells())."""
 
         flu = self.flu.astype('float64')
 
         denoised_flu = np.empty_like(flu)
         deconved = np.empty_like(flu)
 
-        for idx, cell in enumerate(tqdm(flu)):
-            c, s, b, g, lam = deconvolve(cell, penalty=0)
-            denoised_flu[idx, :] = c
-            deconved[idx, :] = s
+        map_cells(_deconvolve_cell, arrays_in={'flu': flu},
+                  arrays_out={'denoised_flu': denoised_flu, 'deconved': deconved},
+                  n_workers=n_workers, chunk_size=chunk_size)
 
         self.run.flu = deconved  # Come up with a more elegant solution to this
         self.deconved = deconved
@@ -527,7 +651,7 @@ class Session:
         self.autorewarded = self.autorewarded[self.nonnan_trials]
         self.unrewarded_hits = self.unrewarded_hits[self.nonnan_trials]
         self.n_trials = len(self.nonnan_trials)
-        self.is_target = self.is_target[:, self.nonnan_trials, :]
+        self.is_target = self.is_target[:, self.nonnan_trials, ...]
         self.first_lick = self.first_lick[self.nonnan_trials]
 
         if vverbose >= 1:
@@ -561,13 +685,10 @@ class Session:
     def get_targets(self):
         
         gt = rf.GetTargets(self.run)
+        # [n_cells x n_trials]; use get_is_target_3d() for a mask of behaviour_trials
         self.is_target = gt.is_target
-        # print(self.is_target.shape)
-        # print(self.filtered_neurons)
-        # self.is_target[self.filtered_neurons, :]
-        self.is_target = np.repeat(self.is_target[:, :, np.newaxis], self.n_times, axis=2)
         # Was a cell targeted on any trial?
-        ever_targeted = np.any(self.is_target, axis=(1,2))
+        ever_targeted = np.any(self.is_target, axis=1)
         # Check that all targets are in s1
         # print('WARNING S1 TARGET CHECKER DISABLED')
         # n = 0
@@ -579,6 +700,23 @@ class Session:
                     # print(self.run.stat[n]['original_index'])
             # n += 1
 
+    def get_is_target_2d(self):
+        """Return is_target as [n_cells x n_trials] boolean matrix 
+        (also for sessions that were saved with the former 3D is_target)."""
+        if self.is_target.ndim == 3:
+            return self.is_target[:, :, 0]
+        return self.is_target
+
+    def get_is_target_3d(self):
+        """Return is_target as [n_cells x n_trials x n_times] boolean mask, for masking 
+        behaviour_trials. This is a read-only broadcast view (identical along time axis), copy if needed."""
+        is_target = self.get_is_target_2d()
+        return np.broadcast_to(is_target[:, :, np.newaxis], is_target.shape + (self.n_times,))
+
+    def set_dtype(self, dtype='float32'):
+        """Set dtype of trial tensors, see set_trial_tensors_dtype()."""
+        set_trial_tensors_dtype(self, dtype=dtype)
+
     def get_first_lick_spont(self, lick_time_array=None, reward_delivery_array=None, 
                              verbose=0, store_spont_licks=True):
         if lick_time_array is None:
@@ -586,39 +724,28 @@ class Session:
         if reward_delivery_array is None:
             reward_delivery_array = self.run.pre_reward
 
-        lick_time_array = copy.deepcopy(lick_time_array)
-        first_lick_array = np.zeros_like(reward_delivery_array, dtype=np.float)
-
-        for i_rew, rew_time in enumerate(reward_delivery_array):
-            diff_lick_time = lick_time_array - rew_time 
-
-            ## while loop to avoid picking negative values
-            first_lick_relative = -1  # start value
-            first_lick_indices = np.argsort(np.abs(diff_lick_time))
-            i_ind = -1
-            while first_lick_relative <= 0:
-                i_ind += 1
-                first_lick_index = first_lick_indices[i_ind]
-                first_lick = lick_time_array[first_lick_index]
-                if np.isin(first_lick, reward_delivery_array):  # something fishy here
-                    continue
-                first_lick_relative = first_lick - rew_time
-            if verbose > 1:
-                print([lick_time_array[x] for x in first_lick_indices[:5]], i_ind, rew_time)
-            if verbose > 0:
-                print(f'Reward at {rew_time}, first lick at {first_lick} or {first_lick_relative}')
-            first_lick_array[i_rew] = first_lick_relative
-
-            ## exception clausules for no lick:
-            if i_rew == len(reward_delivery_array) - 1:  # last reward 
-                if first_lick < rew_time: # no licks apparently after reward
-                    assert False, 'double check - no licks after final reward time'
-                    ## I'll just put an assert here - don't expect this to ever occur so might be something wrong with data if it would happen
-            else:
-                if first_lick > reward_delivery_array[i_rew + 1]:  # if first lick actually occurs after next reward
-                    print('double check - no licks associated with this reward delivery')
-                    first_lick_array[i_rew] = np.nan  # no lick => nan (= None in np arrays)
-                    ## also don't expect this to happen 
+        reward_delivery_array = np.asarray(reward_delivery_array)
+        lick_time_array = np.sort(lick_time_array)  # (copy)
+        lick_time_array = lick_time_array[~np.isin(lick_time_array, reward_delivery_array)]  # something fishy here
+
+        ## first lick strictly after every reward:
+        first_lick_indices = np.searchsorted(lick_time_array, reward_delivery_array, side='right')
+        first_lick = np.append(lick_time_array, np.nan)[first_lick_indices]  # nan if no lick after reward
+        has_lick = ~np.isnan(first_lick)
+        first_lick_array = (first_lick - reward_delivery_array).astype(np.float64)
+        if verbose > 0:
+            for rew_time, lick, lick_relative in zip(reward_delivery_array, first_lick, first_lick_array):
+                print(f'Reward at {rew_time}, first lick at {lick} or {lick_relative}')
+
+        ## exception clausules for no lick:
+        if len(reward_delivery_array) > 0:
+            assert has_lick[-1], 'double check - no licks after final reward time'
+            ## I'll just put an assert here - don't expect this to ever occur so might be something wrong with data if it would happen
+        no_lick = np.logical_or(~has_lick[:-1], first_lick[:-1] > reward_delivery_array[1:])  # if first lick actually occurs after next reward
+        for i_rew in np.where(no_lick)[0]:
+            print('double check - no licks associated with this reward delivery')
+            first_lick_array[i_rew] = np.nan  # no lick => nan (= None in np arrays)
+            ## also don't expect this to happen 
         self.first_lick_spont = first_lick_array
         
         if store_spont_licks:
@@ -633,7 +760,7 @@ class SessionLite(Session):
 
     def __init__(self, mouse, run_number, pkl_path, flu_flavour, remove_nan_trials=True,
                 pre_seconds=4, post_seconds=6, pre_gap_seconds=0.2, post_gap_seconds=0.6,
-                verbose=1, filter_threshold=10):
+                verbose=1, filter_threshold=10, dtype='float64'):
 
         self.mouse = mouse
         self.run_number = run_number
@@ -684,6 +811,7 @@ class SessionLite(Session):
         self.get_targets()
         self.remove_nan_trials_inplace(vverbose=self.verbose)  # remove nan trials
         self.get_first_lick_spont()
+        self.set_dtype(dtype)
         self.clean_obj()
 
     # def filter_neurons(self, vverbose=1, abs_threshold_df=10, abs_threshold_spks=1):
@@ -729,11 +857,102 @@ def only_numerics(seq):
     seq_type= type(seq)
     return seq_type().join(filter(seq_type.isdigit, seq))
 
+SESSION_BUILD_VERSION = 1  # increase when preprocessing of Session/SessionLite changes (to rebuild all sessions incrementally)
+
+def build_session(mouse, run_number, folder_path, flu_flavour,
+                  pre_seconds=4, post_seconds=6, session_type='lite',
+                  pre_gap_seconds=0, post_gap_seconds=0, filter_threshold=10):
+    """Build one Session (session_type='full') or SessionLite (session_type='lite')."""
+    assert session_type in ['full', 'lite']
+    if session_type == 'full':
+        session = Session(mouse=mouse, run_number=run_number, pkl_path=folder_path, 
+                            flu_flavour=flu_flavour, pre_gap_seconds=pre_gap_seconds,
+                            post_gap_seconds=post_gap_seconds, pre_seconds=pre_seconds, 
+                            post_seconds=post_seconds, 
+                            filter_threshold=filter_threshold)
+
+    elif session_type == 'lite':
+        session = SessionLite(mouse=mouse, run_number=run_number, pkl_path=folder_path, 
+                            flu_flavour=flu_flavour, pre_gap_seconds=pre_gap_seconds,
+                            post_gap_seconds=post_gap_seconds, pre_seconds=pre_seconds, 
+                            post_seconds=post_seconds, 
+                            filter_threshold=filter_threshold)
+    return session
+
+def _build_session_job(job, build_folder=None, build_record=None):
+    """Build session of job (dict with arguments of build_session()), possibly in worker process. 
+    If build_folder is given, the session is stored there (see save_built_session()) and only its 
+    path is returned, so that worker processes do not send whole sessions back to the parent process.
+    Errors are returned (rather than raised) so that other sessions are still built.
+    Returns (session or session path, build_record, error)."""
+    try:
+        session = build_session(**job)
+        if build_folder is None:
+            return session, build_record, None
+        return save_built_session(session, job, build_folder, build_record), build_record, None
+    except Exception as e:
+        return None, build_record, f'{type(e).__name__}: {e}'
+
+def hash_file(path, chunk_size=2 ** 24):
+    """sha1 hash of file contents."""
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def get_session_build_paths(job, build_folder):
+    """Paths of session pickle and its build record (json) of job in build_folder."""
+    name = os.path.join(build_folder, f'{job["session_type"]}_{job["flu_flavour"]}', 
+                        f'{job["mouse"]}_R{job["run_number"]}')
+    return name + '.pkl', name + '.json'
+
+def get_session_build_record(job, previous_record=None):
+    """Build record of job: hash of source run.pkl, preprocessing parameters, S1/S2 border and SESSION_BUILD_VERSION.
+    The run.pkl is only rehashed if its size or modification time differ from previous_record."""
+    run_path = os.path.join(job['folder_path'], job['mouse'], f'run{job["run_number"]}.pkl')
+    run_stat = os.stat(run_path)
+    if (previous_record is not None and previous_record['run_size'] == run_stat.st_size 
+            and previous_record['run_mtime'] == run_stat.st_mtime):
+        run_hash = previous_record['run_hash']
+    else:
+        run_hash = hash_file(run_path)
+    params = {key: value for key, value in job.items() if key != 'folder_path'}
+    s1s2_border = load_s1s2_borders().get(job['mouse'], {}).get(str(job['run_number']))  # if missing, build_session() reports error
+    return {'run_hash': run_hash, 'run_size': run_stat.st_size, 'run_mtime': run_stat.st_mtime,
+            'params': params, 's1s2_border': s1s2_border, 'version': SESSION_BUILD_VERSION}
+
+def save_built_session(session, job, build_folder, build_record=None):
+    """Store session of job in build_folder (see get_session_build_paths()), with its build record 
+    (if not None). Returns path of session pickle."""
+    session_path, record_path = get_session_build_paths(job, build_folder)
+    os.makedirs(os.path.dirname(session_path), exist_ok=True)
+    with open(session_path + '.tmp', 'wb') as f:
+        pickle.dump(session, f)
+    os.replace(session_path + '.tmp', session_path)
+    if build_record is not None:
+        with open(record_path, 'w') as f:  # written after session, so a record always has a complete session
+            json.dump(build_record, f, indent=2)
+    return session_path
+
+def is_build_record_fresh(record, previous_record):
+    return previous_record is not None and np.all([record[key] == previous_record.get(key) 
+                                                   for key in ['run_hash', 'params', 's1s2_border', 'version']])
+
 def load_files(save_dict, data_dict, folder_path, flu_flavour,
-               pre_seconds=4, post_seconds=6, session_type='lite'):
+               pre_seconds=4, post_seconds=6, session_type='lite', n_workers=1,
+               build_folder=None):
+    """Build sessions of all runs in data_dict ({mouse: [run_numbers]}) and add them to save_dict.
+    If n_workers > 1, sessions are built in parallel processes (one session per worker at a time).
+    Sessions that fail are reported and skipped.
+
+    If build_folder is given, every session is stored separately in build_folder, together with a 
+    record of its inputs (see get_session_build_record()). Sessions whose inputs have not changed 
+    since they were stored are loaded instead of rebuilt."""
     total_ds = 0
     debug = False
     assert session_type in ['full', 'lite']
+    job_list = []
     for mouse in data_dict.keys():
         
         if mouse in ['J048', 'RL048']:  # Drop the 5Hz data for now
@@ -744,55 +963,97 @@ def load_files(save_dict, data_dict, folder_path, flu_flavour,
         for run_number in data_dict[mouse]:
             if run_number != 10 and debug:
                 continue
+            job_list.append({'mouse': mouse, 'run_number': run_number, 'folder_path': folder_path,
+                             'flu_flavour': flu_flavour, 'pre_seconds': pre_seconds,
+                             'post_seconds': post_seconds, 'session_type': session_type,
+                             'pre_gap_seconds': 0, 'post_gap_seconds': 0, 'filter_threshold': 10})
+
+    load_s1s2_borders()  # read border json once (worker processes inherit it)
+
+    ## Load sessions that are up to date in build_folder:
+    results = [None] * len(job_list)
+    build_records = [None] * len(job_list)
+    if build_folder is not None:
+        for i_job, job in enumerate(job_list):
+            session_path, record_path = get_session_build_paths(job, build_folder)
+            previous_record = None
+            if os.path.exists(record_path) and os.path.exists(session_path):
+                with open(record_path, 'r') as f:
+                    previous_record = json.load(f)
+            build_records[i_job] = get_session_build_record(job, previous_record=previous_record)
+            if is_build_record_fresh(build_records[i_job], previous_record):
+                with open(session_path, 'rb') as f:
+                    results[i_job] = (pickle.load(f), None)
+                print(f'mouse {job["mouse"]}, run {job["run_number"]} is up to date')
+    inds_build = [i_job for i_job in range(len(job_list)) if results[i_job] is None]
+
+    ## Build other sessions (workers store sessions in build_folder, or a temporary folder, and return their paths):
+    parallel = n_workers > 1 and not debug
+    tmp_build_folder = tempfile.mkdtemp(prefix='session_build_') if (parallel and build_folder is None) else None
+    build_folder_use = build_folder if tmp_build_folder is None else tmp_build_folder
+    list_args = [(job_list[i_job], build_folder_use, build_records[i_job]) for i_job in inds_build]
+    try:
+        if parallel:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = [executor.submit(_build_session_job, *args) for args in list_args]
+                built = []  # in order of inds_build
+                for future, (_, _, record) in zip(futures, list_args):
+                    try:  # eg worker killed (out of memory), which breaks the pool for all remaining jobs
+                        built.append(future.result())
+                    except Exception as e:
+                        built.append((None, record, f'{type(e).__name__}: {e}'))
+        else:  # sessions are built in this process, so stored without reloading
+            built = [_build_session_job(job, build_folder=None, build_record=record) for job, _, record in list_args]
+            for (job, _, _), (session, record, _) in zip(list_args, built):
+                if session is not None and build_folder is not None:
+                    try:  # not storing a session is reported, but the built session is still used
+                        save_built_session(session, job, build_folder, record)
+                    except Exception as e:
+                        print(f'WARNING: mouse {job["mouse"]}, run {job["run_number"]} could not be stored: {type(e).__name__}: {e}')
+        for i_job, (session, _, error) in zip(inds_build, built):
+            if isinstance(session, str):  # path of stored session
+                try:
+                    with open(session, 'rb') as f:
+                        session = pickle.load(f)
+                except Exception as e:
+                    session, error = None, f'{type(e).__name__}: {e}'
+            results[i_job] = (session, error)
+    finally:
+        if tmp_build_folder is not None:
+            shutil.rmtree(tmp_build_folder, ignore_errors=True)
+
+    for job, (session, error) in zip(job_list, results):
+        if session is not None:
+            save_dict[total_ds] = session
+            total_ds += 1
+            print(f'succesfully loaded mouse {job["mouse"]}, run {job["run_number"]}')
+        else:
+            print(f'ERROR mouse {job["mouse"]}, run {job["run_number"]}: {error}')
+            if debug: raise RuntimeError(error)
 
-            try:
-                if session_type == 'full':
-                    session = Session(mouse=mouse, run_number=run_number, pkl_path=folder_path, 
-                                        flu_flavour=flu_flavour, pre_gap_seconds=0,
-                                        post_gap_seconds=0, pre_seconds=pre_seconds, 
-                                        post_seconds=post_seconds, 
-                                        filter_threshold=10)
-
-                elif session_type == 'lite':
-                    session = SessionLite(mouse=mouse, run_number=run_number, pkl_path=folder_path, 
-                                        flu_flavour=flu_flavour, pre_gap_seconds=0,
-                                        post_gap_seconds=0, pre_seconds=pre_seconds, 
-                                        post_seconds=post_seconds, 
-                                        filter_threshold=10)
-
-                save_dict[total_ds] = session
-                total_ds += 1
-                print(f'succesfully loaded mouse {mouse}, run {run_number}')
-            except AttributeError as e:
-                print(f'ERROR {e}')
-                if debug: raise
     return save_dict, total_ds
 
 if __name__ == '__main__':
-
-    session_type = input('Enter session type: [full, lite]. Full will include original run and flu files and therefore have larger memory footprint.\n\n')
-    assert session_type in ['full', 'lite'], f'session type {session_type} not recognised'
+    ## Usage: python Session.py --session_type lite --flu_flavour dff --save_option local --workers 4
+    parser = argparse.ArgumentParser(description='Build sessions from run pkls and save them in one pkl')
+    parser.add_argument('--session_type', type=str, default='lite', choices=['full', 'lite'],
+                        help='Full will include original run and flu files and therefore have larger memory footprint.')
+    parser.add_argument('--flu_flavour', type=str, default='dff', choices=['dff', 'raw', 'denoised', 'spks'],
+                        help='flu flavour of lite sessions (full sessions always use dff)')
+    parser.add_argument('--save_option', type=str, default='local', choices=['local', 'qnap'],
+                        help='Save locally (base path) or on qnap')
+    parser.add_argument('--workers', type=int, default=1, help='number of sessions to build in parallel')
+    parser.add_argument('--build_folder', type=str, default=None,
+                        help='incremental build: store sessions separately in this folder and only rebuild sessions whose inputs changed')
+    args = parser.parse_args()
+    session_type = args.session_type
+    save_option = args.save_option
 
     if session_type == 'full':
         flu_flavour = 'flu'
     elif session_type == 'lite':    
-        flu_flavour = input('Enter a flu_flavour, valid entries are: [dff, raw, denoised, spks]\n\n')
-
-        if flu_flavour == 'dff':
-            flu_flavour = 'flu'
-        elif flu_flavour == 'denoised':
-            flu_flavour = 'denoised_flu'
-        elif flu_flavour == 'raw':
-            flu_flavour = 'flu_raw'
-        elif flu_flavour == 'spks':
-            flu_flavour = 'spks'
-        else:
-            print('Invalid flu_flavour')
-            time.sleep(2)
-            raise ValueError
-
-    save_option = input('Save locally (base path) or on qnap? [local, qnap]\n\n')
-    assert save_option in ['local', 'qnap']
+        flu_flavour = {'dff': 'flu', 'denoised': 'denoised_flu', 
+                       'raw': 'flu_raw', 'spks': 'spks'}[args.flu_flavour]
 
     pkl_path = USER_PATHS_DICT['pkl_path']  #'/home/jrowland/Documents/code/Vape/run_pkls'
 
@@ -824,7 +1085,8 @@ if __name__ == '__main__':
     sessions, total_ds = load_files(save_dict=sessions, data_dict=run_dict,
                                     folder_path=pkl_path, flu_flavour=flu_flavour,
                                     pre_seconds=8, post_seconds=6, 
-                                    session_type=session_type)
+                                    session_type=session_type, n_workers=args.workers,
+                                    build_folder=args.build_folder)
 
     dt = datetime.datetime.now()
     timestamp = str(dt.date())# + '-' + str(dt.hour).zfill(2) + str(dt.minute).zfill(2)      
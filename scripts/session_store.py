@@ -0,0 +1,194 @@
+## Session store: every session is saved in its own directory, with one .npy file per (large) array
+## and a small metadata pickle with all other attributes. Arrays are memory-mapped when loaded,
+## so loading all sessions is near-instantaneous and only the data that is used is read from disk.
+## Convert an existing sessions pickle with: python session_store.py path/to/sessions.pkl
+## SharedSessions uses a temporary session store (in shared memory, /dev/shm, if available) to pass sessions 
+## to worker processes without pickling their arrays: workers attach to the memory-mapped arrays by path.
+
+import os
+import sys
+import json
+import pickle
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Session import SessionLite
+
+MIN_MMAP_BYTES = 2 ** 20  # arrays smaller than this are loaded into memory (and are writeable)
+SHARED_STORE_FOLDER = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()  # tmpfs: files are shared memory
+
+
+class LazySessionLite(SessionLite):
+    ''' SessionLite that is loaded from a session store directory (see save_session()).
+
+    All non-array attributes are loaded on init. Arrays are only loaded on first
+    attribute access; large arrays are memory-mapped (read-only), so that memory use
+    scales with the data that is actually used. Arrays that need to be changed in
+    place should be copied first (eg session.behaviour_trials = session.behaviour_trials.copy()).
+
+    Parameters
+    -----------
+    session_path : directory of session in session store
+    '''
+
+    def __init__(self, session_path):
+        with open(os.path.join(session_path, 'metadata.pkl'), 'rb') as f:
+            metadata = pickle.load(f)
+        self.__dict__.update(metadata['attributes'])
+        self._session_path = session_path
+        self._lazy_arrays = dict(metadata['arrays'])  # attribute name -> mmap (bool)
+
+    def __getattr__(self, attr):
+        ## only called if attr has not been set (yet)
+        lazy_arrays = self.__dict__.get('_lazy_arrays', {})
+        if attr not in lazy_arrays:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{attr}'")
+        arr = np.load(os.path.join(self.__dict__['_session_path'], f'{attr}.npy'),
+                      mmap_mode=('r' if lazy_arrays[attr] else None))
+        setattr(self, attr, arr)  # materialise, so that __getattr__ is not called again
+        return arr
+
+
+def save_session(session, session_path):
+    ''' Save session in session store directory session_path.
+
+    numpy arrays (other than object arrays) are saved as .npy files, all other
+    attributes (except caches) are pickled in metadata.pkl.
+    '''
+    os.makedirs(session_path, exist_ok=True)
+    attributes, arrays = {}, {}
+    for attr, value in session.__dict__.items():
+        if attr in ['_session_path', '_lazy_arrays'] or attr.endswith('_cache'):  # caches (eg normalised tensors) are not saved
+            continue
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            np.save(os.path.join(session_path, f'{attr}.npy'), np.asarray(value))
+            arrays[attr] = value.nbytes >= MIN_MMAP_BYTES
+        else:
+            attributes[attr] = value
+    if isinstance(session, LazySessionLite):  # arrays that were not loaded are still on disk
+        for attr, mmap in session._lazy_arrays.items():
+            if attr not in session.__dict__ and attr not in arrays:
+                arr = getattr(session, attr)
+                np.save(os.path.join(session_path, f'{attr}.npy'), np.asarray(arr))
+                arrays[attr] = mmap
+    with open(os.path.join(session_path, 'metadata.pkl'), 'wb') as f:
+        pickle.dump({'attributes': attributes, 'arrays': arrays}, f)
+
+
+def save_session_store(sessions, store_path):
+    ''' Save dict of sessions in session store store_path (one directory per session).'''
+    os.makedirs(store_path, exist_ok=True)
+    index = {}
+    for key, session in sessions.items():
+        name = session.signature if hasattr(session, 'signature') else f'session_{key}'
+        save_session(session, os.path.join(store_path, name))
+        index[str(key)] = name
+    with open(os.path.join(store_path, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+def load_session_store(store_path):
+    ''' Load dict of sessions (with the same keys as the original dict) from session store
+    store_path, as LazySessionLite objects.'''
+    with open(os.path.join(store_path, 'index.json'), 'r') as f:
+        index = json.load(f)
+    return {int(key) if key.isdigit() else key: LazySessionLite(os.path.join(store_path, name))
+            for key, name in index.items()}
+
+
+def convert_sessions_pkl(pkl_path, store_path=None):
+    ''' Convert sessions pickle (as saved by Session.py) to session store.
+    By default, the store is saved next to the pickle (same name, without .pkl).'''
+    if store_path is None:
+        store_path = os.path.splitext(pkl_path)[0]
+    with open(pkl_path, 'rb') as f:
+        sessions = pickle.load(f)
+    save_session_store(sessions, store_path)
+    print(f'{len(sessions)} sessions saved in {store_path}')
+    return store_path
+
+
+_attached_sessions = {}  # sessions attached in this process (session path -> LazySessionLite)
+
+class SessionHandle:
+    ''' Small, picklable handle to a session in a session store (see SharedSessions). 
+    attach() returns the session as LazySessionLite, whose large arrays (behaviour_trials, 
+    pre_rew_trials, ..) are read-only memory-mapped views, so no data is copied. Sessions are 
+    attached once per process, so that caches on the session (eg normalised tensors) are reused 
+    by all tasks of a worker.'''
+
+    def __init__(self, session_path):
+        self.session_path = session_path
+
+    def attach(self):
+        if self.session_path not in _attached_sessions:
+            _attached_sessions[self.session_path] = LazySessionLite(self.session_path)
+        return _attached_sessions[self.session_path]
+
+
+def get_session_store_size(sessions):
+    ''' Approximate size (bytes) of session store of dict of sessions (ie of their numpy arrays).'''
+    n_bytes = 0
+    for session in sessions.values():
+        for attr, value in session.__dict__.items():
+            if isinstance(value, np.ndarray) and not attr.endswith('_cache'):
+                n_bytes += value.nbytes
+        if isinstance(session, LazySessionLite):  # arrays that were not loaded
+            for attr in session._lazy_arrays.keys():
+                if attr not in session.__dict__:
+                    n_bytes += os.path.getsize(os.path.join(session._session_path, f'{attr}.npy'))
+    return n_bytes
+
+
+class SharedSessions:
+    ''' Context manager that shares a dict of sessions with worker processes. The sessions are 
+    saved once in a temporary session store in folder (default SHARED_STORE_FOLDER, ie shared memory), 
+    which is removed on exit. If folder does not have enough free space for the store (eg small tmpfs), 
+    tempfile.gettempdir() is used instead. Usage:
+
+    with SharedSessions(sessions) as handles:  # dict of SessionHandle, with the same keys as sessions
+        executor.submit(fun, handles)  # in worker: sessions = {k: h.attach() for k, h in handles.items()}
+    '''
+
+    def __init__(self, sessions, folder=None):
+        self.sessions = sessions
+        self.folder = SHARED_STORE_FOLDER if folder is None else folder
+        self.store_path, self.handles = None, None
+
+    def __enter__(self):
+        n_bytes = get_session_store_size(self.sessions)
+        if shutil.disk_usage(self.folder).free < 1.1 * n_bytes:  # (10% margin for metadata)
+            print(f'WARNING: not enough space in {self.folder} for sessions ({n_bytes / 1e9:.1f} GB), using {tempfile.gettempdir()}')
+            self.folder = tempfile.gettempdir()
+        self.store_path = tempfile.mkdtemp(prefix='shared_sessions_', dir=self.folder)
+        index = save_session_store(self.sessions, self.store_path)
+        self.handles = {key: SessionHandle(os.path.join(self.store_path, index[str(key)]))
+                        for key in self.sessions.keys()}
+        return self.handles
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.store_path, ignore_errors=True)
+
+
+def _run_with_session_handles(fun, handles, kwargs):
+    sessions = {key: handle.attach() for key, handle in handles.items()}
+    return fun(sessions=sessions, **kwargs)
+
+def map_with_shared_sessions(fun, sessions, list_kwargs, n_workers=1, mp_context='fork'):
+    ''' Return [fun(sessions=sessions, **kwargs) for kwargs in list_kwargs], computed by n_workers 
+    processes that attach to the sessions in shared memory (see SharedSessions), so that only
+    kwargs and results are pickled. fun must be a module-level function, eg 
+    pof.train_test_all_sessions with list_kwargs [{'trial_times_use': np.array([tp])} for tp in time_array].'''
+    if n_workers == 1:
+        return [fun(sessions=sessions, **kwargs) for kwargs in list_kwargs]
+    with SharedSessions(sessions) as handles:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context(mp_context)) as executor:
+            futures = [executor.submit(_run_with_session_handles, fun, handles, kwargs) for kwargs in list_kwargs]
+            return [future.result() for future in futures]
+
+
+if __name__ == '__main__':
+    convert_sessions_pkl(*sys.argv[1:])
@@ -1,10 +1,20 @@
 ## This script performs the regularisation sweep of the dynamic decoders. Results are saved.
+## Every (regularisation strength, decoder) combination is an independent job; jobs can be run in parallel
+## with --workers N. Each job saves its results to its own file (in a job folder), which are merged at the end
+## into the six pickle files of the sweep. Usage: python train_dyn_dec_regularisation.py --workers 32
+## With --reg_path, each decoder fits all regularisation strengths in one job (warm-started regularisation path).
+## Workers are forked by default, and inherit the sessions (and their cached normalised tensors). With --shared_sessions 
+## (required for --mp_context spawn/forkserver), sessions are passed via a shared memory session store instead (see 
+## session_store.SharedSessions): workers attach to the memory-mapped arrays, and compute their own normalised tensors.
 
 import popoff
 from Session import SessionLite, build_flu_array_single
+from session_store import SharedSessions
 from linear_model import PoolAcrossSessions, LinearModel, pca_session, LabelEncoder, largest_PC_trace, largest_PC_loading, do_pca
 import numpy as np
-import sys, os, pickle, copy
+import sys, os, pickle, copy, argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import pop_off_functions as pof
 import pop_off_plotting as pop
@@ -21,115 +31,178 @@ dict_tt_train = {'hit/cr': ['hit', 'cr'],
                  'hit/cr 10 trials': ['hit', 'cr']}  # to run 10 trials; set hard_set_10_trials to True
 subsample_timepoints = False  # if True, subsample time points for speed-up
 add_pop_var = True  # if True, add pop var (to enable split by pop var). takes a few minutes to add.
-
-## Load data in form of Jimmy's PAS object
-print('Loading data\n', '-----------\n')
-remove_targets = False
-pas = PoolAcrossSessions(save_PCA=False, subsample_sessions=False,
-                         remove_targets=remove_targets, remove_toosoon=True)
-# print(pas.sessions)
-
-## Create sessions object from PAS:
-try:  # ensure sessions doesn't exist yet 
-    sessions
-    assert type(sessions) is dict
-except NameError:
-    pass
-
-sessions = {}
-int_keys_pas_sessions = pas.sessions.keys()
-# print(int_keys_pas_sessions)
-i_s = 0
-for ses in pas.sessions.values():  # load into sessions dict (in case pas skips an int as key)
-    ses.signature = f'{ses.mouse}_R{ses.run_number}'
-    sessions[i_s] = ses
-    i_s += 1
-print(sessions)
-assert len(sessions) == 11
-pof.label_urh_arm(sessions=sessions)  # label arm and urh
-   
-print('------------------------------------')
-print(f'{len(sessions)} sessions are loaded')
-if add_pop_var:
-    print('Now adding population variance metrics to all sessions')
-print('------------------------------------')
-tp_dict = pof.create_tp_dict(sessions=sessions)
-
-## Add VCR measurements to session objects
-if add_pop_var:
-    pof.add_vcr_to_lm(lm_list=pas.linear_models)
-    list_save_covs = ['variance_cell_rates_s1']  # to be passed to the training function
-    print('-----\nPopulation variance added\n-----------')
-else:
-    list_save_covs = []
-
-## Define time points for training
-tp_dict['decoders'] = tp_dict['mutual']  # use all time points (resolution) that are shared between all sessions
-tp_dict['decoders'] = tp_dict['decoders'][np.logical_and(tp_dict['decoders'] >- 2,  # time window wherein decoders are trainined
-                                                         tp_dict['decoders'] <= 4)]
-if subsample_timepoints:
-    print('WARNING: SUBSAMPLING TIME POINTS')
-    tp_dict['decoders'] = tp_dict['decoders'][::20]  # optional: subsample to speed up 
-
-pre_stim_art_time = -0.07  # define ps artefact gap
-post_stim_art_time = 0.35  # assuming 150-cells-targeted trials are excluded
-time_array_plot = copy.deepcopy(tp_dict['decoders'])
-time_array_full = copy.deepcopy(tp_dict['decoders'])
-time_array_plot[np.logical_and(time_array_plot >= pre_stim_art_time, 
-                               time_array_plot < post_stim_art_time)] = np.nan
-time_array_full -= pre_stim_art_time
-time_array_plot -= pre_stim_art_time
-
-print('Training the following decoders: ', dict_tt_train.keys())
-
-## Make empty dicts to save results:
-all_lick_pred_split_tt, all_lick_pred_split_tt_nstim, all_lick_pred_split_tt_covar = {}, {} ,{}
-all_ps_pred_split_tt, all_ps_pred_split_tt_nstim, all_ps_pred_split_tt_covar = {}, {}, {}
-
-print('Regularisation strength: ', reg_strength_array)
-print('List covariates: ', list_save_covs)
-print('---------\nStart of training\n-----------')
-
-## Train: 
-## Compute results decoders (note: CV of regularisation is down below in the notebook)
-for i_reg, reg_strength in enumerate(reg_strength_array):
-    (all_lick_pred_split_tt[reg_strength], all_lick_pred_split_tt_nstim[reg_strength], 
-     all_lick_pred_split_tt_covar[reg_strength], all_ps_pred_split_tt[reg_strength], 
-     all_ps_pred_split_tt_nstim[reg_strength], 
-     all_ps_pred_split_tt_covar[reg_strength]) = {}, {}, {}, {}, {}, {}
-    for key, list_tt_train in dict_tt_train.items():
-        print(f'Now training {key} decoder of regularisation iteration {i_reg + 1}/{len(reg_strength_array)}')
-
-        (all_lick_pred_split_tt[reg_strength][key], all_lick_pred_split_tt_nstim[reg_strength][key], 
-         all_lick_pred_split_tt_covar[reg_strength][key], all_ps_pred_split_tt[reg_strength][key], 
-         all_ps_pred_split_tt_nstim[reg_strength][key], 
-         all_ps_pred_split_tt_covar[reg_strength][key]) = pof.compute_prediction_time_array_average_per_mouse_split(sessions=sessions, 
-                                                      time_array=tp_dict['decoders'],
-                                                      projected_data=False, 
-                                                      reg_type='l2', regularizer=reg_strength, 
+## Names of the six results (in order of output of pof.compute_prediction_time_array_average_per_mouse_split())
+result_names = ['all_lick_pred_split_tt', 'all_lick_pred_split_tt_nstim', 'all_lick_pred_split_tt_covar',
+                'all_ps_pred_split_tt', 'all_ps_pred_split_tt_nstim', 'all_ps_pred_split_tt_covar']
+
+## Global data, set in load_data(). Worker processes are forked after loading, so they inherit these.
+sessions, tp_dict, list_save_covs = None, None, None
+
+def load_data():
+    """Load sessions (as PAS object), add covariates and define time points for training."""
+    global sessions, tp_dict, list_save_covs
+    ## Load data in form of Jimmy's PAS object
+    print('Loading data\n', '-----------\n')
+    remove_targets = False
+    pas = PoolAcrossSessions(save_PCA=False, subsample_sessions=False,
+                             remove_targets=remove_targets, remove_toosoon=True)
+
+    ## Create sessions object from PAS:
+    sessions = {}
+    i_s = 0
+    for ses in pas.sessions.values():  # load into sessions dict (in case pas skips an int as key)
+        ses.signature = f'{ses.mouse}_R{ses.run_number}'
+        sessions[i_s] = ses
+        i_s += 1
+    print(sessions)
+    assert len(sessions) == 11
+    pof.label_urh_arm(sessions=sessions)  # label arm and urh
+
+    print('------------------------------------')
+    print(f'{len(sessions)} sessions are loaded')
+    if add_pop_var:
+        print('Now adding population variance metrics to all sessions')
+    print('------------------------------------')
+    tp_dict = pof.create_tp_dict(sessions=sessions)
+
+    ## Add VCR measurements to session objects
+    if add_pop_var:
+        pof.add_vcr_to_lm(lm_list=pas.linear_models)
+        list_save_covs = ['variance_cell_rates_s1']  # to be passed to the training function
+        print('-----\nPopulation variance added\n-----------')
+    else:
+        list_save_covs = []
+
+    ## Define time points for training
+    tp_dict['decoders'] = tp_dict['mutual']  # use all time points (resolution) that are shared between all sessions
+    tp_dict['decoders'] = tp_dict['decoders'][np.logical_and(tp_dict['decoders'] >- 2,  # time window wherein decoders are trainined
+                                                             tp_dict['decoders'] <= 4)]
+    if subsample_timepoints:
+        print('WARNING: SUBSAMPLING TIME POINTS')
+        tp_dict['decoders'] = tp_dict['decoders'][::20]  # optional: subsample to speed up
+
+    ## Cache normalised tensors (as used by pof.train_test_all_sessions()) before worker processes are forked,
+    ## so that all workers share them (copy-on-write) instead of each computing & keeping its own copy
+    for ss in sessions.values():
+        pop.normalise_raster_data(ss, sort_neurons=False, start_time=ss.filter_ps_time.min(),
+                                  end_time=ss.filter_ps_time.max(), filter_150_stim=False)
+
+def create_job_list(base_seed=0, reg_path=False):
+    """Create list of independent jobs (one per regularisation strength & decoder, or one per decoder 
+    if reg_path). Seeds only depend on the job index, so results do not depend on the number of workers."""
+    job_list = []
+    if reg_path:  # all regularisation strengths in one job
+        for i_key, (key, list_tt_train) in enumerate(dict_tt_train.items()):
+            job_list.append({'reg_strength': reg_strength_array, 'key': key,
+                             'list_tt_train': list_tt_train, 'seed': base_seed + len(job_list),
+                             'filename': f'job_regpath_dec{i_key}.pickle'})
+    else:
+        for i_reg, reg_strength in enumerate(reg_strength_array):
+            for i_key, (key, list_tt_train) in enumerate(dict_tt_train.items()):
+                job_list.append({'reg_strength': reg_strength, 'key': key,
+                                 'list_tt_train': list_tt_train, 'seed': base_seed + len(job_list),
+                                 'filename': f'job_reg{str(i_reg).zfill(2)}_dec{i_key}.pickle'})
+    return job_list
+
+def is_same_job(job, stored_job):
+    """Whether stored_job (saved with the results of a job file) has the same parameters as job."""
+    return (np.array_equal(job['reg_strength'], stored_job['reg_strength']) and job['key'] == stored_job['key'] and
+            job['seed'] == stored_job['seed'] and list(job['list_tt_train']) == list(stored_job['list_tt_train']))
+
+def run_job(job, job_folder, session_handles=None, time_array=None, list_covs=None):
+    """Train one decoder for one regularisation strength, and save results to its own file.
+    By default, the global sessions, tp_dict['decoders'] and list_save_covs are used (inherited by forked workers). 
+    If session_handles (dict of session_store.SessionHandle) is given, sessions are attached from the shared store."""
+    sessions_use = sessions if session_handles is None else {key: handle.attach() for key, handle in session_handles.items()}
+    time_array = tp_dict['decoders'] if time_array is None else time_array
+    list_covs = list_save_covs if list_covs is None else list_covs
+    job_path = os.path.join(job_folder, job['filename'])
+    if os.path.exists(job_path):  # already computed (eg in interrupted run), if with the same parameters
+        with open(job_path, 'rb') as handle:
+            stored_job = pickle.load(handle)['job']
+        if is_same_job(job, stored_job):
+            return job_path
+        print(f'WARNING: {job_path} was computed with other parameters ({stored_job}), recomputing')
+    np.random.seed(job['seed'])  # trial subsampling is random
+    results = pof.compute_prediction_time_array_average_per_mouse_split(sessions=sessions_use,
+                                                      time_array=time_array,
+                                                      projected_data=False,
+                                                      reg_type='l2', regularizer=job['reg_strength'],
                                                       average_fun=pof.class_av_mean_accuracy,
-                                                      list_tt_training=list_tt_train,
+                                                      list_tt_training=job['list_tt_train'],
                                                       concatenate_sessions_per_mouse=False,
-                                                      hard_set_10_trials=(True if key == 'hit/cr 10 trials' else False),
-                                                      list_save_covs=list_save_covs)
-
-## Save:
-dt = datetime.now()
-timestamp = str(dt.date()) + '-' + str(dt.hour).zfill(2) + str(dt.minute).zfill(2)
-with open(os.path.join(store_folder, timestamp + '__all_lick_pred_split_tt.pickle'), 'wb') as handle:
-    pickle.dump(all_lick_pred_split_tt, handle)
-
-with open(os.path.join(store_folder, timestamp + '__all_lick_pred_split_tt_nstim.pickle'), 'wb') as handle:
-    pickle.dump(all_lick_pred_split_tt_nstim, handle)
-
-with open(os.path.join(store_folder, timestamp + '__all_lick_pred_split_tt_covar.pickle'), 'wb') as handle:
-    pickle.dump(all_lick_pred_split_tt_covar, handle)
-
-with open(os.path.join(store_folder, timestamp + '__all_ps_pred_split_tt.pickle'), 'wb') as handle:
-    pickle.dump(all_ps_pred_split_tt, handle)
-
-with open(os.path.join(store_folder, timestamp + '__all_ps_pred_split_tt_nstim.pickle'), 'wb') as handle:
-    pickle.dump(all_ps_pred_split_tt_nstim, handle)
-
-with open(os.path.join(store_folder, timestamp + '__all_ps_pred_split_tt_covar.pickle'), 'wb') as handle:
-    pickle.dump(all_ps_pred_split_tt_covar, handle)
+                                                      hard_set_10_trials=(True if job['key'] == 'hit/cr 10 trials' else False),
+                                                      list_save_covs=list_covs)
+    if np.ndim(job['reg_strength']) == 0:
+        results = {job['reg_strength']: results}  # results per regularisation strength
+    for reg_strength in results.keys():
+        assert len(results[reg_strength]) == len(result_names)
+    with open(job_path + '.tmp', 'wb') as handle:  # write to tmp first, so that no partial files exist
+        pickle.dump({'job': job, 'results': results}, handle)
+    os.replace(job_path + '.tmp', job_path)
+    return job_path
+
+def merge_job_results(job_list, job_folder):
+    """Merge results of individual jobs into the six dictionaries (reg_strength -> decoder -> result)."""
+    all_results = {name: {reg_strength: {} for reg_strength in reg_strength_array} for name in result_names}
+    for job in job_list:
+        with open(os.path.join(job_folder, job['filename']), 'rb') as handle:
+            job_file = pickle.load(handle)
+        assert is_same_job(job, job_file['job']), f'{job["filename"]} does not contain the results of {job}'
+        job_results = job_file['results']
+        for reg_strength, results in job_results.items():
+            for i_name, name in enumerate(result_names):
+                all_results[name][reg_strength][job['key']] = results[i_name]
+    return all_results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regularisation sweep of dynamic decoders')
+    parser.add_argument('--workers', type=int, default=1, help='number of parallel processes')
+    parser.add_argument('--seed', type=int, default=0, help='base random seed (job i uses seed + i)')
+    parser.add_argument('--reg_path', action='store_true', 
+                        help='fit all regularisation strengths per decoder in one job (warm-started)')
+    parser.add_argument('--mp_context', type=str, default='fork', choices=['fork', 'spawn', 'forkserver'],
+                        help='start method of worker processes (spawn/forkserver require --shared_sessions)')
+    parser.add_argument('--shared_sessions', action='store_true',
+                        help='pass sessions to workers via a shared memory session store instead of fork inheritance')
+    parser.add_argument('--job_folder', type=str, default=None,
+                        help='folder to store results per job (default: new folder in store_folder). Existing job results are reused.')
+    args = parser.parse_args()
+    assert args.mp_context == 'fork' or args.shared_sessions, f'--mp_context {args.mp_context} requires --shared_sessions'
+
+    dt = datetime.now()
+    timestamp = str(dt.date()) + '-' + str(dt.hour).zfill(2) + str(dt.minute).zfill(2)
+    job_folder = args.job_folder if args.job_folder is not None else os.path.join(store_folder, timestamp + '__jobs')
+    os.makedirs(job_folder, exist_ok=True)
+
+    load_data()
+    job_list = create_job_list(base_seed=args.seed, reg_path=args.reg_path)
+
+    print('Training the following decoders: ', dict_tt_train.keys())
+    print('Regularisation strength: ', reg_strength_array)
+    print('List covariates: ', list_save_covs)
+    print(f'---------\nStart of training ({len(job_list)} jobs, {args.workers} workers)\n-----------')
+
+    ## Train:
+    ## Compute results decoders (note: CV of regularisation is down below in the notebook)
+    if args.workers == 1:
+        for job in tqdm(job_list):
+            run_job(job=job, job_folder=job_folder)
+    elif args.shared_sessions:
+        with SharedSessions(sessions) as session_handles:
+            with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context(args.mp_context)) as executor:
+                futures = [executor.submit(run_job, job, job_folder, session_handles, tp_dict['decoders'], list_save_covs)
+                           for job in job_list]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    future.result()  # raise errors of workers
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(run_job, job, job_folder) for job in job_list]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()  # raise errors of workers
+
+    ## Merge & save:
+    all_results = merge_job_results(job_list=job_list, job_folder=job_folder)
+    for name in result_names:
+        with open(os.path.join(store_folder, timestamp + f'__{name}.pickle'), 'wb') as handle:
+            pickle.dump(all_results[name], handle)